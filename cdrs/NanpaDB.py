@@ -0,0 +1,371 @@
+#!/usr/bin/python
+
+# NanpaDB: state, LATA and OCN of a NANP number (getNumberInfo), from an index file built out of the public
+# NPA-NXX (central office code) and NPA-NXX-X (thousands block) assignment files.
+#
+# The index is a flat binary file, mmap'ed read-only: opening it costs nothing however big it is, and worker
+# processes share the same pages through the page cache.  A number's NPA-NXX indexes directly into a directory
+# with an entry for every possible NPA-NXX, which points at the NPA-NXX record and at the NPA-NXX's thousands block
+# records, if any.  The thousands block wins (pooled blocks can belong to another carrier than the rest of the NXX).
+#
+#   header     magic 'NANPADB1', number of block records, number of NPA-NXX records    ('<8sII')
+#   directory  for NPANXX 0 .. 999999, and a last entry for 1000000:                   ('<II')
+#              NPA-NXX record number + 1 (0: none), number of the first block record of NPANXX
+#   blocks     key NPANXXX, state, lata, ocn (NUL padded), sorted by key              ('<I2s5s4sx')
+#   npa-nxxs   the same with key NPANXX
+#
+# Build or regenerate the index (the new file replaces the old one atomically; running processes keep the old
+# one until they load() again):
+#
+#   python NanpaDB.py --out /usr/local/share/nanpa/nanpa.db allutlzd.txt blocks.csv ...
+#
+# Input files are tab or comma separated with a header line naming the columns: 'NPA-NXX' (or 'NPA' and 'NXX'),
+# optionally 'X' (or 'Block') for thousands blocks, and any of 'State', 'LATA' and 'OCN'.  When several files have
+# the same NPA-NXX(-X), the later file's non-empty fields win; blocks get the state and LATA of their NPA-NXX when
+# their own file doesn't have them.
+#
+# test with py.test
+
+
+
+import sys, os, mmap, getopt, csv
+import logging as log
+from struct import Struct
+from array import array
+
+
+
+# default index file (or $NANPADB)
+DBFILE = os.environ.get('NANPADB', '/usr/local/share/nanpa/nanpa.db')
+
+MAGIC = 'NANPADB1'
+HEADER = Struct('<8sII')
+RECORD = Struct('<I2s5s4sx')
+KEY = Struct('<I')
+DIRENTRY = Struct('<II')
+DIRENTRIES = Struct('<IIII')  # an entry and the next one
+
+NNXX = 1000000
+
+DIRSIZE = DIRENTRY.size * (NNXX + 1)
+
+assert(HEADER.size == RECORD.size == 16)
+
+
+
+###############################################################################
+# {{{ class NanpaIndex
+
+class NanpaIndex(object):
+    'NanpaIndex == a read-only mmap of an index file'
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.nblocks, self.nnxx) = HEADER.unpack_from(self.mm, 0)
+
+        if magic != MAGIC or len(self.mm) != HEADER.size + DIRSIZE + RECORD.size * (self.nblocks + self.nnxx):
+            self.mm.close()
+            raise ValueError('%s is not a NanpaDB index file' % path)
+
+        self.dir = HEADER.size
+        self.blocks = self.dir + DIRSIZE
+        self.nxxs = self.blocks + RECORD.size * self.nblocks
+
+
+    # (state, lata, ocn) for a 10 digit number string, or None
+    def lookup(self, n):
+
+        mm = self.mm
+        npanxx = int(n[:6])
+
+        (nxx, b0, _, b1) = DIRENTRIES.unpack_from(mm, self.dir + npanxx * DIRENTRY.size)
+
+        r = None
+
+        if b1 > b0:  # the NPA-NXX has thousands blocks (at most 10)
+            key = npanxx * 10 + int(n[6])
+            for off in xrange(self.blocks + b0 * RECORD.size, self.blocks + b1 * RECORD.size, RECORD.size):
+                if KEY.unpack_from(mm, off)[0] == key:
+                    r = off
+                    break
+
+        if r is None:
+            if not nxx:
+                return None
+            r = self.nxxs + (nxx - 1) * RECORD.size
+
+        return tuple(v.rstrip('\0') or None for v in RECORD.unpack_from(mm, r)[1:])
+
+
+    def close(self):
+        self.mm.close()
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+# {{{ getNumberInfo
+
+
+index = None
+
+# (re)open the index file (DBFILE by default); getNumberInfo does this on first use
+def load(path=None):
+
+    global index
+
+    old = index
+    index = NanpaIndex(path or DBFILE)
+    if old:
+        old.close()
+
+
+# {'state', 'lata', 'ocn'} for a NANP number (10 digits, optionally after 1 or +1), or None if the number isn't
+# one or its NPA-NXX isn't in the index.  Raises IOError if the index file can't be opened.
+def getNumberInfo(number):
+
+    if not number:
+        return None
+
+    n = number.lstrip('+')
+    if len(n) == 11 and n[0] == '1':
+        n = n[1:]
+    if len(n) != 10 or not n.isdigit():
+        return None
+
+    if index is None:
+        load()
+
+    r = index.lookup(n)
+    if r is None:
+        return None
+
+    return {'state': r[0], 'lata': r[1], 'ocn': r[2]}
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+# {{{ building the index
+
+
+FIELDS = ('state', 'lata', 'ocn')
+WIDTHS = (2, 5, 4)
+
+# column names (lower case) of the input files
+COLUMNS = {
+    'npa-nxx':  'npanxx',
+    'npa-nxx-x': 'npanxxx',
+    'npa':      'npa',
+    'nxx':      'nxx',
+    'x':        'x',
+    'block':    'x',
+    'state':    'state',
+    'lata':     'lata',
+    'ocn':      'ocn',
+}
+
+
+# add the rows of an input file (header line first) to nxxs and blocks, dicts of key -> {field: value}.  Rows without
+# a valid NPA-NXX(-X) are counted in skipped[0].
+def readRows(rows, nxxs, blocks, skipped):
+
+    rows = iter(rows)
+    header = [COLUMNS.get(h.strip().lower()) for h in rows.next()]
+
+    for row in rows:
+
+        r = dict((c, v.strip()) for (c, v) in zip(header, row) if c)
+
+        digits = (r.get('npanxxx') or r.get('npanxx') or (r.get('npa', '') + r.get('nxx', ''))).replace('-', '')
+        if len(digits) == 6 and r.get('x'):
+            digits += r['x']
+
+        if not digits.isdigit() or len(digits) not in (6, 7):
+            skipped[0] += 1
+            continue
+
+        fields = dict((f, r[f]) for f in FIELDS if r.get(f))
+        table = blocks if len(digits) == 7 else nxxs
+        table.setdefault(int(digits), {}).update(fields)
+
+
+def readFile(path, nxxs, blocks, skipped):
+
+    with open(path, 'rb') as f:
+        dialect = csv.excel_tab if '\t' in f.readline() else csv.excel
+        f.seek(0)
+        readRows(csv.reader(f, dialect), nxxs, blocks, skipped)
+
+
+# write the index file for nxxs and blocks (key -> {field: value}), replacing path atomically
+def writeIndex(path, nxxs, blocks):
+
+    for (key, fields) in blocks.iteritems():
+        for (k, v) in nxxs.get(key // 10, {}).iteritems():
+            if k != 'ocn':
+                fields.setdefault(k, v)
+
+    # directory: interleaved (NPA-NXX record number + 1, first block record number) pairs
+    d = array('I', [0]) * (2 * (NNXX + 1))
+
+    for (i, key) in enumerate(sorted(nxxs)):
+        d[2*key] = i + 1
+
+    counts = array('I', [0]) * NNXX
+    for key in blocks:
+        counts[key // 10] += 1
+
+    b = 0
+    for npanxx in xrange(NNXX):
+        d[2*npanxx + 1] = b
+        b += counts[npanxx]
+    d[2*NNXX + 1] = b
+
+    if sys.byteorder != 'little':
+        d.byteswap()
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+
+        f.write(HEADER.pack(MAGIC, len(blocks), len(nxxs)))
+        d.tofile(f)
+
+        for table in (blocks, nxxs):
+            for key in sorted(table):
+                fields = table[key]
+                f.write(RECORD.pack(key, *[fields.get(k, '')[:w] for (k, w) in zip(FIELDS, WIDTHS)]))
+
+    os.rename(tmp, path)
+
+
+def build(files, path):
+
+    nxxs = {}
+    blocks = {}
+    skipped = [0]
+
+    for fn in files:
+        readFile(fn, nxxs, blocks, skipped)
+        log.info('%s: %d NPA-NXX and %d block records so far', fn, len(nxxs), len(blocks))
+
+    if skipped[0]:
+        log.warning('skipped %d rows without a valid NPA-NXX(-X)', skipped[0])
+
+    writeIndex(path, nxxs, blocks)
+    log.info('wrote %s: %d NPA-NXX and %d block records', path, len(nxxs), len(blocks))
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+## {{{ py.test tests
+
+
+def test_build_lookup(tmpdir):
+
+    f1 = tmpdir.join('allutlzd.txt')
+    f1.write('State\tNPA-NXX\tOcn\tCompany\n'
+             'OR\t541-223\t9740\tQwest\n'
+             'OR\t503-943\t9740\tQwest\n'
+             'XX\tnone\t\t\n')
+
+    f2 = tmpdir.join('blocks.csv')
+    f2.write('NPA,NXX,X,OCN,LATA\n'
+             '503,943,7,6534,672\n'
+             '541,223,,,670\n')
+
+    path = str(tmpdir.join('nanpa.db'))
+    build([str(f1), str(f2)], path)
+
+    assert os.path.getsize(path) == 16 + DIRSIZE + 16 * 3
+
+    load(path)
+
+    assert getNumberInfo('+15412233333') == {'state': 'OR', 'lata': '670', 'ocn': '9740'}
+    assert getNumberInfo('5039433333') == {'state': 'OR', 'lata': None, 'ocn': '9740'}
+    assert getNumberInfo('15039437333') == {'state': 'OR', 'lata': '672', 'ocn': '6534'}
+
+    assert getNumberInfo('5039443333') is None
+    assert getNumberInfo('2012223333') is None
+    assert getNumberInfo('9999999999') is None
+    assert getNumberInfo('+44123400067') is None
+    assert getNumberInfo('anonymous') is None
+    assert getNumberInfo(None) is None
+
+    tmpdir.join('bad.db').write('x' * 32)
+    try:
+        load(str(tmpdir.join('bad.db')))
+        assert False
+    except ValueError:
+        pass
+
+    assert index.path == path
+
+## }}}
+###############################################################################
+
+
+def cmdHelp(e=None):
+    if e:
+        print '***'
+        print ' error=',e
+        print '***'
+
+    print ''
+    print 'usage: NanpaDB.py [options] FILE ...'
+    print ' -h | --help'
+    print ' -v | --verbose'
+    print " --out     index file to write (default %s)" % (DBFILE)
+    print " --lookup  look up a number in the index instead"
+    print ''
+    print ' FILEs: NPA-NXX and NPA-NXX-X assignment files (tab or comma separated, with a header line)'
+    sys.exit(-1)
+
+
+if __name__ == '__main__':
+
+    rl = log.getLogger()
+    rl.setLevel(log.INFO)
+
+    p_out = DBFILE
+    p_lookup = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hv', ['out=', 'lookup=', 'help', 'verbose'])
+
+        for opt, arg in opts:
+
+            if opt=='--out':
+                p_out = arg
+            if opt=='--lookup':
+                p_lookup = arg
+
+            if opt=='--help' or opt=='-h':
+                cmdHelp()
+
+            if opt=='--verbose' or opt=='-v':
+                rl.setLevel(log.DEBUG)
+
+        if not p_lookup and not args:
+            raise ValueError('no input files')
+
+    except (getopt.GetoptError, ValueError) as e:
+        cmdHelp(e)
+
+    if p_lookup:
+        load(p_out)
+        print getNumberInfo(p_lookup)
+    else:
+        build(args, p_out)
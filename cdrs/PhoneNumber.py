@@ -3,321 +3,606 @@
 
 
 import re
-
-e164CountryCodes = {
-    '1242' : ('BS','Bahamas'),
-    '1246' : ('BB','Barbados'),
-    '1264' : ('AI','Anguilla'),
-    '1268' : ('AG','Antigua and Barbuda'),
-    '1284' : ('IVB','Territory of GB'),
-    '1340' : ('ISV','Territory of US'),
-    '1345' : ('KY','Cayman Islands'),
-    '1441' : ('BM','Bermuda'),
-    '1473' : ('GD','Grenada'),
-    '1649' : ('TC','Turks and Caicos Islands'),
-    '1664' : ('MS','Montserrat'),
-    '1670' : ('MP','Northern Mariana Islands'),
-    '1671' : ('GU','Guam'),
-    '1684' : ('AS','American Samoa'),
-    '1758' : ('LC','Saint Lucia'),
-    '1767' : ('DM','Dominica'),
-    '1784' : ('VC','Saint Vincent and the Grenadines'),
-    '18091' : ('DO','Dominican Republic'),
-    '18291' : ('DO','Dominican Republic'),
-    '1849' : ('DO','Dominican Republic'),
-    '1868' : ('TT','Trinidad and Tobago'),
-    '1869' : ('KN','Saint Kitts and Nevis'),
-    '1876' : ('JM','Jamaica'),
-    '1' : ('US','United States'), # and Canada
-    '20' : ('EG','Egypt'),
-    '211' : ('SS','South Sudan'),
-    '212' : ('EH','Western Sahara'),
-    '212' : ('MA','Morocco'),
-    '213' : ('DZ','Algeria'),
-    '216' : ('TN','Tunisia'),
-    '218' : ('LY','Libya'),
-    '220' : ('GM','Gambia'),
-    '221' : ('SN','Senegal'),
-    '222' : ('MR','Mauritania'),
-    '223' : ('ML','Mali'),
-    '224' : ('GN','Guinea'),
-    '225' : ('CI','Côte d\'Ivoire'),
-    '226' : ('BF','Burkina Faso'),
-    '227' : ('NE','Niger'),
-    '228' : ('TG','Togo'),
-    '229' : ('BJ','Benin'),
-    '230' : ('MU','Mauritius'),
-    '231' : ('LR','Liberia'),
-    '232' : ('SL','Sierra Leone'),
-    '233' : ('GH','Ghana'),
-    '234' : ('NG','Nigeria'),
-    '235' : ('TD','Chad'),
-    '236' : ('CF','Central African Republic'),
-    '237' : ('CM','Cameroon'),
-    '238' : ('CV','Cape Verde'),
-    '239' : ('ST','Sao Tome and Principe'),
-    '240' : ('GQ','Equatorial Guinea'),
-    '241' : ('GA','Gabon'),
-    '242' : ('CG','Congo'),
-    '243' : ('CD','Yes'),
-    '244' : ('AO','Angola'),
-    '245' : ('GW','Guinea-Bissau'),
-    '246' : ('IO','British Indian Ocean Territory'),
-    '248' : ('SC','Seychelles'),
-    '249' : ('SD','Sudan'),
-    '250' : ('RW','Rwanda'),
-    '251' : ('ET','Ethiopia'),
-    '252' : ('SO','Somalia'),
-    '253' : ('DJ','Djibouti'),
-    '254' : ('KE','Kenya'),
-    '255' : ('TZ','Yes'),
-    '256' : ('UG','Uganda'),
-    '257' : ('BI','Burundi'),
-    '258' : ('MZ','Mozambique'),
-    '260' : ('ZM','Zambia'),
-    '261' : ('MG','Madagascar'),
-    '262' : ('RE','Réunion'),
-    '262' : ('TF','French Southern Territories'),
-    '262' : ('YT','Mayotte'),
-    '263' : ('ZW','Zimbabwe'),
-    '264' : ('NA','Namibia'),
-    '265' : ('MW','Malawi'),
-    '266' : ('LS','Lesotho'),
-    '267' : ('BW','Botswana'),
-    '268' : ('SZ','Swaziland'),
-    '269' : ('KM','Comoros'),
-    '27' : ('ZA','South Africa'),
-    '290' : ('SH','Territory of GB'),
-    '291' : ('ER','Eritrea'),
-    '297' : ('AW','Aruba'),
-    '298' : ('FO','Faroe Islands'),
-    '299' : ('GL','Greenland'),
-    '30' : ('GR','Greece'),
-    '31' : ('NL','Netherlands'),
-    '32' : ('BE','Belgium'),
-    '33' : ('FR','France'),
-    '34' : ('ES','Spain'),
-    '350' : ('GI','Gibraltar'),
-    '351' : ('PT','Portugal'),
-    '352' : ('LU','Luxembourg'),
-    '353' : ('IE','Ireland'),
-    '354' : ('IS','Iceland'),
-    '355' : ('AL','Albania'),
-    '356' : ('MT','Malta'),
-    '357' : ('CY','Cyprus'),
-    '358' : ('AX','Åland Islands'),
-    '358' : ('FI','Finland'),
-    '359' : ('BG','Bulgaria'),
-    '36' : ('HU','Hungary'),
-    '370' : ('LT','Lithuania'),
-    '371' : ('LV','Latvia'),
-    '372' : ('EE','Estonia'),
-    '373' : ('MD','Yes'),
-    '374' : ('AM','Armenia'),
-    '375' : ('BY','Belarus'),
-    '376' : ('AD','Andorra'),
-    '377' : ('MC','Monaco'),
-    '378' : ('SM','San Marino'),
-    '380' : ('UA','Ukraine'),
-    '381' : ('SRB','Yes'),
-    '382' : ('ME','Montenegro'),
-    '385' : ('HR','Croatia'),
-    '386' : ('SI','Slovenia'),
-    '387' : ('BA','Bosnia and Herzegovina'),
-    '389' : ('MK','Yes'),
-    '3906' : ('VA','Holy See (Vatican City State)'),
-    '39' : ('IT','Italy'),
-    '40' : ('RO','Romania'),
-    '41' : ('CH','Switzerland'),
-    '420' : ('CZ','Czech Republic'),
-    '421' : ('SK','Slovakia'),
-    '423' : ('LI','Liechtenstein'),
-    '43' : ('AT','Austria'),
-    '44' : ('UK','United Kingdom'),
-    '45' : ('DK','Denmark'),
-    '46' : ('SE','Sweden'),
-    '47' : ('NO','Norway'),
-    '48' : ('PL','Poland'),
-    '49' : ('DE','Germany'),
-    '500' : ('FK','Falkland Islands (Malvinas)'),
-    '501' : ('BZ','Belize'),
-    '502' : ('GT','Guatemala'),
-    '503' : ('SV','El Salvador'),
-    '504' : ('HN','Honduras'),
-    '505' : ('NI','Nicaragua'),
-    '506' : ('CR','Costa Rica'),
-    '507' : ('PA','Panama'),
-    '508' : ('PM','Saint Pierre and Miquelon'),
-    '509' : ('HT','Haiti'),
-    '51' : ('PE','Peru'),
-    '52' : ('MX','Mexico'),
-    '53' : ('CU','Cuba'),
-    '54' : ('AR','Argentina'),
-    '55' : ('BR','Brazil'),
-    '56' : ('CL','Chile'),
-    '57' : ('CO','Colombia'),
-    '58' : ('VE','Yes'),
-    '590' : ('GP','Guadeloupe'),
-    '590' : ('MF','Saint Martin (French part)'),
-    '591' : ('BO','Yes'),
-    '592' : ('GY','Guyana'),
-    '593' : ('EC','Ecuador'),
-    '594' : ('GF','French Guiana'),
-    '595' : ('PY','Paraguay'),
-    '596' : ('MQ','Martinique'),
-    '597' : ('SR','Suriname'),
-    '598' : ('UY','Uruguay'),
-    '599' : ('AHO','840'),
-    '60' : ('MY','Malaysia'),
-    '61' : ('AU','Australia'),
-    '62' : ('ID','Indonesia'),
-    '63' : ('PH','Philippines'),
-    '64' : ('NZ','New Zealand'),
-    '65' : ('SG','Singapore'),
-    '66' : ('TH','Thailand'),
-    '670' : ('TL','Timor-Leste'),
-    '672' : ('AQ','Antarctica'),
-    '673' : ('BN','Brunei Darussalam'),
-    '674' : ('NR','Nauru'),
-    '675' : ('PG','Papua New Guinea'),
-    '676' : ('TO','Tonga'),
-    '677' : ('SB','Solomon Islands'),
-    '678' : ('VU','Vanuatu'),
-    '679' : ('FJ','Fiji'),
-    '680' : ('PW','Palau'),
-    '681' : ('WF','Wallis and Futuna'),
-    '682' : ('CK','Cook Islands'),
-    '683' : ('NU','Niue'),
-    '685' : ('WS','Samoa'),
-    '686' : ('KI','Kiribati'),
-    '687' : ('NC','New Caledonia'),
-    '688' : ('TV','Tuvalu'),
-    '689' : ('PF','French Polynesia'),
-    '690' : ('TK','Tokelau'),
-    '691' : ('FM','Yes'),
-    '692' : ('MH','Marshall Islands'),
-    '7' : ('RU','Russian Federation'),
-    '81' : ('JP','Japan'),
-    '82' : ('KOR','410'),
-    '84' : ('VN','Viet Nam'),
-    '850' : ('PRK','408'),
-    '852' : ('HK','Hong Kong'),
-    '853' : ('MO','Macao'),
-    '855' : ('KH','Cambodia'),
-    '856' : ('LA','Lao People\'s Democratic Republic'),
-    '86' : ('CN','China'),
-    '870' : ('PN','Pitcairn'),
-    '880' : ('BD','Bangladesh'),
-    '886' : ('TW','Yes'),
-    '90' : ('TR','Turkey'),
-    '91' : ('IN','India'),
-    '92' : ('PK','Pakistan'),
-    '93' : ('AF','Afghanistan'),
-    '94' : ('LK','Sri Lanka'),
-    '95' : ('MM','Myanmar'),
-    '960' : ('MV','Maldives'),
-    '961' : ('LB','Lebanon'),
-    '962' : ('JO','Jordan'),
-    '963' : ('SY','Syrian Arab Republic'),
-    '964' : ('IQ','Iraq'),
-    '965' : ('KW','Kuwait'),
-    '966' : ('SA','Saudi Arabia'),
-    '967' : ('YE','Yemen'),
-    '968' : ('OM','Oman'),
-    '970' : ('PLE','No universal currency'),
-    '971' : ('AE','United Arab Emirates'),
-    '972' : ('IL','Israel'),
-    '973' : ('BH','Bahrain'),
-    '974' : ('QA','Qatar'),
-    '975' : ('BT','Bhutan'),
-    '976' : ('MN','Mongolia'),
-    '977' : ('NP','Nepal'),
-    '98' : ('IR','Yes'),
-    '992' : ('TJ','Tajikistan'),
-    '993' : ('TM','Turkmenistan'),
-    '994' : ('AZ','Azerbaijan'),
-    '995' : ('GE','Georgia'),
-    '996' : ('KG','Kyrgyzstan'),
-    '998' : ('UZ','Uzbekistan'),
-}
+from collections import namedtuple
+
+import lrucache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # classify_many classifies one number at a time
+
+# (e164 country code, iso country code, country name).  Several territories can share a country code: all of them
+# are kept (see num2territories), and the first one listed is the one num2codes returns.
+e164Countries = [
+    ('1242', 'BS', 'Bahamas'),
+    ('1246', 'BB', 'Barbados'),
+    ('1264', 'AI', 'Anguilla'),
+    ('1268', 'AG', 'Antigua and Barbuda'),
+    ('1284', 'IVB', 'Territory of GB'),
+    ('1340', 'ISV', 'Territory of US'),
+    ('1345', 'KY', 'Cayman Islands'),
+    ('1441', 'BM', 'Bermuda'),
+    ('1473', 'GD', 'Grenada'),
+    ('1649', 'TC', 'Turks and Caicos Islands'),
+    ('1664', 'MS', 'Montserrat'),
+    ('1670', 'MP', 'Northern Mariana Islands'),
+    ('1671', 'GU', 'Guam'),
+    ('1684', 'AS', 'American Samoa'),
+    ('1758', 'LC', 'Saint Lucia'),
+    ('1767', 'DM', 'Dominica'),
+    ('1784', 'VC', 'Saint Vincent and the Grenadines'),
+    ('1849', 'DO', 'Dominican Republic'),
+    ('1868', 'TT', 'Trinidad and Tobago'),
+    ('1869', 'KN', 'Saint Kitts and Nevis'),
+    ('1876', 'JM', 'Jamaica'),
+    ('1', 'US', 'United States'), # and Canada
+    ('20', 'EG', 'Egypt'),
+    ('211', 'SS', 'South Sudan'),
+    ('212', 'MA', 'Morocco'),
+    ('212', 'EH', 'Western Sahara'),
+    ('213', 'DZ', 'Algeria'),
+    ('216', 'TN', 'Tunisia'),
+    ('218', 'LY', 'Libya'),
+    ('220', 'GM', 'Gambia'),
+    ('221', 'SN', 'Senegal'),
+    ('222', 'MR', 'Mauritania'),
+    ('223', 'ML', 'Mali'),
+    ('224', 'GN', 'Guinea'),
+    ('225', 'CI', 'Côte d\'Ivoire'),
+    ('226', 'BF', 'Burkina Faso'),
+    ('227', 'NE', 'Niger'),
+    ('228', 'TG', 'Togo'),
+    ('229', 'BJ', 'Benin'),
+    ('230', 'MU', 'Mauritius'),
+    ('231', 'LR', 'Liberia'),
+    ('232', 'SL', 'Sierra Leone'),
+    ('233', 'GH', 'Ghana'),
+    ('234', 'NG', 'Nigeria'),
+    ('235', 'TD', 'Chad'),
+    ('236', 'CF', 'Central African Republic'),
+    ('237', 'CM', 'Cameroon'),
+    ('238', 'CV', 'Cape Verde'),
+    ('239', 'ST', 'Sao Tome and Principe'),
+    ('240', 'GQ', 'Equatorial Guinea'),
+    ('241', 'GA', 'Gabon'),
+    ('242', 'CG', 'Congo'),
+    ('243', 'CD', 'Yes'),
+    ('244', 'AO', 'Angola'),
+    ('245', 'GW', 'Guinea-Bissau'),
+    ('246', 'IO', 'British Indian Ocean Territory'),
+    ('248', 'SC', 'Seychelles'),
+    ('249', 'SD', 'Sudan'),
+    ('250', 'RW', 'Rwanda'),
+    ('251', 'ET', 'Ethiopia'),
+    ('252', 'SO', 'Somalia'),
+    ('253', 'DJ', 'Djibouti'),
+    ('254', 'KE', 'Kenya'),
+    ('255', 'TZ', 'Yes'),
+    ('256', 'UG', 'Uganda'),
+    ('257', 'BI', 'Burundi'),
+    ('258', 'MZ', 'Mozambique'),
+    ('260', 'ZM', 'Zambia'),
+    ('261', 'MG', 'Madagascar'),
+    ('262', 'YT', 'Mayotte'),
+    ('262', 'RE', 'Réunion'),
+    ('262', 'TF', 'French Southern Territories'),
+    ('263', 'ZW', 'Zimbabwe'),
+    ('264', 'NA', 'Namibia'),
+    ('265', 'MW', 'Malawi'),
+    ('266', 'LS', 'Lesotho'),
+    ('267', 'BW', 'Botswana'),
+    ('268', 'SZ', 'Swaziland'),
+    ('269', 'KM', 'Comoros'),
+    ('27', 'ZA', 'South Africa'),
+    ('290', 'SH', 'Territory of GB'),
+    ('291', 'ER', 'Eritrea'),
+    ('297', 'AW', 'Aruba'),
+    ('298', 'FO', 'Faroe Islands'),
+    ('299', 'GL', 'Greenland'),
+    ('30', 'GR', 'Greece'),
+    ('31', 'NL', 'Netherlands'),
+    ('32', 'BE', 'Belgium'),
+    ('33', 'FR', 'France'),
+    ('34', 'ES', 'Spain'),
+    ('350', 'GI', 'Gibraltar'),
+    ('351', 'PT', 'Portugal'),
+    ('352', 'LU', 'Luxembourg'),
+    ('353', 'IE', 'Ireland'),
+    ('354', 'IS', 'Iceland'),
+    ('355', 'AL', 'Albania'),
+    ('356', 'MT', 'Malta'),
+    ('357', 'CY', 'Cyprus'),
+    ('358', 'FI', 'Finland'),
+    ('358', 'AX', 'Åland Islands'),
+    ('359', 'BG', 'Bulgaria'),
+    ('36', 'HU', 'Hungary'),
+    ('370', 'LT', 'Lithuania'),
+    ('371', 'LV', 'Latvia'),
+    ('372', 'EE', 'Estonia'),
+    ('373', 'MD', 'Yes'),
+    ('374', 'AM', 'Armenia'),
+    ('375', 'BY', 'Belarus'),
+    ('376', 'AD', 'Andorra'),
+    ('377', 'MC', 'Monaco'),
+    ('378', 'SM', 'San Marino'),
+    ('380', 'UA', 'Ukraine'),
+    ('381', 'SRB', 'Yes'),
+    ('382', 'ME', 'Montenegro'),
+    ('385', 'HR', 'Croatia'),
+    ('386', 'SI', 'Slovenia'),
+    ('387', 'BA', 'Bosnia and Herzegovina'),
+    ('389', 'MK', 'Yes'),
+    ('3906', 'VA', 'Holy See (Vatican City State)'),
+    ('39', 'IT', 'Italy'),
+    ('40', 'RO', 'Romania'),
+    ('41', 'CH', 'Switzerland'),
+    ('420', 'CZ', 'Czech Republic'),
+    ('421', 'SK', 'Slovakia'),
+    ('423', 'LI', 'Liechtenstein'),
+    ('43', 'AT', 'Austria'),
+    ('44', 'UK', 'United Kingdom'),
+    ('45', 'DK', 'Denmark'),
+    ('46', 'SE', 'Sweden'),
+    ('47', 'NO', 'Norway'),
+    ('48', 'PL', 'Poland'),
+    ('49', 'DE', 'Germany'),
+    ('500', 'FK', 'Falkland Islands (Malvinas)'),
+    ('501', 'BZ', 'Belize'),
+    ('502', 'GT', 'Guatemala'),
+    ('503', 'SV', 'El Salvador'),
+    ('504', 'HN', 'Honduras'),
+    ('505', 'NI', 'Nicaragua'),
+    ('506', 'CR', 'Costa Rica'),
+    ('507', 'PA', 'Panama'),
+    ('508', 'PM', 'Saint Pierre and Miquelon'),
+    ('509', 'HT', 'Haiti'),
+    ('51', 'PE', 'Peru'),
+    ('52', 'MX', 'Mexico'),
+    ('53', 'CU', 'Cuba'),
+    ('54', 'AR', 'Argentina'),
+    ('55', 'BR', 'Brazil'),
+    ('56', 'CL', 'Chile'),
+    ('57', 'CO', 'Colombia'),
+    ('58', 'VE', 'Yes'),
+    ('590', 'MF', 'Saint Martin (French part)'),
+    ('590', 'GP', 'Guadeloupe'),
+    ('591', 'BO', 'Yes'),
+    ('592', 'GY', 'Guyana'),
+    ('593', 'EC', 'Ecuador'),
+    ('594', 'GF', 'French Guiana'),
+    ('595', 'PY', 'Paraguay'),
+    ('596', 'MQ', 'Martinique'),
+    ('597', 'SR', 'Suriname'),
+    ('598', 'UY', 'Uruguay'),
+    ('599', 'AHO', '840'),
+    ('60', 'MY', 'Malaysia'),
+    ('61', 'AU', 'Australia'),
+    ('62', 'ID', 'Indonesia'),
+    ('63', 'PH', 'Philippines'),
+    ('64', 'NZ', 'New Zealand'),
+    ('65', 'SG', 'Singapore'),
+    ('66', 'TH', 'Thailand'),
+    ('670', 'TL', 'Timor-Leste'),
+    ('672', 'AQ', 'Antarctica'),
+    ('673', 'BN', 'Brunei Darussalam'),
+    ('674', 'NR', 'Nauru'),
+    ('675', 'PG', 'Papua New Guinea'),
+    ('676', 'TO', 'Tonga'),
+    ('677', 'SB', 'Solomon Islands'),
+    ('678', 'VU', 'Vanuatu'),
+    ('679', 'FJ', 'Fiji'),
+    ('680', 'PW', 'Palau'),
+    ('681', 'WF', 'Wallis and Futuna'),
+    ('682', 'CK', 'Cook Islands'),
+    ('683', 'NU', 'Niue'),
+    ('685', 'WS', 'Samoa'),
+    ('686', 'KI', 'Kiribati'),
+    ('687', 'NC', 'New Caledonia'),
+    ('688', 'TV', 'Tuvalu'),
+    ('689', 'PF', 'French Polynesia'),
+    ('690', 'TK', 'Tokelau'),
+    ('691', 'FM', 'Yes'),
+    ('692', 'MH', 'Marshall Islands'),
+    ('7', 'RU', 'Russian Federation'),
+    ('81', 'JP', 'Japan'),
+    ('82', 'KOR', '410'),
+    ('84', 'VN', 'Viet Nam'),
+    ('850', 'PRK', '408'),
+    ('852', 'HK', 'Hong Kong'),
+    ('853', 'MO', 'Macao'),
+    ('855', 'KH', 'Cambodia'),
+    ('856', 'LA', 'Lao People\'s Democratic Republic'),
+    ('86', 'CN', 'China'),
+    ('870', 'PN', 'Pitcairn'),
+    ('880', 'BD', 'Bangladesh'),
+    ('886', 'TW', 'Yes'),
+    ('90', 'TR', 'Turkey'),
+    ('91', 'IN', 'India'),
+    ('92', 'PK', 'Pakistan'),
+    ('93', 'AF', 'Afghanistan'),
+    ('94', 'LK', 'Sri Lanka'),
+    ('95', 'MM', 'Myanmar'),
+    ('960', 'MV', 'Maldives'),
+    ('961', 'LB', 'Lebanon'),
+    ('962', 'JO', 'Jordan'),
+    ('963', 'SY', 'Syrian Arab Republic'),
+    ('964', 'IQ', 'Iraq'),
+    ('965', 'KW', 'Kuwait'),
+    ('966', 'SA', 'Saudi Arabia'),
+    ('967', 'YE', 'Yemen'),
+    ('968', 'OM', 'Oman'),
+    ('970', 'PLE', 'No universal currency'),
+    ('971', 'AE', 'United Arab Emirates'),
+    ('972', 'IL', 'Israel'),
+    ('973', 'BH', 'Bahrain'),
+    ('974', 'QA', 'Qatar'),
+    ('975', 'BT', 'Bhutan'),
+    ('976', 'MN', 'Mongolia'),
+    ('977', 'NP', 'Nepal'),
+    ('98', 'IR', 'Yes'),
+    ('992', 'TJ', 'Tajikistan'),
+    ('993', 'TM', 'Turkmenistan'),
+    ('994', 'AZ', 'Azerbaijan'),
+    ('995', 'GE', 'Georgia'),
+    ('996', 'KG', 'Kyrgyzstan'),
+    ('998', 'UZ', 'Uzbekistan'),
+]
+
+# country code -> (iso country code, country name) of the first territory listed
+e164CountryCodes = {}
+
+# country code -> ((iso country code, country name), ...) of all the territories sharing it
+e164Territories = {}
+
+# prefix trie over the country codes: a node is a dict of digit -> child node, plus None -> [(iso, name), ...] if a
+# country code ends there
+e164Trie = {}
+
+MAXCCLEN = max(len(cc) for (cc, iso, name) in e164Countries)
+
+def _compile():
+    for (cc, iso, name) in e164Countries:
+        e164CountryCodes.setdefault(cc, (iso, name))
+        node = e164Trie
+        for d in cc:
+            node = node.setdefault(d, {})
+        node.setdefault(None, []).append((iso, name))
+        e164Territories[cc] = e164Territories.get(cc, ()) + ((iso, name),)
+
+_compile()
 
 
 
 
 
 nchars = re.compile('[^0-9\+]+')
+_nchars = ''.join(chr(c) for c in range(256) if chr(c) not in '0123456789+')  # for str.translate
 
-# returns (e164 country code, remainder of number, iso country code, country name)
-def num2codes(num):
+# digits (and '+') of num, international/national dialing prefix removed; None if too short to be a number
+def _normalize(num):
 
-    if not num:
-        return None
-
-    n = nchars.sub('', num)
+    if isinstance(num, unicode):
+        n = nchars.sub('', num)
+    else:
+        n = num.translate(None, _nchars)
 
     if len(n) < 8: return None
 
-    if n.startswith('+'): n = n[1:]
-    elif n.startswith('011'): n = n[3:]
-    elif n.startswith('001'): n = n[3:]
-    elif n.startswith('00'): n = n[2:]
-    elif n.startswith('0'): n = n[1:]
+    c = n[0]
+    if c == '+': n = n[1:]
+    elif c == '0':
+        if n[1] == '0':
+            if n[2] == '1': n = n[3:]  # 001
+            else: n = n[2:]            # 00
+        elif n[1] == '1' and n[2] == '1': n = n[3:]  # 011
+        else: n = n[1:]
 
     if len(n) < 8: return None
 
-    cc = None
-    nn = None
+    return n
 
-    for i in range(1, min(5, len(num)-6)):
+# longest country code n starts with that leaves at least MINREST digits: (country code, remainder,
+# [(iso, name), ...]) or None
+MINREST = 6
 
-        if n[0:i] in e164CountryCodes:
-            cc = n[0:i]
-            nn = n[i:]
+def _match(n):
 
-    if cc: 
-        d1 = e164CountryCodes[cc]
-        return (cc, nn, d1[0], d1[1])
+    node = e164Trie
+    i = 0
+    ccl = 0
+    territories = None
 
-    else:
-        return None
+    for d in n[:min(MAXCCLEN, len(n) - MINREST)]:
+        node = node.get(d)
+        if node is None:
+            break
+        i += 1
+        t = node.get(None)
+        if t:
+            (ccl, territories) = (i, t)
+
+    if territories:
+        return (n[:ccl], n[ccl:], territories)
+
+    return None
+
+
+###############################################################################
+# {{{ parse(): everything about a number, computed once
 
+# distinct numbers kept by parse (see setCacheSize)
+PARSE_CACHESIZE = 50000
 
+parseCache = lrucache.LRUCache(PARSE_CACHESIZE)
 
+def setCacheSize(n):
+    global parseCache
+    parseCache = lrucache.LRUCache(n)
+
+# hits, misses and size of the parse cache
+def cacheStats():
+    return parseCache.stats()
+
+
+class ParsedNumber(namedtuple('ParsedNumber', 'num digits cc rest territories domestic international')):
+    'ParsedNumber == what parse() found out about a number (immutable)'
+
+    __slots__ = ()
+
+    # iso country code and country name of the first territory listed for cc (None if no match)
+    @property
+    def country(self):
+        return self.territories[0][0] if self.territories else None
+
+    @property
+    def name(self):
+        return self.territories[0][1] if self.territories else None
+
+    # a country code matched, leaving a plausible subscriber number
+    @property
+    def valid(self):
+        return self.cc is not None
+
+    # jurisdiction type: 'D' (US domestic), 'I' (international) or 'U' (unknown)
+    @property
+    def jtype(self):
+        if self.domestic: return 'D'
+        if self.international: return 'I'
+        return 'U'
+
+    # neither domestic nor international: the customer's BTN is used instead (see nccdr Cdr._finalizeFields)
+    @property
+    def needsBtn(self):
+        return not self.domestic and not self.international
 
 
 uspm = re.compile('^((\+1)|1)?\\d{10}$')
 
-# this is too lax .. just checks for 10 digits
+# parse num (a string, or None): the ParsedNumber from parseCache, or computed and cached
+def parse(num):
+    return parseCache.lookup(num, _parse)
+
+def _parse(num):
+
+    digits = cc = rest = territories = None
+
+    if num:
+        digits = _normalize(num)
+        if digits:
+            m = _match(digits)
+            if m:
+                (cc, rest, territories) = (m[0], m[1], e164Territories[m[0]])
+
+    # note: the domestic check is lax: it just checks for 10 digits
+    domestic = num is not None and uspm.match(num) is not None
+
+    international = (cc is not None and not domestic and not num.startswith('+1') and not num.startswith('1') and
+                     len(num) > 9)
+
+    return ParsedNumber(num, digits, cc, rest, territories, domestic, international)
+
+# }}}
+###############################################################################
+
+
+# returns (e164 country code, remainder of number, iso country code, country name)
+def num2codes(num):
+
+    p = parse(num)
+    if p.cc is None:
+        return None
+
+    return (p.cc, p.rest, p.country, p.name)
+
+# num2codes for a list of numbers (each distinct number is parsed once)
+def num2codes_many(nums):
+
+    done = {}
+    codes = []
+
+    for num in nums:
+        c = done.get(num, done)
+        if c is done:
+            c = done[num] = num2codes(num)
+        codes.append(c)
+
+    return codes
+
+# all territories sharing the country code of num: (e164 country code, remainder, [(iso, name), ...]), or None
+def num2territories(num):
+
+    p = parse(num)
+    if p.cc is None:
+        return None
+
+    return (p.cc, p.rest, list(p.territories))
+
+
 def isUSdomesticNumber(num):
-    if num == None: return False
-    return uspm.match(num) != None
+    return parse(num).domestic
 
 # check if number is valid and we can match a country code
 def isInterationalNumber(num):
+    return parse(num).international
 
-    if not looksLikeValidPSTNnumber(num):
-        return False
+def looksLikeValidPSTNnumber(num):
+    return parse(num).valid
 
-    if isUSdomesticNumber(num): return False
 
-    if num.startswith('+1') or num.startswith('1'): return False
-    return len(num) > 9
+# (e164 country code, remainder, iso country code, jurisdiction type) of num.  The jurisdiction type is 'D' for
+# isUSdomesticNumber, 'I' for isInterationalNumber, else 'U'; the first 3 are None if no country code matches.
+def classify(num):
+    p = parse(num)
+    return (p.cc, p.rest, p.country, p.jtype)
 
 
+# parse() for a list of numbers, through the same cache.  The numbers that aren't cached are parsed together
+# (_parseMatrix) if numpy is there, else one at a time.
+def parse_many(nums):
+    return parseCache.lookupMany(nums, _parseMany)
 
-def looksLikeValidPSTNnumber(num):
+def _parseMany(nums):
+
+    if np is None:
+        return [_parse(num) for num in nums]
 
-    if not num or len(num) < 8:
-        return False
+    parsed = [None] * len(nums)
 
-    num = nchars.sub('', num)
+    # byte strings go in the matrix; anything else (None, '', non-ascii unicode) is done by _parse()
+    idx = []
+    strs = []
+    for (i, num) in enumerate(nums):
+        if num and isinstance(num, unicode):
+            try:
+                num = num.encode('ascii')
+            except UnicodeError:
+                num = None
+        if num:
+            idx.append(i)
+            strs.append(num)
+        else:
+            parsed[i] = _parse(nums[i])
 
-    if len(num) < 8:
-        return False
+    if strs:
+        for (i, digits, cc, rest, domestic, international) in zip(idx, *_parseMatrix(strs)):
+            parsed[i] = ParsedNumber(nums[i], digits, cc, rest, e164Territories.get(cc), domestic, international)
 
-    c = num2codes(num)
+    return parsed
 
-    return c != None and len(c[1]) >= 6
+
+# classify for a whole list of numbers, as columns (cc, rest, country, jtype): numpy arrays of object (str or
+# None) and of 'S1' (lists without numpy).  See parse_many.
+def classify_many(nums):
+
+    cols = ([], [], [], [])
+    for p in parse_many(nums):
+        for (col, v) in zip(cols, (p.cc, p.rest, p.country, p.jtype)):
+            col.append(v)
+
+    if np is None:
+        return cols
+
+    return (np.array(cols[0], dtype=object), np.array(cols[1], dtype=object), np.array(cols[2], dtype=object),
+            np.array(cols[3], dtype='S1'))
+
+
+# country codes of each length k as sorted ints, with their code strings: k -> (codes, ccs), for _parseMatrix
+_ccTables = {}
+
+def _compileTables():
+    for k in range(1, MAXCCLEN+1):
+        ccs = sorted(cc for cc in e164CountryCodes if len(cc) == k)
+        _ccTables[k] = (np.array([int(cc) for cc in ccs], dtype=np.int64), np.array(ccs, dtype=object))
+
+if np is not None:
+    _compileTables()
+
+
+(C_PLUS, C_0, C_1) = (ord('+'), ord('0'), ord('1'))
+
+# _parse for a list of byte strings, as lists (digits, cc, rest, domestic, international).  The numbers are laid out
+# as a fixed-width byte matrix, and the domestic pattern, the dialing prefix, the country code match and the
+# international checks are column operations over it instead of regex and trie work per string.
+def _parseMatrix(strs):
+
+    n = len(strs)
+    w = max(12, max(len(s) for s in strs))  # >= the longest dialing prefix + country code
+    rows = np.arange(n)[:,None]
+    cols = np.arange(w)
+
+    b = np.array(strs, dtype='S%d' % w).view(np.uint8).reshape(n, w)  # zero padded
+    l = np.array([len(s) for s in strs])
+    pad = cols >= l[:,None]
+
+    digit = (b >= C_0) & (b <= C_0 + 9)
+    (c0, c1) = (b[:,0], b[:,1])
+
+    # isUSdomesticNumber: 10 digits, optionally after 1 or +1
+    nondigits = (~digit & ~pad).sum(1)
+    domestic = (((nondigits == 0) & ((l == 10) | ((l == 11) & (c0 == C_1)))) |
+                ((nondigits == 1) & (l == 12) & (c0 == C_PLUS) & (c1 == C_1)))
+
+    # _normalize: keep digits and '+' (moved to the front of each row), then drop the dialing prefix
+    keep = digit | (b == C_PLUS)
+    m = keep.sum(1)
+    (r, c) = np.nonzero(keep)
+    nb = np.zeros_like(b)
+    nb[r, np.cumsum(keep, 1)[r, c] - 1] = b[r, c]
+
+    (d0, d1, d2) = (nb[:,0], nb[:,1], nb[:,2])
+    off = np.where(d0 == C_PLUS, 1, 0)
+    zero = d0 == C_0
+    off[zero] = 1
+    off[zero & (d1 == C_0)] = 2
+    off[zero & (((d1 == C_0) & (d2 == C_1)) | ((d1 == C_1) & (d2 == C_1)))] = 3
+
+    valid = (m >= 8) & (m - off >= 8)
+
+    # _match: the longest country code leaving at least MINREST digits
+    ccl = np.zeros(n, dtype=np.int64)
+    cci = np.zeros(n, dtype=np.int64)
+
+    head = nb[rows, off[:,None] + np.arange(MAXCCLEN)]
+    hdigit = (head >= C_0) & (head <= C_0 + 9)
+    alldigits = valid.copy()
+    val = np.zeros(n, dtype=np.int64)
+
+    for k in range(1, MAXCCLEN+1):
+
+        alldigits &= hdigit[:,k-1]
+        val = val * 10 + (head[:,k-1].astype(np.int64) - C_0)
+
+        codes = _ccTables[k][0]
+        j = np.minimum(np.searchsorted(codes, val), len(codes) - 1)
+        hit = alldigits & (k <= m - off - MINREST) & (codes[j] == val)
+
+        ccl[hit] = k
+        cci[hit] = j[hit]
+
+    matched = ccl > 0
+
+    cc = np.empty(n, dtype=object)
+    for k in range(1, MAXCCLEN+1):
+        sel = ccl == k
+        if sel.any():
+            cc[sel] = _ccTables[k][1][cci[sel]]
+
+    # the rows' bytes from start on, as strings (for the rows in mask, None for the others)
+    def substr(start, mask):
+        t = nb[rows, np.minimum(start[:,None] + cols, w - 1)]
+        t[start[:,None] + cols >= m[:,None]] = 0
+        col = np.empty(n, dtype=object)
+        col[mask] = t[mask].copy().view('S%d' % w).ravel().astype(object)
+        return col
+
+    digits = substr(off, valid)
+    rest = substr(off + ccl, matched)
+
+    # isInterationalNumber: a country code matched, not a +1/1 number, more than 9 characters
+    intl = matched & ~domestic & (c0 != C_1) & ~((c0 == C_PLUS) & (c1 == C_1)) & (l > 9)
+
+    return (digits.tolist(), cc.tolist(), rest.tolist(), domestic.tolist(), intl.tolist())
 
 
 ###############################################################################
@@ -365,6 +650,27 @@ def test_c2():
     assert c[1] == '5036459751'
     assert c[2] == 'US'
 
+def test_shared_codes():
+
+    # all territories of a shared code are kept; num2codes returns the first one listed
+    c = num2territories('+358401234567')
+    assert c[0] == '358'
+    assert [t[0] for t in c[2]] == ['FI', 'AX']
+    assert num2codes('+358401234567')[2] == 'FI'
+    assert [t[0] for t in num2territories('+262262123456')[2]] == ['YT', 'RE', 'TF']
+
+    # 1-809 and 1-829 numbers have no code of their own in the table (they match 1, US); 1-849 does
+    assert num2codes('+18091234567')[0:3] == ('1', '8091234567', 'US')
+    assert num2codes('+18092345678')[0:3] == ('1', '8092345678', 'US')
+    assert num2codes('+18492345678')[0:3] == ('1849', '2345678', 'DO')
+
+    # the remainder must have at least 6 digits, however the number was formatted
+    assert num2codes('01123025706') == None
+    assert num2codes('+230 2570 6123')[0:2] == ('230', '25706123')
+
+    nums = ['+44123400067', None, '+44123400067', 'anonymous', '1 (503) 645-9751']
+    assert num2codes_many(nums) == [num2codes(n) for n in nums]
+
 def test_looks_valid():
 
     assert looksLikeValidPSTNnumber('+44123400067')
@@ -380,6 +686,52 @@ def test_is_domestic_or_intl():
     assert isInterationalNumber('00528182436554')
     assert not isUSdomesticNumber('00528182436554')
 
+def test_parse():
+
+    setCacheSize(3)
+
+    p = parse('0044 1234 00067')
+    assert (p.digits, p.cc, p.rest, p.country, p.name) == ('44123400067', '44', '123400067', 'UK', 'United Kingdom')
+    assert p.valid and p.international and not p.domestic and not p.needsBtn and p.jtype == 'I'
+
+    p = parse('+15039433333')
+    assert p.domestic and not p.international and p.jtype == 'D' and p.country == 'US'
+
+    p = parse('anonymous')
+    assert (p.digits, p.cc, p.country) == (None, None, None)
+    assert not p.valid and p.needsBtn and p.jtype == 'U'
+
+    assert parse(None).jtype == 'U'
+    assert [t[0] for t in parse('+358401234567').territories] == ['FI', 'AX']
+
+    try:
+        p.cc = '1'
+        assert False
+    except AttributeError:
+        pass
+
+    assert parse('+15039433333') is parse('+15039433333')
+    assert cacheStats() == {'hits': 1, 'misses': 6, 'size': 3, 'maxsize': 3}  # +1503.. was evicted
+
+    setCacheSize(PARSE_CACHESIZE)
+
+def test_classify_many():
+
+    nums = ['+44123400067', '14512345670', '+12122345678', '+16642223333', '0115527642223333', '18763988463',
+            '1 (503) 645-9751', '5036459751', '+15039433333', '00528182436554', '+358401234567', '+18091234567',
+            '01123025706', '+230 2570 6123', '0533-999', 'anonymous', '', None, u'+44123400067', u'+44 1234 \xe900067',
+            '+1503943333', '0044++123400067', '+447700900123456789', '123', '1+5039433333']
+
+    # the matrix against the per-number parse, then through the cache
+    assert _parseMany(nums) == [_parse(num) for num in nums]
+
+    parseCache.clear()
+    (cc, rest, country, jtype) = classify_many(nums)
+    assert [tuple(r) for r in zip(cc, rest, country, jtype)] == [classify(num) for num in nums]
+    assert parse_many(nums[:2]) == [parse(nums[0]), parse(nums[1])]
+
+    assert classify_many([])[3].tolist() == []
+
 ## }}}
 ###############################################################################
 
@@ -0,0 +1,415 @@
+#!/usr/bin/python
+
+# Synthetic opensips acc rows, for measuring process_cdrs throughput (and for tests that need more than a handful
+# of hand-written rows).
+#
+# AccGen makes calls out of a weighted mix of scenarios:
+#
+#   answered    0..n failed branches (serial failover), then a 200 and a BYE
+#   reinvite    answered, with a re-INVITE in the confirmed dialog
+#   failed      every branch fails; the last branch's error goes back to the caller
+#   noroute     every branch fails, then the 480 without to_tag we send when out of routes
+#   incomplete  answered, no BYE yet (call still up)
+#   straybye    a BYE without the INVITE transactions (missing from acc)
+#
+# plus an optional fraction of duplicated acc rows, and configurable customer/terminator mixes and durations.
+#
+# Benchmark: process_cdrs_iter in TESTMODE, each size in its own process so the peak RSS is per size:
+#
+#   python accgen.py [--calls 10000,100000,1000000] [--feed 20000] [--seed 1]
+#
+# The benchmark and the tests classify the numbers against their own NanpaDB index (writeNanpaIndex), covering
+# AccGen's NPAs, not the installed one.
+#
+# test with py.test
+
+
+
+import sys, os, getopt, time, random, resource, multiprocessing, tempfile, shutil
+import logging as log
+from datetime import datetime
+from datetime import timedelta
+
+import netcall, nccdr, NanpaDB
+
+
+
+###############################################################################
+# {{{ class AccGen
+
+class AccGen(object):
+    'synthetic acc rows, a call at a time'
+
+    SCENARIOS = {'answered': 60, 'reinvite': 5, 'failed': 15, 'noroute': 5, 'incomplete': 10, 'straybye': 5}
+    CUSTOMERS = {'a22': 5, 'vxb': 3, 'vxr': 2, 'cnx': 1}
+    TERMINATORS = {'erl': 4, 'wds': 3, 'ctl': 2, 'lv3': 1}
+    FAILCODES = ('403', '404', '408', '486', '503')
+    NPAS = {'503': 'OR', '541': 'OR', '971': 'OR', '212': 'NY', '415': 'CA', '312': 'IL'}
+
+    # mix: scenario weights; customers/terminators: code3 weights; maxbranches: serial failover attempts;
+    # dupes: fraction of rows duplicated; duration/setup: mean seconds (exponential);
+    # nanums/nbnums: size of the caller-id / dialed number pools (numbers repeat, as they do in real traffic)
+    def __init__(self, seed=None, mix=None, customers=None, terminators=None, maxbranches=3, dupes=0.01,
+                 duration=90, setup=4, nanums=5000, nbnums=20000, start=datetime(2013, 6, 19)):
+
+        self.rnd = random.Random(seed)
+
+        self.mix = _cumulative(mix or AccGen.SCENARIOS)
+        self.customers = _cumulative(customers or AccGen.CUSTOMERS)
+        self.terminators = _cumulative(terminators or AccGen.TERMINATORS)
+        self.maxbranches = maxbranches
+        self.dupes = dupes
+        self.duration = duration
+        self.setup = setup
+
+        npas = sorted(AccGen.NPAS)
+        self.anums = ['+1%s%07d' % (self.rnd.choice(npas), self.rnd.randrange(10**7)) for i in range(nanums)]
+        self.bnums = ['1%s%07d' % (self.rnd.choice(npas), self.rnd.randrange(10**7)) for i in range(nbnums)]
+
+        self.t = start
+        self.nextid = 1
+        self.ncalls = 0
+        self.scenarios = {}  # callid -> scenario name of the calls in the last batch, for tests
+
+
+    # rows and Call-Ids for ncalls calls
+    def batch(self, ncalls):
+
+        rows = []
+        callids = []
+        self.scenarios = {}
+
+        for i in range(ncalls):
+            (cid, crows) = self.call()
+            callids.append(cid)
+            rows.extend(crows)
+
+        return (rows, callids)
+
+
+    # (callid, rows) for one call
+    def call(self):
+
+        rnd = self.rnd
+
+        self.ncalls += 1
+        self.t += timedelta(seconds=rnd.randrange(3))  # calls start a few per second
+
+        scenario = _pick(rnd, self.mix)
+        cid = '%032x@10.1.%d.%d:5060' % (rnd.getrandbits(128), rnd.randrange(256), rnd.randrange(256))
+        self.scenarios[cid] = scenario
+
+        c = {
+            'callid':     cid,
+            'src_id':     _pick(rnd, self.customers),
+            'caller_id':  rnd.choice(self.anums),
+            'callee_id':  rnd.choice(self.bnums),
+            'from_tag':   'as%08x' % (rnd.getrandbits(32)),
+            'ruleid':     long(rnd.randrange(200000, 210000)),
+            'cp_node':    rnd.choice(('g07', 'g08')),
+        }
+        c['callee_lrn'] = c['callee_id']
+
+        rows = []
+        t = self.t
+
+        if scenario == 'straybye':
+            rows.append(self._bye(c, 'tag%08x' % (rnd.getrandbits(32)), t))
+            return (cid, self._dupes(rows))
+
+        nfail = rnd.randrange(self.maxbranches)
+        if scenario in ('failed', 'noroute'):
+            nfail = max(nfail, 1)
+
+        # failed branches
+        for bid in range(nfail):
+            t2 = t + timedelta(seconds=int(rnd.expovariate(1.0/self.setup)))
+            dst = _pick(rnd, self.terminators)
+            rows.append(self._invite(c, bid, 'tag%08x' % (rnd.getrandbits(32)), dst, rnd.choice(AccGen.FAILCODES), t, t2))
+            t = t2
+
+        if scenario == 'failed':
+            return (cid, self._dupes(rows))
+
+        if scenario == 'noroute':
+            row = self._invite(c, nfail, '', None, '480', t, t)
+            rows.append(row)
+            return (cid, self._dupes(rows))
+
+        # the answered branch
+        bid = nfail
+        tag = 'tag%08x' % (rnd.getrandbits(32))
+        dst = _pick(rnd, self.terminators)
+        t1 = t + timedelta(seconds=int(rnd.expovariate(1.0/self.setup)))
+        t2 = t1 + timedelta(seconds=1+int(rnd.expovariate(1.0/self.setup)))
+        rows.append(self._invite(c, bid, tag, dst, '180', t, t1))
+        rows.append(self._invite(c, bid, tag, dst, '200', t, t2))
+
+        t3 = t2 + timedelta(seconds=1+int(rnd.expovariate(1.0/self.duration)))
+
+        if scenario == 'reinvite':
+            tr = t2 + timedelta(seconds=(t3-t2).seconds//2)
+            row = self._invite(c, bid, tag, dst, '200', tr, tr)
+            row['t_branch_idx'] = ''
+            rows.append(row)
+
+        if scenario != 'incomplete':
+            rows.append(self._bye(c, tag, t3))
+
+        return (cid, self._dupes(rows))
+
+
+    def _row(self, c, method, to_tag, bid, dst, code, prtime, tm):
+
+        r = {
+            'id': long(self.nextid), 'callid': c['callid'], 'method': method, 'from_tag': c['from_tag'], 'to_tag': to_tag,
+            'sip_code': code, 'sip_reason': '', 't_branch_idx': bid, 'src_id': c['src_id'], 'dst_id': dst, 'dst_id2': dst,
+            'caller_id': c['caller_id'], 'callee_id': '', 'callee_lrn': '', 'ruleid': 0L, 'cp_node': c['cp_node'],
+            'duration': 0L, 'setuptime': 0L, 'created': None, 'prtime': prtime, 'time': tm,
+        }
+        self.nextid += 1
+        return r
+
+    def _invite(self, c, bid, to_tag, dst, code, prtime, tm):
+        r = self._row(c, 'INVITE', to_tag, str(bid), dst, code, prtime, tm)
+        r['callee_id'] = c['callee_id']
+        r['callee_lrn'] = c['callee_lrn']
+        r['ruleid'] = c['ruleid']
+        return r
+
+    def _bye(self, c, to_tag, tm):
+        return self._row(c, 'BYE', to_tag, '', '', '200', None, tm)
+
+    # acc sometimes has the same transaction twice (different id)
+    def _dupes(self, rows):
+
+        for r in list(rows):
+            if self.rnd.random() < self.dupes:
+                d = dict(r)
+                d['id'] = long(self.nextid)
+                self.nextid += 1
+                rows.append(d)
+
+        return rows
+
+
+def _cumulative(weights):
+
+    total = 0
+    cum = []
+    for (k, w) in sorted(weights.items()):
+        total += w
+        cum.append((total, k))
+
+    return (total, cum)
+
+def _pick(rnd, cumulative):
+
+    (total, cum) = cumulative
+    x = rnd.random() * total
+    for (w, k) in cum:
+        if x < w:
+            return k
+    return cum[-1][1]
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+# {{{ benchmark
+
+
+# write a NanpaDB index with every NPA-NXX of AccGen.NPAS (state from NPAS, made-up LATAs and OCNs) to path
+def writeNanpaIndex(path):
+
+    nxxs = {}
+    for (i, (npa, state)) in enumerate(sorted(AccGen.NPAS.items())):
+        for nxx in range(1000):
+            nxxs[int(npa) * 1000 + nxx] = {'state': state, 'lata': str(600 + i), 'ocn': '%04d' % (nxx % 37 * 100 + i)}
+
+    NanpaDB.writeIndex(path, nxxs, {})
+
+
+# process ncalls synthetic calls, feeding process_cdrs_iter feed calls at a time (generating the rows isn't timed).
+# nanpa: NanpaDB index file to load first (see writeNanpaIndex).  Returns a dict of results; run it in a fresh
+# process (see bench) for a meaningful peak RSS.
+def runBench(ncalls, feed=20000, seed=1, nanpa=None):
+
+    nccdr.TESTMODE = True
+    netcall.NetcallDB.TESTMODE = True
+
+    if nanpa:
+        NanpaDB.load(nanpa)
+
+    gen = AccGen(seed)
+
+    elapsed = 0.0
+    nrows = 0
+    ncomplete = 0
+
+    for i in range(0, ncalls, feed):
+
+        (rows, callids) = gen.batch(min(feed, ncalls-i))
+        nrows += len(rows)
+        nccdr.set_test_data(rows)
+
+        t = time.time()
+        for call in nccdr.process_cdrs_iter(callids):
+            if call.isComplete():
+                ncomplete += 1
+        elapsed += time.time() - t
+
+    nccdr.set_test_data([])
+
+    return {
+        'calls':     ncalls,
+        'rows':      nrows,
+        'complete':  ncomplete,
+        'seconds':   round(elapsed, 2),
+        'calls/sec': int(ncalls / max(elapsed, 1e-6)),
+        'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _runBench(args):
+    return runBench(*args)
+
+
+# each size in its own process
+def bench(sizes, feed=20000, seed=1):
+
+    results = []
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nanpa = os.path.join(tmpdir, 'nanpa.db')
+        writeNanpaIndex(nanpa)
+
+        for n in sizes:
+            pool = multiprocessing.Pool(1)
+            try:
+                results.append(pool.apply(_runBench, ((n, feed, seed, nanpa),)))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+## {{{ py.test tests
+
+
+def setup_module(m):
+
+    nccdr.TESTMODE = True
+    netcall.NetcallDB.TESTMODE = True
+
+    path = os.path.join(tempfile.mkdtemp(), 'nanpa.db')
+    writeNanpaIndex(path)
+    NanpaDB.load(path)
+
+
+def test_accgen():
+
+    gen = AccGen(seed=7, dupes=0.05)
+    (rows, callids) = gen.batch(300)
+
+    assert len(callids) == 300
+    assert len(set(r['id'] for r in rows)) == len(rows)
+    assert set(gen.scenarios.values()) == set(AccGen.SCENARIOS)
+
+    nccdr.set_test_data(rows)
+    calls = dict((c.callid, c) for c in nccdr.process_cdrs_iter(callids))
+    nccdr.set_test_data([])
+
+    assert len(calls) == 300
+
+    for (cid, sc) in gen.scenarios.items():
+
+        call = calls[cid]
+
+        if sc in ('incomplete', 'straybye'):
+            assert call.isIncomplete()
+            continue
+
+        assert call.isComplete()
+        fcdr = call.getFCdr()
+
+        if sc in ('answered', 'reinvite'):
+            assert fcdr.last_rc == 200 and fcdr.status == 'OK'
+            assert fcdr.b_state == AccGen.NPAS[fcdr.b_lrn[1:4]]
+            assert fcdr.s_connected >= 1
+        elif sc == 'noroute':
+            assert fcdr.last_rc == 480 and fcdr.t_branch_idx == 99
+        else:
+            assert fcdr.last_rc >= 400
+
+    # same seed, same rows
+    assert AccGen(seed=7).batch(10) == AccGen(seed=7).batch(10)
+
+
+def test_runbench():
+
+    r = runBench(200, feed=50)
+    assert r['calls'] == 200
+    assert 0 < r['complete'] < 200
+
+## }}}
+###############################################################################
+
+
+def cmdHelp(e=None):
+    if e:
+        print '***'
+        print ' error=',e
+        print '***'
+
+    print ''
+    print 'usage:'
+    print ' -h | --help'
+    print " --calls   comma separated benchmark sizes (default 10000,100000,1000000)"
+    print " --feed    calls loaded into the test data per process_cdrs_iter call (default 20000)"
+    print " --seed    random seed (default 1)"
+    sys.exit(-1)
+
+
+if __name__ == '__main__':
+
+    log.getLogger().setLevel(log.ERROR)
+
+    p_sizes = [10000, 100000, 1000000]
+    p_feed = 20000
+    p_seed = 1
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['calls=', 'feed=', 'seed=', 'help'])
+
+        for opt, arg in opts:
+
+            if opt=='--calls':
+                p_sizes = [int(n) for n in arg.split(',')]
+            if opt=='--feed':
+                p_feed = int(arg)
+            if opt=='--seed':
+                p_seed = int(arg)
+
+            if opt=='--help' or opt=='-h':
+                cmdHelp()
+
+    except (getopt.GetoptError, ValueError) as e:
+        cmdHelp(e)
+
+    print '%10s %10s %10s %10s %10s %10s' % ('calls', 'rows', 'complete', 'seconds', 'calls/sec', 'maxrss_mb')
+
+    for r in bench(p_sizes, p_feed, p_seed):
+        print '%10d %10d %10d %10.2f %10d %10d' % (r['calls'], r['rows'], r['complete'], r['seconds'], r['calls/sec'],
+                                                   r['maxrss_mb'])
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+
+# Backfill: (re)process a large date range of acc data into netcall.calls, e.g. after a pricing or NANPA fix.
+#
+# The range is split into chunks that are processed concurrently by a bounded pool of worker processes, each
+# chunk the same way a cron run of nccdr.py does it (getCallIds, process_cdrs, writeCallRecords).  Completed
+# chunks are appended to a ledger file, so after a crash (or ^C) the same command picks up where it stopped.
+#
+#   python backfill.py --dfrom 2013-11-01 --dto 2013-12-01 [--chunk 60] [--workers 4] [--ledger FILE]
+#
+# Note: acc rows are loaded per Call-Id, so a call whose transactions straddle a chunk boundary is found (and
+# processed) by both chunks.  Only the chunk its first transaction falls in writes it, so two workers never race
+# to write the same call.
+#
+# test with py.test
+
+
+
+import sys, os, time, getopt, json
+import logging as log
+import multiprocessing
+from datetime import datetime
+from datetime import timedelta
+
+import netcall, nccdr
+
+
+
+# default chunk length (minutes), worker count and ledger file
+CHUNK_MINUTES = 60
+WORKERS = 4
+LEDGER = 'backfill.ledger'
+
+
+
+###############################################################################
+# {{{ chunks and ledger
+
+
+# split [dfrom, dto) into consecutive chunks of at most `minutes`
+def makeChunks(dfrom, dto, minutes):
+
+    chunks = []
+    step = timedelta(minutes=minutes)
+
+    a = dfrom
+    while a < dto:
+        b = min(a + step, dto)
+        chunks.append((a, b))
+        a = b
+
+    return chunks
+
+
+# the (dfrom, dto) chunks already done, from the ledger file (one json record per completed chunk)
+def readLedger(path):
+
+    done = set()
+
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    done.add((rec['dfrom'], rec['dto']))
+                except ValueError:
+                    log.warning('ignoring bad ledger line: %s', line.strip())  # e.g. torn last line after a crash
+
+    except IOError:
+        pass
+
+    return done
+
+
+def appendLedger(path, rec):
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(rec, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _key(chunk):
+    return (str(chunk[0]), str(chunk[1]))
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+# {{{ workers
+
+
+# process one chunk: returns (chunk, counts, seconds).  owner: (lo, hi) range of call start times this chunk
+# writes (the chunk itself, open ended for the first and last chunk)
+def runChunk(chunk, owner, src_id=None, discovery=None):
+
+    t1 = time.time()
+
+    db = netcall.NetcallDB()
+
+    callids = db.getCallIds(chunk[0], chunk[1], src_id, None, discovery)
+
+    (lo, hi) = owner
+    def accept(call):
+        ts = call.getEarliestTimestamp()
+        return ts is not None and (lo is None or ts >= lo) and (hi is None or ts < hi)
+
+    counts = nccdr.record_calls(callids, db, accept=accept)
+    counts['callids'] = len(callids)
+
+    return (chunk, counts, time.time() - t1)
+
+
+def _runChunk(args):
+    return runChunk(*args)
+
+
+# chunks: the full list (ownership depends on position); done: keys of chunks to skip.
+# Yields (chunk, counts, seconds) as chunks complete, in completion order.
+def runChunks(chunks, done, nworkers, src_id=None, discovery=None):
+
+    work = []
+    for (i, chunk) in enumerate(chunks):
+        if _key(chunk) in done:
+            continue
+        lo = chunk[0] if i > 0 else None
+        hi = chunk[1] if i < len(chunks)-1 else None
+        work.append((chunk, (lo, hi), src_id, discovery))
+
+    if nworkers <= 1:
+        for w in work:
+            yield runChunk(*w)
+        return
+
+    pool = multiprocessing.Pool(nworkers, nccdr._initWorker)
+
+    try:
+        for r in pool.imap_unordered(_runChunk, work):
+            yield r
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+
+# }}}
+###############################################################################
+
+
+def backfill(dfrom, dto, minutes, nworkers, ledger, src_id=None, discovery=None):
+
+    chunks = makeChunks(dfrom, dto, minutes)
+    done = readLedger(ledger) & set(_key(c) for c in chunks)
+
+    ntodo = len(chunks) - len(done)
+    log.info('%d chunks of %d minutes, %d already done, %d to go', len(chunks), minutes, len(done), ntodo)
+
+    t0 = time.time()
+    ndone = 0
+    ncalls = 0
+    nerrors = 0
+
+    for (chunk, counts, secs) in runChunks(chunks, done, nworkers, src_id, discovery):
+
+        ndone += 1
+        ncalls += counts['complete'] + counts['incomplete']
+
+        # a chunk with write errors isn't done: it'll be retried next time
+        if counts['errors']:
+            nerrors += 1
+            log.error('%s - %s: %d calls could not be recorded', chunk[0], chunk[1], counts['errors'])
+        else:
+            rec = {'dfrom': str(chunk[0]), 'dto': str(chunk[1]), 'seconds': round(secs, 1), 'ts': int(time.time())}
+            rec.update(counts)
+            appendLedger(ledger, rec)
+
+        elapsed = time.time() - t0
+        eta = elapsed / ndone * (ntodo - ndone)
+
+        log.info('%s - %s: %d written, %d unchanged, %d incomplete in %.1fs  [%d/%d chunks, %.0f calls/s, ETA %s]',
+                 chunk[0], chunk[1], counts['written'], counts['unchanged'], counts['incomplete'], secs, ndone, ntodo,
+                 ncalls / max(elapsed, 0.001), timedelta(seconds=int(eta)))
+
+    return nerrors
+
+
+
+###############################################################################
+## {{{ py.test tests
+
+
+def test_chunks():
+
+    d = datetime(2013, 11, 1)
+    chunks = makeChunks(d, d + timedelta(minutes=150), 60)
+
+    assert len(chunks) == 3
+    assert chunks[0] == (d, d + timedelta(minutes=60))
+    assert chunks[-1] == (d + timedelta(minutes=120), d + timedelta(minutes=150))
+
+    assert makeChunks(d, d, 60) == []
+
+
+def test_ledger(tmpdir):
+
+    path = str(tmpdir.join('ledger'))
+    d = datetime(2013, 11, 1)
+    chunks = makeChunks(d, d + timedelta(hours=3), 60)
+
+    assert readLedger(path) == set()
+
+    appendLedger(path, {'dfrom': str(chunks[1][0]), 'dto': str(chunks[1][1]), 'written': 3})
+    with open(path, 'a') as f:
+        f.write('{"dfrom": "2013-11-01 02:00:00", "dt')  # crashed mid-write
+
+    assert readLedger(path) == set([_key(chunks[1])])
+
+## }}}
+###############################################################################
+
+
+def cmdHelp(e=None):
+    if e:
+        print '***'
+        print ' error=',e
+        print '***'
+
+    print ''
+    print 'usage:'
+    print ' -h | --help'
+    print ' -v | --verbose'
+    print " --dfrom   start of the range to (re)process"
+    print " --dto     end of the range"
+    print " --chunk   chunk length in minutes (default %d)" % (CHUNK_MINUTES)
+    print " --workers number of chunks processed at a time (default %d)" % (WORKERS)
+    print " --ledger  file recording completed chunks (default %s)" % (LEDGER)
+    print " --src_id  limit calls processed to this source (inbound customer) id"
+    print " --discovery  Call-Id discovery mode (see nccdr.py)"
+    sys.exit(-1)
+
+
+if __name__ == '__main__':
+
+    rl = log.getLogger()
+    rl.setLevel(log.INFO)
+
+    p_dfrom = None
+    p_dto = None
+    p_chunk = CHUNK_MINUTES
+    p_workers = WORKERS
+    p_ledger = LEDGER
+    p_src_id = None
+    p_discovery = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hv', ['dfrom=', 'dto=', 'chunk=', 'workers=', 'ledger=', 'src_id=',
+                                                        'discovery=', 'help', 'verbose'])
+
+        for opt, arg in opts:
+
+            if opt=='--dfrom':
+                p_dfrom = nccdr.parseDate(arg)
+            if opt=='--dto':
+                p_dto = nccdr.parseDate(arg)
+
+            if opt=='--chunk':
+                p_chunk = int(arg)
+            if opt=='--workers':
+                p_workers = int(arg)
+            if opt=='--ledger':
+                p_ledger = arg
+
+            if opt=='--src_id':
+                p_src_id = arg
+            if opt=='--discovery':
+                p_discovery = arg
+
+            if opt=='--help' or opt=='-h':
+                cmdHelp()
+
+            if opt=='--verbose' or opt=='-v':
+                rl.setLevel(log.DEBUG)
+
+        if not p_dfrom or not p_dto:
+            raise ValueError('--dfrom and --dto are required')
+        if p_chunk < 1 or p_workers < 1:
+            raise ValueError('--chunk and --workers must be at least 1')
+
+    except (getopt.GetoptError, ValueError) as e:
+        cmdHelp(e)
+
+    if not nccdr.openNanpaDB():
+        sys.exit(1)
+
+    if backfill(p_dfrom, p_dto, p_chunk, p_workers, p_ledger, p_src_id, p_discovery):
+        sys.exit(1)
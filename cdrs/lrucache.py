@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# LRUCache: bounded memoization for lookups that repeat a lot within a run (number classification, ...)
+#
+# test with py.test
+
+
+
+###############################################################################
+# {{{ class LRUCache
+
+class LRUCache(object):
+    'dict with a maximum size, evicting the least recently used entry; counts hits and misses'
+
+    # entries are kept in a circular doubly linked list, least recently used first: each link is
+    # [prev, next, key, value] and self.d maps key -> link.  (OrderedDict is pure python in 2.7 and
+    # costs a few us per hit, which is as much as some of the lookups it's caching.)
+
+    def __init__(self, maxsize):
+
+        assert(maxsize > 0)
+
+        self.maxsize = maxsize
+        self.d = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+        self.hits = 0
+        self.misses = 0
+
+
+    # cached value for key, or func(key) (which is then cached).  None results are cached too.
+    def lookup(self, key, func):
+
+        link = self.d.get(key)
+
+        if link is not None:
+            self.hits += 1
+            self._touch(link)
+            return link[3]
+
+        self.misses += 1
+        v = func(key)
+        self._add(key, v)
+
+        return v
+
+    # lookup() for a list of keys: func gets the list of distinct keys that aren't cached and returns their values
+    # (in the same order).  Returns the values for keys, hits and misses counted as if looked up one at a time.
+    def lookupMany(self, keys, func):
+
+        vals = {}
+        todo = []
+
+        for key in keys:
+            if key in vals:
+                self.hits += 1
+                continue
+            link = self.d.get(key)
+            if link is not None:
+                self.hits += 1
+                self._touch(link)
+                vals[key] = link[3]
+            else:
+                self.misses += 1
+                vals[key] = None
+                todo.append(key)
+
+        if todo:
+            for (key, v) in zip(todo, func(todo)):
+                vals[key] = v
+                self._add(key, v)
+
+        return [vals[key] for key in keys]
+
+
+    # move link to the most recently used end
+    def _touch(self, link):
+
+        (prev, next) = (link[0], link[1])
+        prev[1] = next
+        next[0] = prev
+
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+
+    def _add(self, key, v):
+
+        root = self.root
+
+        if len(self.d) >= self.maxsize:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.d[oldest[2]]
+
+        last = root[0]
+        link = [last, root, key, v]
+        last[1] = root[0] = self.d[key] = link
+
+
+    def clear(self):
+        self.d.clear()
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.d), 'maxsize': self.maxsize}
+
+
+    def __len__(self):
+        return len(self.d)
+
+    def __contains__(self, key):
+        return key in self.d
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+## {{{ py.test tests
+
+
+def test_lru():
+
+    calls = []
+    def f(k):
+        calls.append(k)
+        return k * 2
+
+    c = LRUCache(2)
+
+    assert c.lookup(1, f) == 2
+    assert c.lookup(2, f) == 4
+    assert c.lookup(1, f) == 2    # 1 is now the most recently used
+    assert c.lookup(3, f) == 6    # evicts 2
+    assert 2 not in c and 1 in c and 3 in c
+    assert c.lookup(2, f) == 4
+
+    assert calls == [1, 2, 3, 2]
+    assert c.stats() == {'hits': 1, 'misses': 4, 'size': 2, 'maxsize': 2}
+
+    c.lookup(None, lambda k: None)
+    assert None in c
+
+    batches = []
+    def fm(ks):
+        batches.append(ks)
+        return [k * 2 for k in ks]
+
+    c = LRUCache(3)
+    c.lookup(1, f)
+    assert c.lookupMany([1, 4, 5, 4], fm) == [2, 8, 10, 8]
+    assert batches == [[4, 5]]
+    assert 1 in c and 4 in c and 5 in c
+    assert c.stats() == {'hits': 2, 'misses': 3, 'size': 3, 'maxsize': 3}
+    assert c.lookupMany([], fm) == [] and len(batches) == 1
+
+## }}}
+###############################################################################
@@ -5,7 +5,8 @@
 # Core Cdr/Call classes and processing: creates cdr records from opensips.acc transactions; this program
 # simulates a dialog state machine to make proper cdrs from this transaction data.
 #
-# Also includes script code to run from cron to periodically create new netcall.calls records from acc data.
+# Also includes script code to run from cron to periodically create new netcall.calls records from acc data, or
+# (--daemon) to run continuously and record calls as their acc rows come in.
 #
 # * in order for this program to function correctly, the 'acc' opensips table must be capturing all data (at
 #    present there are bugs and some problem calls are going partially unrecorded).
@@ -20,25 +21,47 @@
 
 
 
-import sys, time, os, getopt, re
+import sys, time, os, getopt, re, calendar, zlib, json, hashlib
+import multiprocessing, threading, Queue
 from datetime import datetime
 from datetime import timedelta
 from collections import Counter
+from itertools import groupby
 import logging as log
 
-import NanpaDB, netcall, PhoneNumber
+import NanpaDB, netcall, PhoneNumber, runstats
+from runstats import stats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # no CdrBatch; Cdrs are finalized one at a time
 
 TESTMODE = False
 
+# number of calls finalized together (CdrBatch) by process_cdrs_iter
+BATCHSIZE = 500
+
+# daemon mode (--daemon) defaults
+DAEMON_WATERMARK = '/var/tmp/nccdr.watermark'
+DAEMON_INTERVAL = 5
+
+# checkpoints of incomplete calls (see CheckpointStore) expire after this many seconds
+CHECKPOINT_TTL = 2*86400
+CHECKPOINT_VERSION = 2  # bump when Call/Cdr snapshot() changes; older checkpoints are ignored
+
 test_rdata = []
 
 
+
 ################################################################################
 ## {{{ support routines
 
 
-# load & preprocess raw acc table data
-def _loadTxRows(callids):
+# load & preprocess raw acc table data: yields (callid, [Tx, ...]) for each Call-Id that has acc rows, with the rows
+# already in dialog state machine order (prtime, time, id) -- the database does the sorting.
+# afterids: dict of Call-Id -> acc.id, load only the rows after that id for those Call-Ids (see iterTxRows)
+def _loadTxRows(callids, chunksize=None, afterids=None, since=None, stream=True):
 
     # make sure there are no duplicates
     s1 = set(callids)
@@ -48,33 +71,129 @@ def _loadTxRows(callids):
 
     if not TESTMODE:
 
-        rdata = netcall.NetcallDB().getTxRows(callids)
+        rdata = (_prepTxRow(r) for r in netcall.NetcallDB().iterTxRows(callids, chunksize, afterids, since, stream))
 
     else:
-        rdata = test_rdata
+        rdata = [_prepTxRow(r) for r in test_rdata if r['callid'] in s1
+                 and (not afterids or r['id'] > afterids.get(r['callid'], -1))
+                 and (since is None or (afterids and r['callid'] in afterids) or r['time'] >= since)]
+        rdata.sort(key=lambda t: (t.callid, t.prtime, t.time, t.id))
+
+
+    for (cid, rows) in groupby(rdata, key=lambda t: t.callid):
+
+        yield (cid, list(rows))
+
+
+# convert a raw acc row (dict) into a Tx.  some preprocessing steps here: opensips accounting (acc) is just messy
+# and complicated.
+def _prepTxRow(r):
+
+    # we'll be sorting on prtime later, so much sure there is a good value (acc leaves prtime empty for some transactions,
+    # but if that's the case then use time field.
+    # Note: 'prtime' is the timestamp for when request was sent, 'time' is timestamp of response.
+    prtime = r['prtime']
+    if prtime == None or prtime == '0000-00-00 00:00:00' or prtime == '':
+        prtime = r['time']
+
+    rc = _str2int(r['sip_code'], 0)
+    bid = _str2int(r['t_branch_idx'], None)
+    dst_id = r['dst_id']
+
+    # special case we want to flag: no routes available, there will be no to_tag in final invite reply and response==480
+    # (XXX make sure you don't change the 480! TODO test this and make sure to differentiate between local no-routes-available-in-our-routing-table
+    # vs we tried all our lcr routes and all failed)
+    if (r['to_tag'] == None or r['to_tag'] == '') and rc == 480:
+        bid = 99
+        dst_id = None
+
+    eprtime = _dt2e(prtime)
+    etime = _dt2e(r['time'])
+
+    # digest over the whole (preprocessed) row minus the auto increment id, to spot duplicate acc rows
+    h = dict(r)
+    del(h['id'])
+    h['prtime'] = eprtime
+    h['time'] = etime
+    h['t_branch_idx'] = bid
+    h['dst_id'] = dst_id
+    txhash = _txDigest(h)
+
+    return Tx(r['id'], r['callid'], r['method'], r['from_tag'], r['to_tag'], rc, eprtime, etime, bid,
+              r.get('src_id'), dst_id, r.get('caller_id'), r.get('callee_id'), r.get('callee_lrn'), r.get('ruleid'),
+              r.get('cp_node'), txhash)
 
 
-    rl = []
-    for r in rdata:
+# first 8 bytes of an md5 over an acc row's fields (sorted by name), as an integer.  Not hash(): the digests of the
+# rows a call has seen are kept in its checkpoint (Call.txseen), which processes on other hosts and other Pythons
+# (PYTHONHASHSEED, 32/64 bit) resume from.
+def _txDigest(h):
 
-        # some preprocessing steps here: opensips accounting (acc) is just messy and complicated.
+    parts = []
+    for k in sorted(h):
+        v = h[k]
+        t = type(v)
+        if t is not str:
+            v = '\x00' if v is None else v.encode('utf8') if t is unicode else str(v)
+        parts.append(k)
+        parts.append(v)
 
-        # we'll be sorting on prtime later, so much sure there is a good value (acc leaves prtime empty for some transactions,
-        # but if that's the case then use time field.
-        # Note: 'prtime' is the timestamp for when request was sent, 'time' is timestamp of response.
-        if r['prtime'] == None or r['prtime'] == '0000-00-00 00:00:00' or r['prtime'] == '':
-            r['prtime'] = r['time']
+    return int(hashlib.md5('\x1f'.join(parts)).hexdigest()[:16], 16)
 
-        # special case we want to flag: no routes available, there will be no to_tag in final invite reply and response==480
-        # (XXX make sure you don't change the 480! TODO test this and make sure to differentiate between local no-routes-available-in-our-routing-table
-        # vs we tried all our lcr routes and all failed)
-        if (r['to_tag'] == None or r['to_tag'] == '') and int(r['sip_code']) == 480:
-            r['t_branch_idx'] = 99
-            r['dst_id'] = None
 
-        rl.append(r)
+def _str2int(v, default):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
+
+
+# open the NanpaDB index (NanpaDB.DBFILE), before recording anything: without it every domestic number would get no
+# state or LATA, and the calls would be written as intrastate/unknown jurisdiction and priced that way, so a missing
+# or bad index stops the run instead of being logged per lookup.  Returns False (and logs why) if it can't be opened.
+def openNanpaDB():
+    try:
+        NanpaDB.load()
+    except (IOError, ValueError) as e:
+        log.error("can't open the NanpaDB index %s: %s", NanpaDB.DBFILE, e)
+        return False
+    return True
+
+
+# classify a phone number (anum, b_lrn) for jurisdiction info: returns (iso country code, jurisdiction type
+# 'D'/'I'/'U', state, lata, ocn), the last 3 from NanpaDB for domestic numbers (else None).  The same caller-ids
+# and LRNs show up over and over: PhoneNumber.parse() keeps its results in an LRU cache (PhoneNumber.cacheStats()
+# for hits/misses), and NanpaDB is an mmap'ed index lookup, so there's no cache of our own on top.
+def classifyNumber(num):
+    return _classify(PhoneNumber.parse(num))
+
+# classifyNumber for a list of numbers: the ones not in the cache are parsed together (PhoneNumber.parse_many)
+def classifyNumbers(nums):
+    return [_classify(p) for p in PhoneNumber.parse_many(nums)]
+
+def _classify(p):
 
-    return rl
+    # note: isUSdomesticNumber is lax compared to num2codes ... TODO implement logic to decide when to use
+    # lax or strict parsing rules -- like in a Carrier subclass, since different carriers may have different
+    # policies or can assume certain countries/defaults when numbers are ambiguous
+    jtype = p.jtype
+
+    if jtype == 'D':
+        ni = NanpaDB.getNumberInfo(p.num)
+        if ni:
+            return (p.country, jtype, ni['state'], ni['lata'], ni['ocn'])
+
+    return (p.country, jtype, None, None, None)
+
+
+# datetime (acc/calls tables have second resolution, no timezone) <-> integer epoch seconds
+def _dt2e(dt):
+    if dt is None: return None
+    return calendar.timegm(dt.timetuple())
+
+def _e2dt(e):
+    if e is None: return None
+    return datetime.utcfromtimestamp(e)
 
 
 
@@ -114,6 +233,144 @@ def resp2message(rc):
 ################################################################################
 
 
+################################################################################
+# {{{ dialog state machine: transition table used by Cdr.apply_tx
+#
+# dialog states: 0=? 1=early 2=confirmed 3=terminated, -1=incomplete
+#
+# Each tx is classified once (Tx.txclass, from method and response class) and a branch advances with one lookup,
+# DIALOG_TABLE[d_state+1][txclass] -> (next state, action bits).  The table is compiled from DIALOG_RULES below;
+# a new dialog edge case should be a new rule, not another branch in apply_tx.
+
+# method classes
+M_INV, M_BYE, M_OTHER = 0, 1, 2
+# response classes: provisional (incl. 3xx, and 0 for no response), ok (2xx), error (4xx and up)
+R_PROV, R_OK, R_ERR = 0, 1, 2
+
+_METHODS = {'INVITE': M_INV, 'BYE': M_BYE}
+
+def txClass(method, rc):
+    if rc >= 400: r = R_ERR
+    elif rc >= 200 and rc < 300: r = R_OK
+    else: r = R_PROV
+    return _METHODS.get(method, M_OTHER) * 3 + r
+
+
+# actions, applied in this order
+DA_CONFIRM   = 0x01    # t_confirm = tx time
+DA_END       = 0x02    # t_end = tx time
+DA_COMPLETED = 0x04    # status = 'completed' (overridden by DA_RESULT, as it always has been)
+DA_FIELDS    = 0x08    # fill in c_from/c_to/anum/bnum/b_lrn/ruleid from the tx where not yet set
+DA_RESULT    = 0x10    # last_rc/status from the tx response code
+DA_LOG_ILLEGAL  = 0x100
+DA_LOG_BYEFAIL  = 0x200
+DA_LOG_REINVITE = 0x400
+DA_LOG_AFTEREND = 0x800
+_DA_LOG = 0xf00
+
+_DIALOG_LOGS = (
+    (DA_LOG_ILLEGAL,  log.debug,   'dialog transition to illegal state; callid=%s'),
+    (DA_LOG_BYEFAIL,  log.error,   'wtf bye failed! .. now what?; callid=%s'),
+    (DA_LOG_REINVITE, log.debug,   'reinvite? callid=%s'),
+    (DA_LOG_AFTEREND, log.warning, 'unexpected tx after terminated dialog; callid=%s'),
+)
+
+# (state, method class, response class, next state, actions); None matches any, first matching rule wins, no match
+# means stay in the same state.  DA_FIELDS and DA_RESULT are added by _compileDialogTable.
+DIALOG_RULES = (
+    (-1,   None,  None,   -1, 0),  # ignore all other data until we find the remaining pieces
+
+    (0,    M_INV, R_PROV,  1, 0),
+    (0,    M_INV, R_OK,    2, DA_CONFIRM),
+    (0,    M_INV, R_ERR,   3, DA_CONFIRM | DA_END),
+    (0,    M_BYE, None,   -1, DA_LOG_ILLEGAL),  # not expected, but OK if we are missing earlier txs from acc table
+
+    (1,    M_INV, R_OK,    2, DA_CONFIRM),
+    (1,    M_INV, R_ERR,   3, DA_CONFIRM | DA_END),
+    (1,    M_BYE, None,   -1, DA_LOG_ILLEGAL),
+
+    (2,    M_BYE, R_OK,    3, DA_END | DA_COMPLETED),
+    (2,    M_BYE, None,    2, DA_END | DA_LOG_BYEFAIL),
+    (2,    None,  None,    2, DA_LOG_REINVITE),
+
+    (3,    None,  None,    3, DA_LOG_AFTEREND),
+)
+
+def _compileDialogTable(rules):
+
+    table = []
+
+    for ds in (-1, 0, 1, 2, 3):
+        row = []
+        for m in (M_INV, M_BYE, M_OTHER):
+            for r in (R_PROV, R_OK, R_ERR):
+
+                (ds_n, act) = (ds, 0)
+                for (rs, rm, rr, rn, ra) in rules:
+                    if rs == ds and rm in (None, m) and rr in (None, r):
+                        (ds_n, act) = (rn, ra)
+                        break
+
+                if ds != -1:
+                    if ds_n > 0 and m == M_INV: act |= DA_FIELDS
+                    if ds_n == 2 or ds_n == 3:  act |= DA_RESULT
+
+                row.append((ds_n, act))
+
+        table.append(tuple(row))
+
+    return tuple(table)
+
+DIALOG_TABLE = _compileDialogTable(DIALOG_RULES)
+
+
+# }}}
+################################################################################
+
+
+################################################################################
+# {{{ Tx: one sip transaction (acc table row)
+#
+# acc rows are compacted into these as soon as they're loaded: integer sip_code & t_branch_idx (None if empty),
+# prtime/time as integer epoch seconds, and a hash over the original row for de-duplication.  Columns the
+# dialog state machine doesn't use (sip_reason, duration, ...) are dropped.
+
+class Tx(object):
+    'Tx == one sip transaction (acc table row)'
+
+    __slots__ = ('id', 'callid', 'method', 'from_tag', 'to_tag', 'sip_code', 'prtime', 'time', 't_branch_idx',
+                 'src_id', 'dst_id', 'caller_id', 'callee_id', 'callee_lrn', 'ruleid', 'cp_node', 'txhash', 'tag', 'txclass')
+
+    def __init__(self, id, callid, method, from_tag, to_tag, sip_code, prtime, time, t_branch_idx,
+                 src_id, dst_id, caller_id, callee_id, callee_lrn, ruleid, cp_node, txhash):
+
+        self.id = id
+        self.callid = callid
+        self.method = method
+        self.from_tag = from_tag
+        self.to_tag = to_tag
+        self.sip_code = sip_code
+        self.prtime = prtime
+        self.time = time
+        self.t_branch_idx = t_branch_idx
+        self.src_id = src_id
+        self.dst_id = dst_id
+        self.caller_id = caller_id
+        self.callee_id = callee_id
+        self.callee_lrn = callee_lrn
+        self.ruleid = ruleid
+        self.cp_node = cp_node
+        self.txhash = txhash
+
+        self.tag = None # branch tag, assigned when the tx is added to a Call
+
+        self.txclass = txClass(method, sip_code)  # column in the dialog transition table
+
+
+# }}}
+################################################################################
+
+
 ################################################################################
 # {{{ Call: collection of Cdrs (ie branches) with same Call-Id.
 #
@@ -138,12 +395,20 @@ class Call:
         self.cdrs = []
         self.tags2cdrs = {}
 
+        # all transactions (acc rows) for this Call-Id, in chronological order
+        self.transactions = []
+
         # branch of this call relevant for customer billing
         self.f_cdr = None
 
         # earliest timestamp (ie first invite of first transaction)
         self.t_start = None
 
+        # dispatchTransactions() state: earliest prtime, highest acc.id and tx hashes seen so far
+        self.e_start = None
+        self.lastid = 0
+        self.txseen = set()
+
     def addCdr(self, cdr):
 
         assert(cdr.callid == self.callid)
@@ -162,10 +427,55 @@ class Call:
         return tag in self.tags2cdrs
 
     def getAllTransactions(self):
-        txs = []
+        return list(self.transactions)
+
+    # feed the transactions through the dialog state machines of the branches: each tx row is de-duplicated
+    # once for the whole call and handed only to the branch it belongs to.  Cross-branch data (t_start: every
+    # branch is timed from the earliest transaction of the call) is collected along the way.
+    # Can be called again after adding more transactions (or on a Call resumed from a snapshot): only the new ones
+    # are applied.
+    def dispatchTransactions(self):
+
+        e_start = self.e_start
+        seen = self.txseen
+
+        for t in self.transactions:
+
+            if e_start is None or t.prtime < e_start: e_start = t.prtime
+            if t.id > self.lastid: self.lastid = t.id
+
+            if t.txhash in seen:
+                continue
+            seen.add(t.txhash)
+
+            self.tags2cdrs[t.tag].apply_tx(t)
+
+        self.e_start = e_start
+        t_start = _e2dt(e_start)
         for cdr in self.cdrs:
-            txs.extend(cdr.transactions)
-        return txs
+            cdr.e_start = e_start
+            cdr.t_start = t_start
+
+    # dialog state of the call (after dispatchTransactions, but before finalize) as plain data for a CheckpointStore.
+    # Doesn't include the transactions themselves: a restored call only needs the acc rows after lastid.
+    def snapshot(self):
+
+        return {'v': CHECKPOINT_VERSION, 'lastid': self.lastid, 'e_start': self.e_start, 'txseen': list(self.txseen),
+                'cdrs': [cdr.snapshot() for cdr in self.cdrs]}
+
+    # restore an empty Call to the state in a snapshot(); continue with _addTxRow and dispatchTransactions
+    def restore(self, snap):
+
+        assert(not self.cdrs)
+
+        self.lastid = snap['lastid']
+        self.e_start = snap['e_start']
+        self.txseen = set(snap['txseen'])
+
+        for cs in snap['cdrs']:
+            cdr = Cdr(self.callid, None)
+            cdr.restore(cs)
+            self.addCdr(cdr)
 
     # warning: most methods below this one are invalid before finalize() is called
     def finalize(self):
@@ -246,6 +556,9 @@ class Call:
 class Cdr:
     'Cdr == one branch of serial-forking route attempts'
 
+    # dialog state machine fields, in Cdr.snapshot() order (everything else is computed by finalize)
+    SNAPFIELDS = ('tag', 'd_state', 'e_confirm', 'e_end', 't_branch_idx', 'cp_node', 'status', 'last_rc',
+                  'c_from', 'c_to', 'anum', 'bnum', 'b_lrn', 'ruleid')
 
     def __init__(self, callid, tag):
 
@@ -254,11 +567,15 @@ class Cdr:
         self.callid = callid
         self.tag = tag # to-tag (or maybe from-tag from a BYE) to identify branch
 
-        # t_* fields are datetime objects (with second resolution, thanks to opensips/mysql recording)
+        # t_* fields are datetime objects (with second resolution, thanks to opensips/mysql recording);
+        # e_* are the same times as integer epoch seconds (see _dt2e), as kept by the dialog state machine
 
         self.t_start = None       # time of first invite
         self.t_confirm = None     # time of final reply for that invite (confirmation or end of dialog)
         self.t_end = None         # time of dialog end (bye message or same as t_confirm if dialog was never confirmed)
+        self.e_start = None
+        self.e_confirm = None
+        self.e_end = None
         self.s_setup = None       # seconds spent in call setup (calculated as t_confirm - t_start)
         self.s_connected = None   # seconds spent in confirmed dialog state (calculated as t_end - t_confirmed)
         self.s_total = None       # total seconds (calculated as t_end - t_start)
@@ -291,7 +608,7 @@ class Cdr:
         # identifies the branch; highest value should be last branch tried and relevant for the caller for final response
         self.t_branch_idx = 0
 
-        # rows from acc table
+        # Tx objects (rows from acc table)
         self.transactions = []
 
         # hash over tx rows, to avoid duplicates
@@ -311,123 +628,111 @@ class Cdr:
     # advance dialog state per SIP rules, populate cdr fields
     # pass in tx rows one at a time, and in chronological order; pass in all tx rows for the same call-id, even though it may
     # have a to_tag for another branch (we want to see all branches so we can extract data)
+    # (Call.dispatchTransactions does the same thing for all branches of a call in a single pass)
     def process_tx(self, t):
 
         # check if any transaction is earlier than t_start
-        if not self.t_start or t['prtime'] < self.t_start: self.t_start = t['prtime']
+        if self.e_start is None or t.prtime < self.e_start:
+            self.e_start = t.prtime
+            self.t_start = _e2dt(t.prtime)
 
-        # avoid duplicates: calculate hash over tx row
-        t_ = t.copy()
-        del(t_['id'])
-        t_hash = hash(frozenset(t_.items()))
-        if t_hash in self.txhash:
+        # avoid duplicates: hash over tx row
+        if t.txhash in self.txhash:
             #log.debug('- skipping dupe')
             return
-        else: self.txhash[t_hash] = 1
+        else: self.txhash[t.txhash] = 1
 
 
-        my_branch = t['tag'] == self.tag
+        my_branch = t.tag == self.tag
         if not my_branch: return
 
-        if t['t_branch_idx']:
-            self.t_branch_idx = int(t['t_branch_idx'])
-
-        if t['cp_node']:
-            if not self.cp_node or self.cp_node[-1] != t['cp_node']:
-                self.cp_node.append(t['cp_node'])
+        self.apply_tx(t)
 
-        mINV = t['method']=='INVITE'
-        mBYE = t['method']=='BYE'
-        rc = int(t['sip_code'])
-        rc_provisional = (rc >= 300 and rc < 400) or rc < 200
-        rc_ok = rc >= 200 and rc < 300
-        rc_error = rc >= 400
-        rc_final = rc_ok or rc_error
 
-        #print 'debug: cs=',self.d_state,'  method=',t['method'],'  rc=',rc
+    # advance dialog state per SIP rules with a (de-duplicated) tx row that belongs to this branch
+    def apply_tx(self, t):
 
-        # dialog state logic: 0=? 1=early 2=confirmed 3=terminated, -1=incomplete
+        if t.t_branch_idx is not None:
+            self.t_branch_idx = t.t_branch_idx
 
-        ds = self.d_state  # current state
-        ds_n = ds # next state
+        if t.cp_node:
+            if not self.cp_node or self.cp_node[-1] != t.cp_node:
+                self.cp_node.append(t.cp_node)
 
-        if ds==-1: return  # ignore all other data until we find the remaining pieces (or maybe better to try our best with recording fields)
+        (ds_n, act) = DIALOG_TABLE[self.d_state + 1][t.txclass]
 
-        if ds==0:
+        if act:
 
-            if mINV and rc_provisional: ds_n = 1
+            if act & _DA_LOG:
+                for (bit, level, msg) in _DIALOG_LOGS:
+                    if act & bit: level(msg, self.callid)
 
-            elif mINV and rc_ok:
-                self.t_confirm = t['time']
-                ds_n = 2
+            if act & DA_CONFIRM:   self._confirm(t.time)
+            if act & DA_END:       self._end(t.time)
+            if act & DA_COMPLETED: self.status = 'completed'
 
-            elif mINV and rc_final:
-                self.t_confirm = t['time']
-                self.t_end = t['time']
-                ds_n = 3
-
-            elif mBYE: # not expected, but OK if we are missing earlier txs from acc table
-                log.debug('dialog transition to illegal state; callid='+self.callid)
-                ds_n = -1
-
-
-        elif ds==1:
+            if act & DA_FIELDS:
+                if t.src_id     and not self.c_from:  self.c_from = t.src_id
+                if t.dst_id     and not self.c_to:    self.c_to   = t.dst_id
+                if t.caller_id  and not self.anum:    self.anum   = t.caller_id
+                if t.callee_id  and not self.bnum:    self.bnum   = t.callee_id
+                if t.callee_lrn and not self.b_lrn:   self.b_lrn  = t.callee_lrn
+                if t.ruleid     and not self.ruleid:  self.ruleid = t.ruleid
 
-            if mINV and rc_ok:
-                self.t_confirm = t['time']
-                ds_n = 2
-
-            elif mINV and rc_final:
-                self.t_confirm = t['time']
-                self.t_end = t['time']
-                ds_n = 3
-
-            elif mBYE: # not expected, but OK if we are missing earlier txs from acc table
-                log.debug('dialog transition to illegal state; callid=%s',self.callid)
-                ds_n = -1
+            if act & DA_RESULT:
+                self.last_rc = t.sip_code
+                self.status = resp2message(t.sip_code)
 
+        self.d_state = ds_n
 
-        elif ds==2:
+    def _confirm(self, e):
+        self.e_confirm = e
+        self.t_confirm = _e2dt(e)
 
-            if mBYE:
-                self.t_end = t['time']
-                if rc_ok:
-                    ds_n = 3
-                    self.status = 'completed'
-                else:
-                    log.error('wtf bye failed! .. now what?; callid=%s',self.callid)
+    def _end(self, e):
+        self.e_end = e
+        self.t_end = _e2dt(e)
 
-            else:
-                log.debug('reinvite? callid='+self.callid)
+    def snapshot(self):
+        return [getattr(self, f) for f in Cdr.SNAPFIELDS]
 
+    def restore(self, cs):
+        for (f, v) in zip(Cdr.SNAPFIELDS, cs):
+            setattr(self, f, v)
+        self.cp_node = list(self.cp_node)
+        self.t_confirm = _e2dt(self.e_confirm)
+        self.t_end = _e2dt(self.e_end)
 
-        elif ds==3:
 
-            log.warning('unexpected tx after terminated dialog; callid=%s',self.callid)
+    # done feeding process_tx, now we can compute the computable fields and anything else
+    # (see CdrBatch for finalizing many Cdrs at once)
+    def finalize(self):
 
-        ###
+        customer = self._finalizeFields()
 
+        if not customer:
+            return
 
-        if ds_n > 0 and mINV:
+        ## compute final times
+        if self.t_confirm and self.t_start:
+            self.s_setup = int((self.t_confirm - self.t_start).total_seconds())
 
-            if 'src_id'     in t and t['src_id']     and not self.c_from:  self.c_from = t['src_id']
-            if 'dst_id'     in t and t['dst_id']     and not self.c_to:    self.c_to   = t['dst_id']
-            if 'caller_id'  in t and t['caller_id']  and not self.anum: self.anum = t['caller_id']
-            if 'callee_id'  in t and t['callee_id']  and not self.bnum: self.bnum = t['callee_id']
-            if 'callee_lrn' in t and t['callee_lrn'] and not self.b_lrn:    self.b_lrn = t['callee_lrn']
-            if 'ruleid'     in t and t['ruleid']     and not self.ruleid:   self.ruleid = t['ruleid']
+        if self.t_confirm and self.t_end:
+            self.s_connected = int((self.t_end - self.t_confirm).total_seconds())
 
-        if ds_n==2 or ds_n==3:
-            self.last_rc = rc
-            self.status = resp2message(rc)
+        if self.t_start and self.t_end:
+            self.s_total = int((self.t_end - self.t_start).total_seconds())
 
 
-        #
-        self.d_state = ds_n
+        # given the customer object, have it compute the call_price for this call.
+        self.s_connected_r = customer.calculateRoundedBillingSeconds(self.s_connected, cdr=self)
+        (self.call_price, self.ptgroup) = customer.computeCallPrice(cdr=self)
 
 
-    # done feeding process_tx, now we can compute the computable fields and anything else
-    def finalize(self):
+    # the non-numeric part of finalize(): customer lookup, BTN substitution and jurisdiction info.
+    # returns the Customer object (None if there isn't one, in which case the Cdr can't be finalized)
+    # classify: classifyNumber, or a lookup over numbers the caller already classified (see CdrBatch)
+    def _finalizeFields(self, classify=classifyNumber):
 
         #print 'finalizing) c_from=%s c_to=%s tag=%s' % (self.c_from, self.c_to, self.tag)
 
@@ -436,28 +741,17 @@ class Cdr:
         if not customer:
             log.warning("no customer object found for c_from %s.  callid=%s", self.c_from, self.callid)
             log.warning(" --> FIX THIS so opensips always records c_from regardless")
-            return
+            return None
             #sys.exit(-1)
 
         if self.c_to: # c_to may be null if this all routes were tried and we're returning 480 to client
             terminator = netcall.getTerminatorObject(self.c_to)
 
-        ## compute final times
-        if self.t_confirm and self.t_start:
-            self.s_setup = int((self.t_confirm - self.t_start).total_seconds())
-
-        if self.t_confirm and self.t_end:
-            self.s_connected = int((self.t_end - self.t_confirm).total_seconds())
-
-        if self.t_start and self.t_end:
-            self.s_total = int((self.t_end - self.t_start).total_seconds())
-
 
-        # set anum to btn if needed
+        # set anum to btn if needed (anum neither isUSdomesticNumber nor isInterationalNumber)
         btn_used = False
         self.anum2 = self.anum
-        if (not PhoneNumber.isUSdomesticNumber(self.anum) and 
-            not PhoneNumber.isInterationalNumber(self.anum)):
+        if classify(self.anum)[1] == 'U':
 
             btn_used = True
             log.debug("will use btn for anum %s", self.anum)
@@ -480,37 +774,18 @@ class Cdr:
 
         # TODO: clarify what happens when BTN was substituted ...
         # call origination type - domestic or international?
-        ed = PhoneNumber.num2codes(self.anum2)
-        if ed:
-            self.a_country = ed[2]
-        # note: isUSdomesticNumber is lax compared to num2codes ... TODO implement logic to decide when to use
-        # lax or strict parsing rules -- like in a Carrier subclass, since different carriers may have different
-        # policies or can assume certain countries/defaults when numbers are ambiguous
-        if PhoneNumber.isUSdomesticNumber(self.anum2): self.a_jtype = 'D'
-        elif PhoneNumber.isInterationalNumber(self.anum2): self.a_jtype = 'I'
-        else: self.a_jtype = 'U'
+        (self.a_country, self.a_jtype, self.a_state, self.a_lata, self.a_ocn) = classify(self.anum2)
         if self.a_jtype == 'D' and self.a_country != 'US':
             log.warning('PhoneNumber num2codes & isUSdomesticNumber returning inconsistent result! lax parsing case? anum2=%s', self.anum2)
 
         # call destination type - domestic or international? (note: parsing bnum here less reliable than looking at lcr route used?)
-        ed = PhoneNumber.num2codes(self.b_lrn)
-        if ed:
-            self.b_country = ed[2]
-        if PhoneNumber.isUSdomesticNumber(self.b_lrn): self.b_jtype = 'D'
-        elif PhoneNumber.isInterationalNumber(self.b_lrn): self.b_jtype = 'I'
-        else: self.b_jtype = 'U'
+        (self.b_country, self.b_jtype, self.b_state, self.b_lata, self.b_ocn) = classify(self.b_lrn)
         if self.b_jtype == 'D' and self.b_country != 'US':
             log.warning('PhoneNumber num2codes & isUSdomesticNumber returning inconsistent result! lax parsing case? b_lrn=%s', self.b_lrn)
 
-
-        if self.b_jtype == 'D':
-            ni = NanpaDB.getNumberInfo(self.b_lrn)
-            if ni:
-                self.b_state = ni['state']
-                self.b_lata  = ni['lata']
-                self.b_ocn   = ni['ocn']
-
-        if self.a_jtype == 'D':
+        # state/lata/ocn always come from the original anum, even when the BTN decided the jurisdiction type
+        if self.a_jtype == 'D' and self.anum2 != self.anum:
+            (self.a_state, self.a_lata, self.a_ocn) = (None, None, None)
             ni = NanpaDB.getNumberInfo(self.anum)
             if ni:
                 self.a_state = ni['state']
@@ -529,10 +804,7 @@ class Cdr:
         elif self.a_state and self.b_state and self.a_state==self.b_state:
             self.xstate = 'intra'
 
-
-        # given the customer object, have it compute the call_price for this call.
-        self.s_connected_r = customer.calculateRoundedBillingSeconds(self.s_connected, cdr=self)
-        (self.call_price, self.ptgroup) = customer.computeCallPrice(cdr=self)
+        return customer
 
 
 
@@ -565,244 +837,1516 @@ class Cdr:
 
 
 ################################################################################
-# {{{ process_cdrs: convert transaction data in opensips.acc table into Call/Cdr objects.
-#
-# returns 2 lists of Call objects: one for complete and one for incomplete calls.
+# {{{ CdrBatch: finalize() for many Cdrs at once
 #
-# define:
-#   Cdr = one branch of a call (uniquely identified by to/from tags)
-#   Call = all branches of a call that share a unique SIP Call-Id
-#
-#   If a Call has enough Cdr branches that complete the call (ie, terminated dialog, ie
-#   final response to first invite or successful bye after connected dialog), then it
-#   is considered 'complete', otherwise 'incomplete'.
+# Cdr.finalize() does the time arithmetic, billing seconds rounding and price multiply one object at a time.
+# CdrBatch pulls those fields out of a list of Cdrs into numpy columns, computes them for the whole batch and
+# writes the results back to the Cdr objects.  Customers take part through applyBillingSpecs() and
+# applyCallPrices() (see netcall.Customer), which work on a row mask of the batch, so per-carrier rules are
+# masked column operations instead of per-Cdr method calls.  A Customer subclass that only overrides the
+# per-Cdr calculateRoundedBillingSeconds()/computeCallPrice() still works: its rows are done one at a time.
 #
-def process_cdrs(callids):
+# columns (one entry per Cdr that has a customer):
+#   e_start, e_confirm, e_end        epoch seconds; has_start, has_confirm, has_end are the not-null masks
+#   s_setup, s_connected, s_total    seconds; has_setup, has_connected, has_total masks
+#   r1, r2                           billing spec (first interval, next intervals) used for each row
+#   s_connected_r                    rounded billing seconds
+#   ruleid, bnum                     (object) from the Cdrs
+#   ptgroup, mprice, call_price      price table group, route price per minute (nan if n/a), call price
 
-    calls = {} # map of Call-Id strings to Call objects
+class CdrBatch:
+    'CdrBatch == many Cdrs finalized together as columns'
 
-    # create the Call objects immediately (added 2013/11/8), since there is a common case
-    # where the callid is in the Redis cdr:callids queue but there are not yet any rows
-    # in the acc table.
-    for cid in callids:
-        calls[cid] = Call(cid)
+    def __init__(self, cdrs):
 
-    # note: Cdr (misnamed) object represents a single branch of a call
+        self.cdrs = list(cdrs)
+        self.n = 0
 
-    for r in _loadTxRows(callids): # return rows (each is a single sip transaction) from acc table
+        self._bnum_countries = None
 
-        cid = r['callid']
-        method = r['method']
-        ttag = r['to_tag']
-        ftag = r['from_tag']
-        bid = r['t_branch_idx']
 
-        call = calls[cid]
+    def finalize(self):
 
-        #tag = ttag + str(bid)
-        tag = ttag
-        if not tag: ttag = str(bid)
+        rows = []
+        customers = []
 
-        # uniquely identify each branch: normally this will be the to tag (differs for each serially forked branch, as oppsed
-        # to the from tag that is constant for each outbound request);for the case of BYE, this could be the from tag depending on
-        # who sent it.  BUT the problem is servers along different branches may not populate the to tag in their response ... so
-        # for the purposes of identification here we concat to tag with branch id.
+        # jurisdiction info: the batch's anums and LRNs are classified together, the few BTNs one at a time
+        nums = []
+        for cdr in self.cdrs:
+            nums.append(cdr.anum)
+            nums.append(cdr.b_lrn or cdr.bnum)
 
-        if not call.hasTag(tag):
+        classes = dict(zip(nums, classifyNumbers(nums)))
 
-            if method == 'BYE' and call.hasTag(ftag + bid): tag = ftag + bid
-            else:
-                # we could have a stranded BYE before seeing other txs, but don't worry about that for now
-                call.addCdr( Cdr(cid, tag) )
+        def classify(num):
+            c = classes.get(num)
+            if c is None:
+                c = classifyNumber(num)
+            return c
 
-        cdr = call.getCdr(tag)
+        for cdr in self.cdrs:
+            customer = cdr._finalizeFields(classify)
+            if customer:
+                rows.append(cdr)
+                customers.append(customer)
 
-        r['tag'] = tag
+        self.rows = rows
+        n = self.n = len(rows)
 
-        cdr.transactions.append(r)
+        if not n: return
 
 
+        ## compute final times
 
-    # for each call, apply all transactions to all branches to Cdr objects can advance
-    # their dialog state machines
-    for call in calls.values():
+        (self.e_start, self.has_start) = _ecolumn(rows, 'e_start', 't_start')
+        (self.e_confirm, self.has_confirm) = _ecolumn(rows, 'e_confirm', 't_confirm')
+        (self.e_end, self.has_end) = _ecolumn(rows, 'e_end', 't_end')
 
-        all_txs = call.getAllTransactions()
+        self.has_setup = self.has_confirm & self.has_start
+        self.has_connected = self.has_confirm & self.has_end
+        self.has_total = self.has_start & self.has_end
 
-        # sort all transactions by prtime, then time, then id
-        def cmpt1(left, right):
-            if left['prtime'] > right['prtime']: return 1
-            if left['prtime'] < right['prtime']: return -1
-            if left['time'] > right['time']: return 1
-            if left['time'] < right['time']: return -1
-            if left['id'] > right['id']: return 1
-            if left['id'] < right['id']: return -1
-            return 0
+        self.s_setup = np.where(self.has_setup, self.e_confirm - self.e_start, 0)
+        self.s_connected = np.where(self.has_connected, self.e_end - self.e_confirm, 0)
+        self.s_total = np.where(self.has_total, self.e_end - self.e_start, 0)
 
-        all_txs.sort(cmp = cmpt1) # order important for dialog state machine logic
+        _storeColumn(rows, 's_setup', self.s_setup, self.has_setup)
+        _storeColumn(rows, 's_connected', self.s_connected, self.has_connected)
+        _storeColumn(rows, 's_total', self.s_total, self.has_total)
 
-        for cdr in call.getAllCdrs():
 
-            for t in all_txs:
-                cdr.process_tx(t)
-            #print ': tag=%s d_state=%d' % (cdr.tag, cdr.d_state)
+        self.ruleid = np.array([cdr.ruleid for cdr in rows], dtype=object)
+        self.bnum = np.array([cdr.bnum for cdr in rows], dtype=object)
 
-            if cdr.d_state > 0:
-                cdr.finalize()
-            else:
-                log.debug('not finalizing incomplete Cdr')
+        masks = []
+        for (customer, idx) in _groupByIdentity(customers):
+            mask = np.zeros(n, dtype=bool)
+            mask[idx] = True
+            masks.append((customer, mask))
 
-        call.finalize()
 
+        ## billing seconds
 
-    now = datetime.now()
-    now_1h = now - timedelta(hours=1)
-    now_2h = now - timedelta(hours=2)
+        self.r1 = np.zeros(n, dtype=np.int64)
+        self.r2 = np.zeros(n, dtype=np.int64)
 
+        perrow = np.zeros(n, dtype=bool)
 
-    # incomplete if getFCdr d_state != 3 (ie: Cdr with highest branch id hasn't transitioned to a completed/final dialog state)
-    completes = []
-    incompletes = []
+        for (customer, mask) in masks:
+            if _perCdrOverride(customer, 'calculateRoundedBillingSeconds', 'applyBillingSpecs'):
+                perrow |= mask
+            else:
+                customer.applyBillingSpecs(self, mask)
 
-    for call in calls.values():
+        self.s_connected_r = _roundBillingSeconds(self.s_connected, self.r1, self.r2, ~perrow)
 
-        if call.isIncomplete():
-            incompletes.append(call)
+        for i in np.flatnonzero(perrow):
+            cdr = rows[i]
+            self.s_connected_r[i] = customers[i].calculateRoundedBillingSeconds(cdr.s_connected, cdr=cdr)
 
-        else:
-            completes.append(call)
+        _storeColumn(rows, 's_connected_r', self.s_connected_r)
 
 
-    return [completes, incompletes]
+        ## call price
 
-# }}}
-################################################################################
+        self.ptgroup = np.zeros(n, dtype=np.int64)
+        self.mprice = np.empty(n)
+        self.mprice.fill(np.nan)
 
+        perrow = np.zeros(n, dtype=bool)
 
+        for (customer, mask) in masks:
+            if _perCdrOverride(customer, 'computeCallPrice', 'applyCallPrices'):
+                perrow |= mask
+            else:
+                customer.applyCallPrices(self, mask)
 
+        priced = (self.s_connected_r > 0) & ~np.isnan(self.mprice)
+        self.call_price = np.where(priced, self.mprice * self.s_connected_r / 60.0, 0.0)
 
-##########################################################################
-## {{{ py.test tests
+        for i in np.flatnonzero(perrow):
+            (self.call_price[i], self.ptgroup[i]) = customers[i].computeCallPrice(cdr=rows[i])
 
-def setup_module(m):
+        _storeColumn(rows, 'call_price', self.call_price)
+        _storeColumn(rows, 'ptgroup', self.ptgroup)
 
-    global TESTMODE
-    TESTMODE = True
 
-    netcall.NetcallDB.TESTMODE = True
+    # list of Cdrs for the rows in mask
+    def getCdrs(self, mask):
+        return [self.rows[i] for i in np.flatnonzero(mask)]
 
+    # split mask by the values of an (object) column: returns list of (value, submask)
+    def groupBy(self, mask, column):
 
-def set_test_data(rdata):
-    del(test_rdata[:])
-    test_rdata.extend(rdata)
+        col = getattr(self, column)
+        groups = {}
+        for i in np.flatnonzero(mask):
+            groups.setdefault(col[i], []).append(i)
 
+        l = []
+        for (v, idx) in groups.items():
+            m = np.zeros(self.n, dtype=bool)
+            m[idx] = True
+            l.append((v, m))
+        return l
 
-def test_p1():
+    # iso country code of bnum for each row (None if unknown)
+    def bnumCountries(self):
 
-    set_test_data([
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Forbidden', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '403', 'id': 10152L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid': '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'aprqngfrt-v4irvo30000c6', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 14)},
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Ringing', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '180', 'id': 10154L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid':   '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 16)},
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '200', 'id': 10158L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid':        '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 17)},
-        {'callee_lrn': '', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '', 'duration': 0L, 'sip_code': '200', 'id': 10162L, 'src_id': 'a22', 'ruleid': 0L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': '', 'method': 'BYE', 'from_tag': 'as63dfc9e2', 'callee_id': '', 'callid':                                          '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': '', 'prtime': None, 'time': datetime(2013, 6, 19, 22, 22, 23)},
-        ])
+        if self._bnum_countries is None:
+            cl = [nd[2] if nd else None for nd in PhoneNumber.num2codes_many(self.bnum)]
+            self._bnum_countries = np.array(cl, dtype=object)
 
-    (bcalls, incompletes) = process_cdrs(['44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060'])
-    assert(len(bcalls)==1)
-    assert(len(incompletes)==0)
+        return self._bnum_countries
 
-    fcdr = bcalls[0].getFCdr()
-    errs = bcalls[0].getErrCdrs()
 
-    assert(len(errs)==1)
-    ecdr = errs[0]
 
-    #print fcdr
-    #print ecdr
+# returns (int64 column of epoch seconds, not-null mask) for Cdr attribute ename (or datetime attribute tname
+# for hand built Cdrs that only have t_* fields set)
+def _ecolumn(cdrs, ename, tname):
 
-    #print fcdr.t_start
-    #print fcdr.t_confirm
-    #print fcdr.t_end
-    #print fcdr.s_setup
-    #print fcdr.s_connected
-    #print fcdr.s_total
-    assert(fcdr.s_total==9)
-    assert(fcdr.s_setup==3)
-    assert(fcdr.s_connected==6)
+    vals = []
+    for cdr in cdrs:
+        e = getattr(cdr, ename)
+        if e is None:
+            e = _dt2e(getattr(cdr, tname))
+        vals.append(e)
 
+    has = np.array([e is not None for e in vals], dtype=bool)
+    col = np.array([e if e is not None else 0 for e in vals], dtype=np.int64)
 
+    return (col, has)
 
-def test_p2():
 
-    # here we have what looks like an extraneous response, but the final 480 is actually what was sent back to our customer
-    # after no other routes were available to try.  So, 2 error branches: one branch to erl, the other to wds
-    set_test_data([
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Forbidden', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '403', 'id': 10164L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': 'aprqngfrt-jvbfii30000c6', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25)},
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Request Timeout', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '408', 'id': 10166L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-e91e', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25, 5)},
-        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Temporarily Unavailable', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '480', 'id': 10170L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': '', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25, 5)},
-        ])
+# copy column values back into Cdr attributes (None where mask is False)
+def _storeColumn(cdrs, attr, col, mask=None):
 
-    (bcalls, incompletes) = process_cdrs(['36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060'])
-    assert(len(bcalls)==1)
-    assert(len(incompletes)==0)
+    vals = col.tolist()
+    if mask is None:
+        for (cdr, v) in zip(cdrs, vals):
+            setattr(cdr, attr, v)
+    else:
+        for (cdr, v, m) in zip(cdrs, vals, mask.tolist()):
+            setattr(cdr, attr, v if m else None)
 
-    fcdr = bcalls[0].getFCdr()
-    errs = bcalls[0].getErrCdrs()
 
+# group list indexes by object identity: list of (object, [indexes])
+def _groupByIdentity(objs):
 
-    #print fcdr
+    groups = {}
+    for (i, o) in enumerate(objs):
+        groups.setdefault(id(o), (o, []))[1].append(i)
+    return groups.values()
 
-    assert(fcdr.t_branch_idx==99)
-    assert(len(errs)==2)
 
-    e0 = errs[0].t_branch_idx
-    e1 = errs[1].t_branch_idx
-    assert(e0 != e1 and ((e0==0 or e0==1) and (e1==0 or e1==1)))
+# true if the customer's class overrides the per-Cdr method but not its batch (mask) counterpart
+def _perCdrOverride(customer, method, batchmethod):
 
+    c = type(customer)
+    base = netcall.Customer
+    return (getattr(c, method).im_func is not getattr(base, method).im_func and
+            getattr(c, batchmethod).im_func is getattr(base, batchmethod).im_func)
 
-def test_nanpa():
 
-    ni = NanpaDB.getNumberInfo('+15412233333')
-    assert(ni['state'] == 'OR')
-    assert(ni['lata'] == '670')
-    ni = NanpaDB.getNumberInfo('5039433333')
-    assert(ni['state'] == 'OR')
-    assert(ni['lata'] == '672')
-    
-def test_p3():
+# column version of Customer._calculateRoundedBillingSeconds (only rows in mask are computed, the rest are 0)
+def _roundBillingSeconds(s_connected, r1, r2, mask):
 
-    set_test_data([
-        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Request Timeout', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '408', 'id': 10614L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-c5aa', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 21, 1, 29, 3), 'time': datetime(2013, 6, 21, 1, 29, 7)},
-        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Request Timeout', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '408', 'id': 10634L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-5dbb', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 21, 1, 29, 7), 'time': datetime(2013, 6, 21, 1, 29, 11)},
-        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Temporarily Unavailable', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '480', 'id': 10638L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 21, 1, 29, 7), 'time': datetime(2013, 6, 21, 1, 29, 11)},
-        ])
+    total = np.zeros(len(s_connected), dtype=np.int64)
 
-    (bcalls, incompletes) = process_cdrs(['16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060'])
-    assert(len(bcalls)==1)
-    assert(len(incompletes)==0)
+    todo = mask & (s_connected != 0)
 
-    fcdr = bcalls[0].getFCdr()
-    errs = bcalls[0].getErrCdrs()
+    # first (minimum) interval
+    first = todo & (r1 > 0) & (s_connected <= r1)
+    total[first] = r1[first]
 
-    assert(fcdr.t_branch_idx==99)
-    assert(len(errs)==2)
+    # subsequent intervals
+    todo &= ~first
+    if (todo & (r2 == 0)).any():
+        raise ZeroDivisionError('billing_spec_r2 is 0')
 
+    cr1 = todo & (r1 > 0)
+    rest = np.where(cr1, s_connected - r1, s_connected)
+    r2_ = np.where(todo, r2, 1)
 
-    assert(fcdr.last_rc==480)
-    assert(fcdr.call_price==0.0)
+    ints = rest // r2_
+    ints += (rest % r2_) != 0  # bump up to next interval
 
+    total[todo] = (ints * r2_ + np.where(cr1, r1, 0))[todo]
 
-def test_incomplete1():
+    return total
 
-    set_test_data([
-        {'callee_lrn': '', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '', 'duration': 0L, 'sip_code': '200', 'id': 10162L, 'src_id': 'a22', 'ruleid': 0L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': '', 'method': 'BYE', 'from_tag': 'as63dfc9e2', 'callee_id': '', 'callid':                                          '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': '', 'prtime': None, 'time': datetime(2013, 6, 19, 22, 22, 23)},
-        ])
 
-    callid = '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060'
-    (bcalls, incompletes) = process_cdrs([callid])
-    assert(len(bcalls)==0)
-    assert(len(incompletes)==1)
+# }}}
+################################################################################
 
-    fcdr = incompletes[0].getFCdr()
+
+################################################################################
+# {{{ process_cdrs: convert transaction data in opensips.acc table into Call/Cdr objects.
+#
+# returns 2 lists of Call objects: one for complete and one for incomplete calls.
+#
+# define:
+#   Cdr = one branch of a call (uniquely identified by to/from tags)
+#   Call = all branches of a call that share a unique SIP Call-Id
+#
+#   If a Call has enough Cdr branches that complete the call (ie, terminated dialog, ie
+#   final response to first invite or successful bye after connected dialog), then it
+#   is considered 'complete', otherwise 'incomplete'.
+#
+def process_cdrs(callids):
+
+    completes = []
+    incompletes = []
+
+    # incomplete if getFCdr d_state != 3 (ie: Cdr with highest branch id hasn't transitioned to a completed/final dialog state)
+    for call in process_cdrs_iter(callids):
+
+        if call.isIncomplete():
+            incompletes.append(call)
+
+        else:
+            completes.append(call)
+
+
+    return [completes, incompletes]
+
+
+# streaming version of process_cdrs: acc rows are streamed from the database grouped by Call-Id, and each Call
+# object is yielded as soon as its dialog state machines are done, so memory stays bounded and the caller can
+# start writing records right away.  Yields complete and incomplete calls alike (check isComplete()).
+# chunksize: number of Call-Ids per acc query (default NetcallDB.TXCHUNK)
+# store: optional CheckpointStore; calls with a checkpoint are resumed from it and only their newer acc rows are
+#        loaded, and incomplete calls are checkpointed for the next run (complete ones are dropped from the store)
+# prefetch: if > 0, load and replay acc rows in a background thread, up to this many batches ahead of finalize
+# since, horizon: see _lookback
+def process_cdrs_iter(callids, chunksize=None, store=None, prefetch=0, since=None, horizon=None):
+
+    callids = list(callids)
+
+    snaps = {}
+    if store:
+        snaps = store.load(callids)
+
+    batches = _buildBatches(callids, chunksize, snaps, since, horizon)
+    if prefetch:
+        batches = _prefetch(batches, prefetch)
+
+    for batch in batches:
+        for call in _finalizeCalls(batch, store):
+            yield call
+
+
+# _buildCalls in lists of (up to) BATCHSIZE calls, ready for _finalizeCalls
+def _buildBatches(callids, chunksize, snaps, since=None, horizon=None):
+
+    batch = []
+
+    for call in _buildCalls(callids, chunksize, snaps, since):
+
+        batch.append(call)
+
+        if len(batch) >= BATCHSIZE:
+            yield _lookback(batch, snaps, since, horizon)
+            batch = []
+
+    if batch:
+        yield _lookback(batch, snaps, since, horizon)
+
+
+# Historical lookback: with a `since`, only acc rows from then on are loaded for the Call-Ids (e.g. since = the
+# start of the date range Call-Ids were discovered in), which leaves out the start of calls that began earlier.
+# Calls of the batch that come out incomplete, with a branch in the illegal state (-1, e.g. a BYE without its
+# INVITE), or without their first branch (failed branches that ended before `since`: their err Cdrs and the call's
+# start would be lost, even though the final branch completes), are reloaded with all their acc rows back to `horizon` (None: all of them) and replayed from scratch.
+# Just those Call-Ids are queried again (on callid_idx), so long calls come out right without widening the date
+# range for every call.  Calls resumed from a checkpoint already have their history and are left alone.
+def _lookback(batch, snaps, since, horizon):
+
+    if since is None:
+        return batch
+
+    cids = [call.callid for call in batch if call.callid not in snaps and _needsLookback(call)]
+    if not cids:
+        return batch
+
+    calls = {}
+
+    with stats.timer('lookback'):
+        for (cid, rows) in _loadTxRows(cids, None, None, horizon, False):
+            calls[cid] = _replay(cid, rows)
+            stats.count('lookback_rows', len(rows))
+
+    stats.count('lookback_calls', len(cids))
+
+    return [calls.get(call.callid, call) for call in batch]
+
+
+# the call has branches and the final one (Call.finalize picks it the same way) didn't terminate, or some branch
+# is missing its earlier transactions, or the INVITEs start after branch 0
+def _needsLookback(call):
+
+    if not call.cdrs:
+        return False
+
+    if sorted(call.cdrs, key=lambda cdr: cdr.t_branch_idx)[-1].d_state != 3:
+        return True
+
+    if any(cdr.d_state == -1 for cdr in call.cdrs):
+        return True
+
+    bids = [t.t_branch_idx for t in call.transactions if t.method == 'INVITE' and t.t_branch_idx is not None]
+    return bool(bids) and min(bids) > 0
+
+
+# iterate over `it` in a background thread, up to depth items ahead of the consumer; an exception in the thread is
+# re-raised in the consumer.  If the consumer stops early (exception, close()), the thread stops at its next item.
+def _prefetch(it, depth):
+
+    q = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(v):
+        while not stop.is_set():
+            try:
+                q.put(v, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for v in it:
+                if not put((True, v)):
+                    return
+            put((False, None))
+        except:
+            put((False, sys.exc_info()))
+
+    th = threading.Thread(target=run, name='nccdr-load')
+    th.daemon = True
+    th.start()
+
+    try:
+        while True:
+            (ok, v) = q.get()
+            if ok:
+                yield v
+            elif v:
+                raise v[0], v[1], v[2]
+            else:
+                return
+    finally:
+        stop.set()
+
+
+# create Call objects from acc rows (resuming from snaps where there is one) and run their state machines; yields a
+# Call for every Call-Id
+def _buildCalls(callids, chunksize, snaps, since=None):
+
+    # Call-Ids we haven't seen acc rows for (yet)
+    pending = set(callids)
+
+    afterids = dict((cid, snap['lastid']) for (cid, snap) in snaps.iteritems())
+
+    loader = _loadTxRows(list(pending), chunksize, afterids, since)
+
+    for (cid, rows) in stats.timeiter('load', loader): # rows (each is a single sip transaction) from acc table
+
+        if cid not in pending:
+            log.warning('acc rows for unexpected Call-Id (collation mismatch?); callid=%s', cid)
+            continue
+
+        pending.discard(cid)
+
+        with stats.timer('replay'):
+
+            if cid in snaps:
+                stats.count('resumed')
+            call = _replay(cid, rows, snaps.get(cid))
+
+        stats.count('rows', len(rows))
+        stats.count('calls')
+        stats.count('branches', len(call.cdrs))
+
+        yield call
+
+    # still create Call objects for the rest (added 2013/11/8), since there is a common case
+    # where the callid is in the Redis cdr:callids queue but there are not yet any rows
+    # in the acc table; or no new rows since the checkpoint.
+    for cid in callids:
+        if cid in pending:
+            pending.discard(cid)
+            call = Call(cid)
+            if cid in snaps:
+                call.restore(snaps[cid])
+                call.dispatchTransactions()
+            yield call
+
+
+# a Call from its acc rows (after restoring it from snap, if given), with its dialog state machines run
+def _replay(cid, rows, snap=None):
+
+    call = Call(cid)
+    if snap:
+        call.restore(snap)
+
+    for t in rows:
+        _addTxRow(call, t)
+
+    # transactions are already sorted by prtime, then time, then id (order important for dialog state machine logic)
+    call.dispatchTransactions()
+
+    return call
+
+
+# note: Cdr (misnamed) object represents a single branch of a call
+def _addTxRow(call, t):
+
+    cid = t.callid
+    method = t.method
+    ttag = t.to_tag
+    ftag = t.from_tag
+    bid = t.t_branch_idx
+    if bid is None: bid = ''
+    else: bid = str(bid)
+
+    #tag = ttag + str(bid)
+    tag = ttag
+    if not tag: ttag = str(bid)
+
+    # uniquely identify each branch: normally this will be the to tag (differs for each serially forked branch, as oppsed
+    # to the from tag that is constant for each outbound request);for the case of BYE, this could be the from tag depending on
+    # who sent it.  BUT the problem is servers along different branches may not populate the to tag in their response ... so
+    # for the purposes of identification here we concat to tag with branch id.
+
+    if not call.hasTag(tag):
+
+        if method == 'BYE' and call.hasTag(ftag + bid): tag = ftag + bid
+        else:
+            # we could have a stranded BYE before seeing other txs, but don't worry about that for now
+            call.addCdr( Cdr(cid, tag) )
+
+    cdr = call.getCdr(tag)
+
+    t.tag = tag
+
+    cdr.transactions.append(t)
+    call.transactions.append(t)
+
+
+# finalize the branches (Cdrs) of the calls that got past the start of a dialog, then the calls themselves
+# (and update the checkpoints in store, if given)
+def _finalizeCalls(calls, store=None):
+
+    with stats.timer('finalize'):
+        return _finalizeCalls_(calls, store)
+
+def _finalizeCalls_(calls, store):
+
+    # snapshot before finalize, which fills in fields (b_lrn, ...) the state machine would otherwise leave alone
+    snaps = None
+    if store:
+        snaps = [call.snapshot() for call in calls]
+
+    cdrs = []
+
+    for call in calls:
+        for cdr in call.getAllCdrs():
+
+            #print ': tag=%s d_state=%d' % (cdr.tag, cdr.d_state)
+
+            if cdr.d_state > 0:
+                cdrs.append(cdr)
+            else:
+                log.debug('not finalizing incomplete Cdr')
+
+    if np:
+        CdrBatch(cdrs).finalize()
+    else:
+        for cdr in cdrs:
+            cdr.finalize()
+
+    for call in calls:
+        call.finalize()
+
+    if store:
+        _updateCheckpoints(store, calls, snaps)
+
+    return calls
+
+
+def _updateCheckpoints(store, calls, snaps):
+
+    save = {}
+    done = []
+
+    for (call, snap) in zip(calls, snaps):
+
+        if call.isComplete():
+            done.append(call.callid)
+
+        # nothing to resume for a call without acc rows, and a branch in the illegal state (-1) is waiting for
+        # earlier transactions: a full reload has to find those, so don't checkpoint past them
+        elif call.cdrs and not [cdr for cdr in call.cdrs if cdr.d_state==-1]:
+            save[call.callid] = snap
+
+        else:
+            done.append(call.callid)
+
+    if save:
+        store.save(save)
+    if done:
+        store.delete(done)
+
+# }}}
+################################################################################
+
+
+
+
+################################################################################
+# {{{ CheckpointStore: dialog state of incomplete calls between runs
+#
+# Calls still in progress (multi-hour calls in particular) would otherwise have all of their acc rows re-read and
+# replayed on every run.  A store keeps Call.snapshot() for each incomplete call, so the next run resumes the
+# state machines with just the rows added since.  Stores have:
+#
+#   load(callids)  -> dict of Call-Id -> snapshot, for those that have a current checkpoint
+#   save(snaps)    dict of Call-Id -> snapshot
+#   delete(callids)
+#   forShard(n)    store to use in worker process n (see record_calls_sharded)
+#
+# Note: a resumed call only gets acc rows with a higher id than it has seen, so a row that is committed late with a
+# lower id than one already processed for the same call is missed (the daemon's overlap window doesn't help here).
+
+# all checkpoints in a local (json) file
+class FileCheckpointStore(object):
+    "checkpoints of incomplete calls in a local file"
+
+    def __init__(self, path, ttl=CHECKPOINT_TTL):
+
+        self.path = path
+        self.ttl = ttl
+        self.ckpts = None  # Call-Id -> [time saved, snapshot]
+
+    def load(self, callids):
+
+        ckpts = self._ckpts()
+        snaps = {}
+
+        for cid in callids:
+            if cid in ckpts:
+                snaps[cid] = ckpts[cid][1]
+
+        return snaps
+
+    def save(self, snaps):
+
+        ckpts = self._ckpts()
+        now = int(time.time())
+
+        for (cid, snap) in snaps.iteritems():
+            ckpts[cid] = [now, snap]
+
+        self._write()
+
+    def delete(self, callids):
+
+        ckpts = self._ckpts()
+        n = len(ckpts)
+
+        for cid in callids:
+            ckpts.pop(cid, None)
+
+        if len(ckpts) != n:
+            self._write()
+
+    def forShard(self, n):
+        return FileCheckpointStore('%s.%d' % (self.path, n), self.ttl)
+
+    def _ckpts(self):
+
+        if self.ckpts is None:
+
+            self.ckpts = {}
+
+            try:
+                with open(self.path) as f:
+                    self.ckpts = json.load(f)
+
+            except IOError:
+                pass
+
+            except ValueError:
+                log.error('checkpoint file %s is corrupt, ignoring it', self.path)
+
+            expired = int(time.time()) - self.ttl
+            for (cid, (saved, snap)) in self.ckpts.items():
+                if saved < expired or snap.get('v') != CHECKPOINT_VERSION:
+                    del(self.ckpts[cid])
+
+        return self.ckpts
+
+    # write-then-rename so a crash never leaves a truncated file
+    def _write(self):
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.ckpts, f, separators=(',', ':'))
+        os.rename(tmp, self.path)
+
+
+# one Redis key per call (expiring after ttl), shared by all processes
+# Keys are PREFIX + the call's 64 bit netcall.cidKey in hex instead of the (much longer) Call-Id; the Call-Id is
+# kept in the value, and a checkpoint saved under another Call-Id (a key collision) is ignored.
+
+class RedisCheckpointStore(object):
+    "checkpoints of incomplete calls in Redis"
+
+    PREFIX = 'cdr:ckpt:'
+
+    def __init__(self, ttl=CHECKPOINT_TTL):
+
+        self.ttl = ttl
+        self.db = None  # connected on first use, so the store can be handed to worker processes
+
+    def load(self, callids):
+
+        callids = list(callids)
+        snaps = {}
+
+        if not callids:
+            return snaps
+
+        vals = self._redis().mget([_ckptKey(cid) for cid in callids])
+
+        for (cid, v) in zip(callids, vals):
+            if v:
+                snap = json.loads(v)
+                if snap.get('v') == CHECKPOINT_VERSION and snap.get('callid') == cid:
+                    del snap['callid']
+                    snaps[cid] = snap
+
+        return snaps
+
+    def save(self, snaps):
+
+        pipe = self._redis().pipeline(transaction=False)
+        for (cid, snap) in snaps.iteritems():
+            snap = dict(snap, callid=cid)
+            pipe.setex(_ckptKey(cid), json.dumps(snap, separators=(',', ':')), self.ttl)
+        pipe.execute()
+
+    def delete(self, callids):
+
+        keys = [_ckptKey(cid) for cid in callids]
+        if keys:
+            self._redis().delete(*keys)
+
+    def forShard(self, n):
+        return RedisCheckpointStore(self.ttl)
+
+    def _redis(self):
+
+        if not self.db:
+            self.db = netcall.NetcallDB()
+        return self.db._redis()
+
+
+def _ckptKey(callid):
+    return RedisCheckpointStore.PREFIX + '%016x' % netcall.cidKey(callid)
+
+
+# }}}
+################################################################################
+
+
+
+
+################################################################################
+# {{{ record_calls: process Call-Ids and write the complete calls to netcall.calls
+#
+# Note: only completed calls are recorded (has an invite plus a final dialog-ending response); failed branches
+# stay in the acc table to be analyzed elsewhere, and incompletes are left for later date ranges.
+#
+# returns a Counter with 'complete', 'incomplete', 'written', 'unchanged' (already recorded as is, not written),
+# 'errors' (calls that failed to write; the database error has been logged and the transaction rolled back) and
+# 'no_fcdr' (complete calls without an F-Cdr, logged), plus 'nc_hits' and 'nc_misses' of PhoneNumber's parse cache,
+# which classifyNumber goes through.
+#
+# accept: optional function(call) -> bool to decide which complete calls to write; the others are counted as
+# 'skipped' (see backfill, where each call is written by the one chunk it started in).
+#
+# pipeline: overlap the stages instead of running them one after the other: acc rows are loaded (and replayed) in one
+# thread and calls written in another, each up to PIPELINE_DEPTH batches ahead of/behind finalize (pricing) in this
+# one.  Each thread has its own database connection: the loader makes one, the writer uses db.  This only helps as
+# far as the stages are waiting on MySQL/Redis, which in practice is most of the time.
+#
+# since, horizon: bounded acc load with a lookback for the calls that need it (see _lookback)
+
+PIPELINE_DEPTH = 2
+
+def record_calls(callids, db=None, store=None, accept=None, pipeline=False, since=None, horizon=None):
+
+    if not db:
+        db = netcall.NetcallDB()
+
+    counts = Counter()
+    nc = PhoneNumber.cacheStats()
+
+    writer = None
+    if pipeline:
+        writer = CallWriter(db, counts, PIPELINE_DEPTH)
+
+    completes = []  # waiting to be written
+
+    try:
+        for call in process_cdrs_iter(callids, store=store, prefetch=pipeline and PIPELINE_DEPTH, since=since,
+                                      horizon=horizon):
+
+            if call.isIncomplete():
+                counts['incomplete'] += 1
+                continue
+
+            counts['complete'] += 1
+
+            if accept and not accept(call):
+                counts['skipped'] += 1
+                continue
+
+            completes.append(call)
+
+            if len(completes) >= netcall.NetcallDB.WRITEBATCH:
+                _writeCalls(db, completes, counts, writer)
+                completes = []
+
+        _writeCalls(db, completes, counts, writer)
+
+    finally:
+        if writer:
+            writer.close()
+
+    counts['nc_hits'] += PhoneNumber.cacheStats()['hits'] - nc['hits']
+    counts['nc_misses'] += PhoneNumber.cacheStats()['misses'] - nc['misses']
+
+    return counts
+
+
+def _writeCalls(db, calls, counts, writer=None):
+
+    if writer:
+        if calls:
+            writer.put(calls)
+        return
+
+    _writeCallBatch(db, calls, counts)
+
+
+def _writeCallBatch(db, calls, counts):
+
+    if not calls:
+        return
+
+    with stats.timer('write'):
+        (nwritten, nunchanged, failed, nofcdr) = db.writeCallRecords(calls)
+
+    counts['written'] += nwritten
+    counts['unchanged'] += nunchanged
+    counts['errors'] += len(failed)
+    counts['no_fcdr'] += len(nofcdr)
+
+
+# writes batches of calls in a background thread (the write stage of a pipelined record_calls), adding to counts
+# 'written', 'unchanged', 'errors' and 'no_fcdr'.  put() blocks while depth batches are waiting; close() waits for
+# the writes to finish.
+# An exception in the thread is re-raised by the next put() or close().
+class CallWriter(threading.Thread):
+    'background thread writing batches of complete calls with db.writeCallRecords'
+
+    def __init__(self, db, counts, depth):
+
+        threading.Thread.__init__(self, name='nccdr-write')
+        self.daemon = True
+
+        self.db = db
+        self.counts = counts
+        self.q = Queue.Queue(depth)
+        self.error = None
+
+        self.start()
+
+    def run(self):
+        while True:
+            calls = self.q.get()
+            if calls is None:
+                return
+            if self.error:
+                continue  # keep draining, so put() never blocks on a dead writer
+            try:
+                _writeCallBatch(self.db, calls, self.counts)
+            except:
+                self.error = sys.exc_info()
+
+    def put(self, calls):
+        self._raise()
+        self.q.put(calls)
+
+    def close(self):
+        self.q.put(None)
+        self.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error:
+            (e, self.error) = (self.error, None)
+            raise e[0], e[1], e[2]
+
+
+# same as record_calls, but Call-Ids are sharded by hash over a pool of nworkers processes; each worker has
+# its own NetcallDB connections and loads, replays, finalizes and writes its own shard.  Returns the merged counts.
+# pool: an existing multiprocessing.Pool (from makeWorkerPool) to reuse, e.g. across daemon polls.
+# store: CheckpointStore; each shard uses store.forShard(n)
+# pipeline, since, horizon: passed on to each worker's record_calls
+def record_calls_sharded(callids, nworkers, pool=None, store=None, pipeline=False, since=None, horizon=None):
+
+    shards = [[] for i in range(nworkers)]
+    for cid in callids:
+        shards[_shardOf(cid, nworkers)].append(cid)
+
+    shards = [(shard, store and store.forShard(n), pipeline, since, horizon) for (n, shard) in enumerate(shards)]
+
+    if pool:
+        results = pool.map(_recordShard, shards, 1)
+
+    else:
+        pool = makeWorkerPool(nworkers)
+        try:
+            results = pool.map(_recordShard, shards, 1)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    counts = Counter()
+    for (c, data) in results:
+        counts.update(c)
+        stats.merge(data)
+
+    return counts
+
+
+# stable (across processes and runs) shard number for a Call-Id
+def _shardOf(callid, nshards):
+    return (zlib.crc32(callid) & 0xffffffff) % nshards
+
+
+# returns the counts and the runstats of this worker's shard
+def _recordShard(args):
+    (callids, store, pipeline, since, horizon) = args
+    stats.reset()
+    counts = record_calls(callids, None, store, pipeline=pipeline, since=since, horizon=horizon)
+    return (counts, stats.data())
+
+
+def makeWorkerPool(nworkers):
+    return multiprocessing.Pool(nworkers, _initWorker)
+
+
+def _initWorker():
+
+    # start over with Carrier objects and the price table, but keep the parent's (its Redis pubsub connection)
+    # referenced: see netcall.Connections
+    netcall.connections.keep(dict(netcall.code3_2_customers), dict(netcall.code3_2_terminators),
+                             netcall.priceTable.pubsub)
+    netcall.code3_2_customers.clear()
+    netcall.code3_2_terminators.clear()
+    netcall.priceTable.clear()
+
+
+# }}}
+################################################################################
+
+
+
+
+################################################################################
+# {{{ AccTail: daemon mode, follow the acc table by auto-increment id
+#
+# Instead of re-querying a time window from cron, poll acc for rows above a watermark id (a primary key range
+# scan), collect the Call-Ids those rows belong to, and re-process just those calls.  A call is re-processed
+# every time it gets a new acc row, so a complete call is written when its dialog-ending transaction shows up and
+# simply clobbered if more rows arrive later (see the race condition note in main).
+#
+# The watermark is only persisted after the calls have been recorded, so a crash re-processes (never skips) the
+# last batch.  Auto-increment ids are handed out at insert time but become visible at commit, so a row can show
+# up below ids we've already read; the last OVERLAP ids are re-scanned on every poll to pick up such stragglers
+# (after a restart the ids seen in that window are forgotten, so their calls are processed once more).
+
+class AccTail(object):
+    "follow acc by id from a persisted watermark"
+
+    OVERLAP = 500     # ids below the watermark to re-scan for late committed rows
+    MAXROWS = 20000   # acc rows per poll
+
+    def __init__(self, db, wmfile):
+
+        self.db = db
+        self.wmfile = wmfile
+
+        self.lastid = self._readWatermark()
+        if self.lastid is None:
+            # no watermark yet: start from now instead of replaying the whole table (use cron mode for that)
+            self.lastid = db.getMaxAccId()
+            self._writeWatermark(self.lastid)
+            log.info("no watermark in %s, starting at acc.id %d", wmfile, self.lastid)
+
+        self.seen = set()      # ids in the overlap window already handed out
+        self._pending = None   # (lastid, seen) to apply on commit()
+
+
+    # distinct Call-Ids with new acc rows since the last commit(), in order of first appearance
+    def poll(self):
+
+        floor = max(self.lastid - AccTail.OVERLAP, 0)
+
+        callids = []
+        cidset = set()
+        seen = set(i for i in self.seen if i > floor)
+        lastid = self.lastid
+
+        for (id, cid) in self.db.getAccIdsSince(floor, AccTail.MAXROWS):
+            if id in seen:
+                continue
+            seen.add(id)
+            if id > lastid:
+                lastid = id
+            if cid not in cidset:
+                cidset.add(cid)
+                callids.append(cid)
+
+        self._pending = (lastid, seen)
+
+        return callids
+
+
+    # the Call-Ids from the last poll() have been recorded: advance and persist the watermark
+    def commit(self):
+
+        if self._pending is None:
+            return
+
+        (lastid, seen) = self._pending
+        self._pending = None
+
+        if lastid != self.lastid:
+            self._writeWatermark(lastid)
+
+        self.lastid = lastid
+        self.seen = seen
+
+
+    def _readWatermark(self):
+
+        try:
+            with open(self.wmfile) as f:
+                return long(f.read().strip())
+
+        except IOError:
+            return None
+
+
+    # write-then-rename so a crash never leaves a truncated watermark
+    def _writeWatermark(self, lastid):
+
+        tmp = self.wmfile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d\n' % (lastid))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.wmfile)
+
+
+
+# statsfile/statsredis: write a runstats record for every poll that had calls to record (see writeRunStats)
+def run_daemon(db, wmfile, interval, nworkers=1, store=None, statsfile=None, statsredis=False, pipeline=False):
+
+    tail = AccTail(db, wmfile)
+
+    pool = None
+    if nworkers > 1:
+        pool = makeWorkerPool(nworkers)
+
+    while True:
+
+        stats.reset()
+
+        with stats.timer('poll'):
+            callids = tail.poll()
+
+        if not callids:
+            tail.commit()
+            time.sleep(interval)
+            continue
+
+        t1 = time.time()
+
+        if pool:
+            counts = record_calls_sharded(callids, nworkers, pool, store, pipeline)
+        else:
+            counts = record_calls(callids, db, store, pipeline=pipeline)
+
+        if counts['errors']:
+            # leave the watermark where it is so the batch is retried
+            log.error("%d calls could not be recorded, will retry", counts['errors'])
+            time.sleep(interval)
+            continue
+
+        tail.commit()
+
+        log.info("acc.id %d: recorded %d calls (%d unchanged, %d incomplete) in %.1f seconds", tail.lastid,
+                 counts['written'], counts['unchanged'], counts['incomplete'], time.time()-t1)
+
+        if statsfile or statsredis:
+            writeRunStats(counts, statsfile, statsredis, mode='daemon', lastid=tail.lastid)
+
+
+# write the runstats record for this run (stage times, counters plus counts from record_calls) to a json lines file
+# and/or Redis; extra: more fields for the record
+def writeRunStats(counts, statsfile=None, statsredis=False, **extra):
+
+    rec = stats.record(**extra)
+    rec['counts'].update(counts)
+
+    r = None
+    if statsredis:
+        r = netcall.NetcallDB()._redis()
+
+    runstats.writeRecord(rec, statsfile, r)
+
+
+# }}}
+################################################################################
+
+
+
+
+##########################################################################
+## {{{ py.test tests
+
+def setup_module(m):
+
+    global TESTMODE
+    TESTMODE = True
+
+    netcall.NetcallDB.TESTMODE = True
+
+    # a small NanpaDB index with the NPA-NXXs the tests use
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'nanpa.db')
+    NanpaDB.writeIndex(path, {541223: {'state': 'OR', 'lata': '670', 'ocn': '9740'},
+                              503943: {'state': 'OR', 'lata': '672', 'ocn': '9740'}}, {})
+    NanpaDB.load(path)
+
+
+def set_test_data(rdata):
+    del(test_rdata[:])
+    test_rdata.extend(rdata)
+
+
+P1_CALLID = '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060'
+P2_CALLID = '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060'
+P3_CALLID = '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060'
+
+# an acc row for the tests that need test_p1's, test_p2's or test_p3's call again: the 200 OK to test_p1's INVITE on
+# branch 1, with the given fields changed
+def _accRow(**fields):
+    row = {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '1', 'duration': 0L,
+           'sip_code': '200', 'id': 10158L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08',
+           'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid': P1_CALLID,
+           'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 22, 14),
+           'time': datetime(2013, 6, 19, 22, 22, 17)}
+    row.update(fields)
+    return row
+
+# test_p1's call: 403 on branch 0, 180 and 200 on branch 1, BYE
+def _p1Rows():
+    return [
+        _accRow(id=10152L, sip_code='403', sip_reason='Forbidden', t_branch_idx='0', dst_id='erl', dst_id2='erl',
+                to_tag='aprqngfrt-v4irvo30000c6', time=datetime(2013, 6, 19, 22, 22, 14)),
+        _accRow(id=10154L, sip_code='180', sip_reason='Ringing', time=datetime(2013, 6, 19, 22, 22, 16)),
+        _accRow(),
+        _accRow(id=10162L, method='BYE', callee_lrn='', callee_id='', t_branch_idx='', ruleid=0L, dst_id='', dst_id2='',
+                prtime=None, time=datetime(2013, 6, 19, 22, 22, 23)),
+        ]
+
+# test_p2's call: 403 on branch 0, 408 and the final 480 on branch 1
+def _p2Rows():
+    def row(**fields):
+        r = {'callid': P2_CALLID, 'from_tag': 'as4a819a50', 'prtime': datetime(2013, 6, 19, 22, 25),
+             'time': datetime(2013, 6, 19, 22, 25, 5)}
+        r.update(fields)
+        return _accRow(**r)
+
+    return [
+        row(id=10164L, sip_code='403', sip_reason='Forbidden', t_branch_idx='0', dst_id='erl', dst_id2='erl',
+            to_tag='aprqngfrt-jvbfii30000c6', time=datetime(2013, 6, 19, 22, 25)),
+        row(id=10166L, sip_code='408', sip_reason='Request Timeout', to_tag='01cb61382f57641c77c469cfc8891839-e91e'),
+        row(id=10170L, sip_code='480', sip_reason='Temporarily Unavailable', to_tag=''),
+        ]
+
+# the first acc row of test_p3's call: a 408 on branch 0
+def _p3Row():
+    return _accRow(id=10614L, callid=P3_CALLID, sip_code='408', sip_reason='Request Timeout', t_branch_idx='0',
+                   callee_lrn='15032060203', caller_id='12123330002', callee_id='15036665555', ruleid=54988L,
+                   cp_node='g07', dst_id='erl', dst_id2='erl', from_tag='as60a8cbfa',
+                   to_tag='01cb61382f57641c77c469cfc8891839-c5aa', prtime=datetime(2013, 6, 21, 1, 29, 3),
+                   time=datetime(2013, 6, 21, 1, 29, 7))
+
+
+def test_p1():
+
+    set_test_data([
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Forbidden', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '403', 'id': 10152L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid': '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'aprqngfrt-v4irvo30000c6', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 14)},
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Ringing', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '180', 'id': 10154L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid':   '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 16)},
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '200', 'id': 10158L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as63dfc9e2', 'callee_id': '15039432980', 'callid':        '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 22, 14), 'time': datetime(2013, 6, 19, 22, 22, 17)},
+        {'callee_lrn': '', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '', 'duration': 0L, 'sip_code': '200', 'id': 10162L, 'src_id': 'a22', 'ruleid': 0L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': '', 'method': 'BYE', 'from_tag': 'as63dfc9e2', 'callee_id': '', 'callid':                                          '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': '', 'prtime': None, 'time': datetime(2013, 6, 19, 22, 22, 23)},
+        ])
+
+    (bcalls, incompletes) = process_cdrs(['44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060'])
+    assert(len(bcalls)==1)
+    assert(len(incompletes)==0)
+
+    fcdr = bcalls[0].getFCdr()
+    errs = bcalls[0].getErrCdrs()
+
+    assert(len(errs)==1)
+    ecdr = errs[0]
+
+    #print fcdr
+    #print ecdr
+
+    #print fcdr.t_start
+    #print fcdr.t_confirm
+    #print fcdr.t_end
+    #print fcdr.s_setup
+    #print fcdr.s_connected
+    #print fcdr.s_total
+    assert(fcdr.s_total==9)
+    assert(fcdr.s_setup==3)
+    assert(fcdr.s_connected==6)
+
+
+
+# acc rows come out of the loader in state machine order no matter how they were stored
+def test_tx_order():
+
+    set_test_data(_p1Rows()[::-1])
+
+    (bcalls, incompletes) = process_cdrs([P1_CALLID])
+    assert(len(bcalls)==1)
+    assert(len(incompletes)==0)
+
+    txs = bcalls[0].getAllTransactions()
+    assert([t.id for t in txs] == [10152L, 10154L, 10158L, 10162L])
+
+    fcdr = bcalls[0].getFCdr()
+    assert(fcdr.s_total==9)
+    assert(fcdr.s_setup==3)
+    assert(fcdr.s_connected==6)
+
+
+def test_p2():
+
+    # here we have what looks like an extraneous response, but the final 480 is actually what was sent back to our customer
+    # after no other routes were available to try.  So, 2 error branches: one branch to erl, the other to wds
+    set_test_data([
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Forbidden', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '403', 'id': 10164L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': 'aprqngfrt-jvbfii30000c6', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25)},
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Request Timeout', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '408', 'id': 10166L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-e91e', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25, 5)},
+        {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Temporarily Unavailable', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '480', 'id': 10170L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': '', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 19, 22, 25), 'time': datetime(2013, 6, 19, 22, 25, 5)},
+        ])
+
+    (bcalls, incompletes) = process_cdrs(['36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060'])
+    assert(len(bcalls)==1)
+    assert(len(incompletes)==0)
+
+    fcdr = bcalls[0].getFCdr()
+    errs = bcalls[0].getErrCdrs()
+
+
+    #print fcdr
+
+    assert(fcdr.t_branch_idx==99)
+    assert(len(errs)==2)
+
+    e0 = errs[0].t_branch_idx
+    e1 = errs[1].t_branch_idx
+    assert(e0 != e1 and ((e0==0 or e0==1) and (e1==0 or e1==1)))
+
+
+# single-pass dispatch must leave every branch in the same state as replaying all txs through each branch
+def test_dispatch_equiv():
+
+    # test_p2's call, with the 408 accounted twice
+    rows = _p2Rows()
+    set_test_data(rows + [dict(rows[1], id=10167L)])
+
+    (cid, rows) = list(_loadTxRows([P2_CALLID]))[0]
+    c1 = Call(cid)
+    c2 = Call(cid)
+    for t in rows:
+        _addTxRow(c1, t)
+        _addTxRow(c2, t)
+
+    c1.dispatchTransactions()
+    for cdr in c2.getAllCdrs():
+        for t in c2.transactions:
+            cdr.process_tx(t)
+
+    assert(len(c1.getAllCdrs()) == 3)
+    for (a, b) in zip(c1.getAllCdrs(), c2.getAllCdrs()):
+        assert(a.tag == b.tag)
+        assert((a.d_state, a.t_start, a.t_confirm, a.t_end) == (b.d_state, b.t_start, b.t_confirm, b.t_end))
+        assert((a.t_branch_idx, a.last_rc, a.status, a.cp_node) == (b.t_branch_idx, b.last_rc, b.status, b.cp_node))
+        assert((a.c_from, a.c_to, a.anum, a.bnum, a.b_lrn, a.ruleid) == (b.c_from, b.c_to, b.anum, b.bnum, b.b_lrn, b.ruleid))
+
+
+# the if/elif ladder DIALOG_TABLE replaced, kept as the reference for test_dialog_table
+def _applyTxLadder(cdr, t):
+
+    mINV = t.method=='INVITE'
+    mBYE = t.method=='BYE'
+    rc = t.sip_code
+    rc_provisional = (rc >= 300 and rc < 400) or rc < 200
+    rc_ok = rc >= 200 and rc < 300
+    rc_final = rc_ok or rc >= 400
+
+    ds = ds_n = cdr.d_state
+
+    if ds==-1: return
+
+    if ds==0 or ds==1:
+        if ds==0 and mINV and rc_provisional: ds_n = 1
+        elif mINV and rc_ok:
+            cdr._confirm(t.time)
+            ds_n = 2
+        elif mINV and rc_final:
+            cdr._confirm(t.time)
+            cdr._end(t.time)
+            ds_n = 3
+        elif mBYE:
+            ds_n = -1
+
+    elif ds==2:
+        if mBYE:
+            cdr._end(t.time)
+            if rc_ok:
+                ds_n = 3
+                cdr.status = 'completed'
+
+    if ds_n > 0 and mINV:
+        if t.src_id     and not cdr.c_from:  cdr.c_from = t.src_id
+        if t.callee_id  and not cdr.bnum:    cdr.bnum   = t.callee_id
+
+    if ds_n==2 or ds_n==3:
+        cdr.last_rc = rc
+        cdr.status = resp2message(rc)
+
+    cdr.d_state = ds_n
+
+
+# every (state, method, response) combination must come out of the table the way it came out of the old ladder
+def test_dialog_table():
+
+    for ds in (-1, 0, 1, 2, 3):
+        for method in ('INVITE', 'BYE', 'CANCEL'):
+            for rc in (0, 100, 180, 200, 302, 404, 487, 503, 603):
+
+                t = Tx(1L, 'cid', method, 'ft', 'tt', rc, 1000, 1005, 0, 'a22', 'wds', '+15032222222', '15039432980',
+                       None, None, 'g08', 0)
+                (a, b) = (Cdr('cid', 'tt'), Cdr('cid', 'tt'))
+                a.d_state = b.d_state = ds
+
+                a.apply_tx(t)
+                _applyTxLadder(b, t)
+
+                assert((a.d_state, a.e_confirm, a.e_end, a.status, a.last_rc, a.c_from, a.bnum) ==
+                       (b.d_state, b.e_confirm, b.e_end, b.status, b.last_rc, b.c_from, b.bnum)), (ds, method, rc)
+
+
+def test_tx_prep():
+
+    r = {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': 'Temporarily Unavailable', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '480', 'id': 10170L, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as4a819a50', 'callee_id': '15039432980', 'callid': '36f1b17621c025302eb7b69c043344f1@70.102.5.22:5060', 'to_tag': '', 'created': None, 'dst_id': 'wds', 'prtime': None, 'time': datetime(2013, 6, 19, 22, 25, 5)}
+
+    t = _prepTxRow(r)
+    assert(t.sip_code == 480)
+    assert(t.t_branch_idx == 99 and t.dst_id == None)
+    assert(t.prtime == t.time)
+    assert(_e2dt(t.time) == r['time'])
+
+    # the digest goes into checkpoints: the same on any host/Python (no hash() randomization)
+    assert(t.txhash == 5328481366002727226)
+
+    # same row under another id is a dupe; any other difference is not
+    r2 = dict(r)
+    r2['id'] = 10171L
+    assert(_prepTxRow(r2).txhash == t.txhash)
+    r2['sip_reason'] = 'Service Unavailable'
+    assert(_prepTxRow(r2).txhash != t.txhash)
+
+    r2['t_branch_idx'] = ''
+    r2['to_tag'] = 'SDjugrf99-10829758'
+    assert(_prepTxRow(r2).t_branch_idx == None)
+
+
+def _mkcdr(c_from, bnum, s_setup, s_conn, ruleid=204012L):
+
+    ts = datetime(2013, 6, 19, 22, 22, 14)
+
+    cdr = Cdr('cid-%s-%s-%s@1.2.3.4' % (c_from, bnum, s_conn), 'tag1')
+    cdr.c_from = c_from
+    cdr.c_to = 'wds'
+    cdr.anum = '+15032222222'
+    cdr.bnum = bnum
+    cdr.b_lrn = bnum
+    cdr.ruleid = ruleid
+    cdr.d_state = 3
+    cdr.e_start = _dt2e(ts)
+    cdr.t_start = ts
+    if s_setup is not None:
+        cdr._confirm(cdr.e_start + s_setup)
+        cdr._end(cdr.e_confirm + (s_conn or 0))
+    return cdr
+
+def test_batch_finalize():
+
+    if not np: return
+
+    specs = [
+        ('a22', '15039432980', 3, 6),
+        ('a22', '15039432980', 3, 0),
+        ('a22', '15039432980', 0, 61),
+        ('a22', '15039432980', None, None),
+        ('qkc', '+52111222333', 2, 37),
+        ('qkc', '+15032223333', 2, 37),
+        ('ryn', '15039432980', 5, 3600),
+        ('ryn', '15039432980', 5, 1, 0L),
+        (None,  '15039432980', 5, 30),
+        ]
+
+    c1 = [_mkcdr(*sp) for sp in specs]
+    c2 = [_mkcdr(*sp) for sp in specs]
+
+    for cdr in c1:
+        cdr.finalize()
+    CdrBatch(c2).finalize()
+
+    fields = ('s_setup', 's_connected', 's_total', 's_connected_r', 'call_price', 'ptgroup', 'a_jtype', 'b_jtype', 'xstate')
+    for (a, b) in zip(c1, c2):
+        for f in fields:
+            assert(getattr(a, f) == getattr(b, f))
+
+    assert(c2[4].s_connected_r == 37)  # quickcom 1/1 to Mexico
+    assert(c2[5].s_connected_r == 42)
+    assert(c2[6].call_price > 0.0)
+    assert(c2[8].s_connected == None)   # no customer, not finalized
+
+
+def test_batch_round():
+
+    if not np: return
+
+    c = netcall.Customer('a22')
+    s = np.array(range(-7, 200), dtype=np.int64)
+    for (r1, r2) in [(0, 1), (1, 1), (6, 6), (60, 6), (24, 6), (25, 6), (30, 6), (0, 60), (60, 60)]:
+        r1a = np.zeros(len(s), dtype=np.int64) + r1
+        r2a = np.zeros(len(s), dtype=np.int64) + r2
+        rs = _roundBillingSeconds(s, r1a, r2a, np.ones(len(s), dtype=bool))
+        assert(rs.tolist() == [c._calculateRoundedBillingSeconds(x, r1, r2) for x in s.tolist()])
+
+
+# a Customer subclass with only a per-Cdr billing rule is still honored by CdrBatch
+def test_batch_perrow_override():
+
+    if not np: return
+
+    class FlatCustomer(netcall.Customer):
+        def calculateRoundedBillingSeconds(self, s_connected, cdr=None):
+            return 60
+
+    netcall.carrierData['tSB'] = { 'code3': 'tSB', 'code5': '99667', 'subclass.customer': FlatCustomer }
+    try:
+        cdrs = [_mkcdr('tSB', '15039432980', 1, 7), _mkcdr('a22', '15039432980', 1, 7)]
+        CdrBatch(cdrs).finalize()
+        assert(cdrs[0].s_connected_r == 60)
+        assert(cdrs[1].s_connected_r == 12)
+    finally:
+        del(netcall.carrierData['tSB'])
+        netcall.code3_2_customers.pop('tSB', None)
+
+
+def test_nanpa():
+
+    ni = NanpaDB.getNumberInfo('+15412233333')
+    assert(ni['state'] == 'OR')
+    assert(ni['lata'] == '670')
+    ni = NanpaDB.getNumberInfo('5039433333')
+    assert(ni['state'] == 'OR')
+    assert(ni['lata'] == '672')
+
+
+def test_classify_number():
+
+    PhoneNumber.parseCache.clear()
+
+    assert(classifyNumber('15412233333')[:4] == ('US', 'D', 'OR', '670'))
+    assert(classifyNumber('+15039433333')[:3] == ('US', 'D', 'OR'))
+    assert(classifyNumber('+44123400067') == ('UK', 'I', None, None, None))
+    assert(classifyNumber('anonymous') == (None, 'U', None, None, None))
+    assert(classifyNumber(None) == (None, 'U', None, None, None))
+    assert(classifyNumber('15412233333')[:4] == ('US', 'D', 'OR', '670'))
+
+    assert(PhoneNumber.cacheStats()['hits'] == 1 and PhoneNumber.cacheStats()['misses'] == 5)
+
+    nums = ['+15039433333', '+44123400067', '15412233333', None, '5412233333', '+44123400067']
+    assert(classifyNumbers(nums) == [_classify(PhoneNumber._parse(n)) for n in nums])
+    assert(PhoneNumber.cacheStats()['hits'] == 6 and PhoneNumber.cacheStats()['misses'] == 6)
+
+def test_p3():
+
+    set_test_data([
+        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Request Timeout', 't_branch_idx': '0', 'duration': 0L, 'sip_code': '408', 'id': 10614L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'erl', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-c5aa', 'created': None, 'dst_id': 'erl', 'prtime': datetime(2013, 6, 21, 1, 29, 3), 'time': datetime(2013, 6, 21, 1, 29, 7)},
+        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Request Timeout', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '408', 'id': 10634L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '01cb61382f57641c77c469cfc8891839-5dbb', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 21, 1, 29, 7), 'time': datetime(2013, 6, 21, 1, 29, 11)},
+        {'callee_lrn': '15032060203', 'caller_id': '12123330002', 'sip_reason': 'Temporarily Unavailable', 't_branch_idx': '1', 'duration': 0L, 'sip_code': '480', 'id': 10638L, 'src_id': 'a22', 'ruleid': 54988L, 'setuptime': 0L, 'cp_node': 'g07', 'dst_id2': 'wds', 'method': 'INVITE', 'from_tag': 'as60a8cbfa', 'callee_id': '15036665555', 'callid': '16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060', 'to_tag': '', 'created': None, 'dst_id': 'wds', 'prtime': datetime(2013, 6, 21, 1, 29, 7), 'time': datetime(2013, 6, 21, 1, 29, 11)},
+        ])
+
+    (bcalls, incompletes) = process_cdrs(['16aac9fe7d3d04bb62443cc24625b424@70.102.5.22:5060'])
+    assert(len(bcalls)==1)
+    assert(len(incompletes)==0)
+
+    fcdr = bcalls[0].getFCdr()
+    errs = bcalls[0].getErrCdrs()
+
+    assert(fcdr.t_branch_idx==99)
+    assert(len(errs)==2)
+
+
+    assert(fcdr.last_rc==480)
+    assert(fcdr.call_price==0.0)
+
+
+def test_incomplete1():
+
+    set_test_data([
+        {'callee_lrn': '', 'caller_id': '+15032222222', 'sip_reason': 'OK', 't_branch_idx': '', 'duration': 0L, 'sip_code': '200', 'id': 10162L, 'src_id': 'a22', 'ruleid': 0L, 'setuptime': 0L, 'cp_node': 'g08', 'dst_id2': '', 'method': 'BYE', 'from_tag': 'as63dfc9e2', 'callee_id': '', 'callid':                                          '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060', 'to_tag': 'SDjugrf99-10829758', 'created': None, 'dst_id': '', 'prtime': None, 'time': datetime(2013, 6, 19, 22, 22, 23)},
+        ])
+
+    callid = '44e9522b1f284b6c6203a4ba711867a8@70.102.5.22:5060'
+    (bcalls, incompletes) = process_cdrs([callid])
+    assert(len(bcalls)==0)
+    assert(len(incompletes)==1)
+
+    fcdr = incompletes[0].getFCdr()
     assert(fcdr.callid == callid)
 
 def test_500err():
@@ -823,6 +2367,263 @@ def test_500err():
 
     assert(fcdr.last_rc == 500)
 
+
+def test_iter_chunks():
+
+    set_test_data([_p3Row(), _p1Rows()[3]])
+
+    callids = [P3_CALLID, 'no-acc-rows-yet@1.2.3.4', P1_CALLID, 'no-acc-rows-yet@1.2.3.4']
+
+    calls = list(process_cdrs_iter(callids, chunksize=1))
+
+    # one Call per distinct Call-Id
+    assert(len(calls) == 3)
+    calls = dict((c.callid, c) for c in calls)
+
+    assert(calls[callids[0]].isComplete())
+    assert(calls[callids[0]].getFCdr().last_rc == 408)
+    assert(calls[callids[1]].isIncomplete() and not calls[callids[1]].getFCdr())
+    assert(calls[callids[2]].isIncomplete())
+
+
+def test_record_calls():
+
+    set_test_data([_p3Row()])
+
+    class FailingDB(object):
+        def writeCallRecords(self, calls):
+            return (0, 0, list(calls), [])
+
+    stats.reset()
+
+    counts = record_calls([P3_CALLID, 'no-acc-rows-yet@1.2.3.4'], FailingDB())
+    assert(counts['complete'] == 1)
+    assert(counts['incomplete'] == 1)
+    assert(counts['written'] == 0)
+    assert(counts['errors'] == 1)
+
+    assert((stats.counts['rows'], stats.counts['calls'], stats.counts['branches']) == (1, 1, 1))
+
+    counts = record_calls([P3_CALLID], FailingDB(), accept=lambda call: False)
+    assert((counts['complete'], counts['skipped'], counts['errors']) == (1, 1, 0))
+
+    class UnchangedDB(object):
+        def writeCallRecords(self, calls):
+            return (0, len(calls), [], [])
+
+    counts = record_calls([P3_CALLID], UnchangedDB())
+    assert((counts['written'], counts['unchanged'], counts['errors']) == (0, 1, 0))
+    assert(set(['load', 'replay', 'finalize', 'write']) <= set(stats.times))
+
+    # pipelined: same results; a write error surfaces in the caller
+    counts = record_calls([P3_CALLID, 'no-acc-rows-yet@1.2.3.4'], FailingDB(), pipeline=True)
+    assert((counts['complete'], counts['incomplete'], counts['written'], counts['errors']) == (1, 1, 0, 1))
+
+    class BrokenDB(object):
+        def writeCallRecords(self, calls):
+            raise IOError('connection lost')
+
+    try:
+        record_calls([P3_CALLID], BrokenDB(), pipeline=True)
+        assert(False)
+    except IOError:
+        pass
+
+    # shard assignment must not depend on the process (hash() randomization, etc)
+    assert(_shardOf(P3_CALLID, 4) == 3)
+    assert(set(_shardOf('%d@1.2.3.4' % i, 4) for i in range(100)) == set([0, 1, 2, 3]))
+
+
+def test_prefetch():
+
+    assert(list(_prefetch(iter(range(10)), 2)) == range(10))
+
+    def failing():
+        yield 1
+        raise KeyError('boom')
+
+    it = _prefetch(failing(), 2)
+    assert(it.next() == 1)
+    try:
+        it.next()
+        assert(False)
+    except KeyError:
+        pass
+
+    # consumer stopping early releases the loader thread
+    it = _prefetch(iter(xrange(1000)), 1)
+    it.next()
+    it.close()
+    time.sleep(0.6)
+    assert(not [th for th in threading.enumerate() if th.name == 'nccdr-load'])
+
+
+# a call that started before `since`: found by the lookback, as long as the horizon goes back far enough
+def test_lookback():
+
+    cid = 'long-call@1.2.3.4'
+    def row(id, method, code, tm, bid='0', to_tag='tt1'):
+        return {'callee_lrn': '15038289199', 'caller_id': '+15032222222', 'sip_reason': '', 't_branch_idx': bid, 'duration': 0L,
+                'sip_code': code, 'id': id, 'src_id': 'a22', 'ruleid': 204012L, 'setuptime': 0L, 'cp_node': 'g08',
+                'dst_id2': 'wds', 'method': method, 'from_tag': 'ft1', 'callee_id': '15039432980', 'callid': cid,
+                'to_tag': to_tag, 'created': None, 'dst_id': 'wds', 'prtime': tm, 'time': tm}
+
+    set_test_data([
+        row(1L, 'INVITE', '200', datetime(2013, 6, 19, 10, 0, 5)),
+        row(2L, 'BYE', '200', datetime(2013, 6, 19, 13, 0, 0), ''),
+        ])
+
+    since = datetime(2013, 6, 19, 12, 0)
+
+    stats.reset()
+    [call] = list(process_cdrs_iter([cid], since=since, horizon=since - timedelta(hours=1)))
+    assert(call.isIncomplete())
+    assert(stats.counts['lookback_calls'] == 1 and stats.counts['lookback_rows'] == 1)
+
+    [call] = list(process_cdrs_iter([cid], since=since, horizon=since - timedelta(hours=3)))
+    assert(call.isComplete())
+    assert(call.getFCdr().t_confirm == datetime(2013, 6, 19, 10, 0, 5))
+    assert(call.getFCdr().s_connected == 3*3600 - 5)
+
+    # complete within the window: no lookback
+    stats.reset()
+    [call] = list(process_cdrs_iter([cid], since=datetime(2013, 6, 19, 9, 0), horizon=None))
+    assert(call.isComplete() and stats.counts['lookback_calls'] == 0)
+
+
+# a call whose failed branch 0 ended before `since` is complete without it, but is looked back anyway: otherwise
+# branch 0's err Cdr and the call's start would be lost
+def test_lookback_branch0():
+
+    set_test_data(_p1Rows())
+    since = datetime(2013, 6, 19, 22, 22, 15)
+
+    stats.reset()
+    [call] = list(process_cdrs_iter([P1_CALLID], since=since, horizon=since - timedelta(hours=1)))
+    assert(stats.counts['lookback_calls'] == 1 and stats.counts['lookback_rows'] == 4)
+    assert(call.isComplete())
+    assert([cdr.last_rc for cdr in call.getErrCdrs()] == [403])
+
+    fcdr = call.getFCdr()
+    assert((fcdr.s_total, fcdr.s_setup, fcdr.s_connected) == (9, 3, 6))
+
+    # all of the call in the window: no lookback
+    stats.reset()
+    [call] = list(process_cdrs_iter([P1_CALLID], since=datetime(2013, 6, 19, 22, 0), horizon=None))
+    assert(call.isComplete() and stats.counts['lookback_calls'] == 0)
+
+
+def _splitCalls(callids, store):
+    calls = list(process_cdrs_iter(callids, store=store))
+    return ([c for c in calls if c.isComplete()], [c for c in calls if c.isIncomplete()])
+
+
+# a call in progress is checkpointed, and the next run resumes it with just the new acc rows
+def test_checkpoint(tmpdir):
+
+    rows = _p1Rows()
+    callid = P1_CALLID
+    path = str(tmpdir.join('ckpt'))
+
+    # connected, no BYE yet
+    set_test_data(rows[:3])
+    (bcalls, incompletes) = _splitCalls([callid], FileCheckpointStore(path))
+    assert(len(incompletes)==1 and incompletes[0].isConfirmedDialog())
+    assert(FileCheckpointStore(path).load([callid])[callid]['lastid'] == 10158L)
+
+    # nothing new: still resumed (and still incomplete)
+    (bcalls, incompletes) = _splitCalls([callid], FileCheckpointStore(path))
+    assert(len(incompletes)==1 and incompletes[0].isConfirmedDialog())
+    assert(incompletes[0].getAllTransactions() == [])
+
+    set_test_data(rows)
+    (bcalls, incompletes) = _splitCalls([callid], FileCheckpointStore(path))
+    assert(len(bcalls)==1)
+    assert([t.id for t in bcalls[0].getAllTransactions()] == [10162L])
+
+    # same result as replaying all the rows
+    fcdr = bcalls[0].getFCdr()
+    assert(fcdr.s_total==9)
+    assert(fcdr.s_setup==3)
+    assert(fcdr.s_connected==6)
+    assert((fcdr.status, fcdr.last_rc, fcdr.c_to, fcdr.cp_node) == ('OK', 200, 'wds', ['g08']))
+    assert(len(bcalls[0].getErrCdrs())==1)
+
+    # complete calls are dropped from the store
+    assert(FileCheckpointStore(path).load([callid]) == {})
+
+
+def test_redis_checkpoint_keys():
+
+    class FakeRedis(object):
+        def __init__(self): self.d = {}
+        def mget(self, keys): return [self.d.get(k) for k in keys]
+        def pipeline(self, transaction=True): return self
+        def setex(self, k, v, ttl): self.d[k] = v
+        def execute(self): pass
+        def delete(self, *keys):
+            for k in keys: self.d.pop(k, None)
+
+    class FakeDB(object):
+        def __init__(self): self.r = FakeRedis()
+        def _redis(self): return self.r
+
+    store = RedisCheckpointStore()
+    store.db = FakeDB()
+
+    snap = {'v': CHECKPOINT_VERSION, 'lastid': 7}
+    store.save({'a@x': snap})
+
+    [key] = store.db.r.d.keys()
+    assert(key == _ckptKey('a@x') and len(key) == len(RedisCheckpointStore.PREFIX) + 16)
+    assert(store.load(['a@x', 'b@x']) == {'a@x': snap})
+
+    # another Call-Id's checkpoint under the same key is ignored
+    store.db.r.d[_ckptKey('b@x')] = store.db.r.d[key]
+    assert(store.load(['b@x']) == {})
+
+    store.delete(['a@x'])
+    assert(store.load(['a@x']) == {})
+
+
+def test_acc_tail(tmpdir):
+
+    class AccDB(object):
+        def __init__(self):
+            self.rows = []
+        def getMaxAccId(self):
+            return max([0] + [r[0] for r in self.rows])
+        def getAccIdsSince(self, lastid, limit=None):
+            return sorted(r for r in self.rows if r[0] > lastid)[:limit]
+
+    db = AccDB()
+    db.rows = [(1L, 'old@x')]
+    wmfile = str(tmpdir.join('wm'))
+
+    # no watermark: start at the end of the table
+    tail = AccTail(db, wmfile)
+    assert(tail.lastid == 1)
+    assert(open(wmfile).read().strip() == '1')
+
+    db.rows += [(2L, 'a@x'), (3L, 'b@x'), (4L, 'a@x')]
+    assert(tail.poll() == ['old@x', 'a@x', 'b@x'])  # overlap window is re-scanned once after a start
+
+    # not committed: the same calls come back
+    assert(tail.poll() == ['old@x', 'a@x', 'b@x'])
+    tail.commit()
+    assert(open(wmfile).read().strip() == '4')
+
+    # id 5 committed late, after 6 was already read
+    db.rows += [(6L, 'c@x')]
+    assert(tail.poll() == ['c@x'])
+    tail.commit()
+    db.rows += [(5L, 'b@x')]
+    assert(tail.poll() == ['b@x'])
+    tail.commit()
+    assert(tail.poll() == [])
+
+    assert(AccTail(db, wmfile).lastid == 6)
+
 # }}}
 ##########################################################################
 
@@ -870,6 +2671,17 @@ def cmdHelp(e=None):
     print " --dto     query acc table for calls that start earlier than date"
     print " --src_id  limit calls processed to this source (inbound customer) id"
     print " --limit   limit calls processed"
+    print " --workers process Call-Ids in N parallel worker processes"
+    print " --discovery  how to find the Call-Ids in the date range: index (default), id or distinct (see NetcallDB.iterCallIds)"
+    print " --daemon  run continuously, following the acc table by id instead of a date range"
+    print " --watermark  file holding the last acc.id processed in daemon mode (default %s)" % (DAEMON_WATERMARK)
+    print " --interval   seconds to sleep between daemon polls when idle (default %d)" % (DAEMON_INTERVAL)
+    print " --checkpoint file (or 'redis') to keep the state of incomplete calls in, so later runs resume them"
+    print " --stats   append a json record of per-stage timings and counters for each run to this file"
+    print " --stats-redis  also push the stats records to Redis (%s)" % (runstats.REDIS_KEY)
+    print " --pipeline  load, finalize and write calls concurrently (threads) instead of one stage after the other"
+    print " --lookback  hours: only load acc rows from --dfrom on, and look back this far just for calls that come"
+    print "             out incomplete (e.g. long calls that started before --dfrom); default: load all rows"
     sys.exit(-1)
 
 
@@ -885,10 +2697,20 @@ if __name__ == '__main__':
     p_dto   = None
     p_src_id = None   # 'vxb'
     p_limit = -1
+    p_workers = 1
+    p_discovery = None
+    p_daemon = False
+    p_watermark = DAEMON_WATERMARK
+    p_interval = DAEMON_INTERVAL
+    p_store = None
+    p_statsfile = None
+    p_statsredis = False
+    p_pipeline = False
+    p_lookback = None
 
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hv', ['dfrom=', 'dto=', 'limit=', 'src_id=', 'help', 'summary', 'verbose'])
+        opts, args = getopt.getopt(sys.argv[1:], 'hv', ['dfrom=', 'dto=', 'limit=', 'src_id=', 'workers=', 'discovery=', 'daemon', 'watermark=', 'interval=', 'checkpoint=', 'stats=', 'stats-redis', 'pipeline', 'lookback=', 'help', 'summary', 'verbose'])
 
     except getopt.GetoptError as e:
         cmdHelp(e)
@@ -908,6 +2730,40 @@ if __name__ == '__main__':
             if opt=='--limit':
                 p_limit = int(arg)
 
+            if opt=='--workers':
+                p_workers = int(arg)
+                if p_workers < 1:
+                    raise ValueError('--workers must be at least 1')
+
+            if opt=='--discovery':
+                if arg not in ('index', 'id', 'distinct'):
+                    raise ValueError('unknown --discovery mode ' + arg)
+                p_discovery = arg
+
+            if opt=='--daemon':
+                p_daemon = True
+            if opt=='--watermark':
+                p_watermark = arg
+            if opt=='--interval':
+                p_interval = float(arg)
+
+            if opt=='--stats':
+                p_statsfile = arg
+            if opt=='--stats-redis':
+                p_statsredis = True
+
+            if opt=='--pipeline':
+                p_pipeline = True
+
+            if opt=='--lookback':
+                p_lookback = timedelta(hours=float(arg))
+
+            if opt=='--checkpoint':
+                if arg == 'redis':
+                    p_store = RedisCheckpointStore()
+                else:
+                    p_store = FileCheckpointStore(arg)
+
             if opt=='--help' or opt=='-h':
                 cmdHelp()
 
@@ -919,6 +2775,14 @@ if __name__ == '__main__':
         cmdHelp(e)
 
 
+    if not openNanpaDB():
+        sys.exit(1)
+
+    if p_daemon:
+        run_daemon(netcall.NetcallDB(), p_watermark, p_interval, p_workers, p_store, p_statsfile, p_statsredis,
+                   p_pipeline)
+
+
     if not p_dto:
         p_dto = datetime.now() - timedelta(minutes=5)
 
@@ -936,22 +2800,19 @@ if __name__ == '__main__':
     #    range.  great, because we can do an easier query and not miss any long duration (or long setup) calls; the
     #    only thing you do is if you find an incomplete call, go back to an earlier time to search for the starting
     #    transactions.  Forget about Redis new Call-Id queue ... nice idea but it's adding unecessary complexity.
+    #    (that's --lookback, see _lookback; without it all acc rows of the Call-Ids are loaded)
 
 
-    callids = db.getCallIds(p_dfrom, p_dto, p_src_id, p_limit)
+    stats.reset()
 
-    log.debug("looking at %d distinct call-ids", len(callids))
+    with stats.timer('getCallIds'):
+        callids = db.getCallIds(p_dfrom, p_dto, p_src_id, p_limit, p_discovery)
+
+    log.info("looking at %d distinct call-ids (%d acc rows examined)", len(callids), db.rows_examined)
     if len(callids)==0:
         log.info("nothing to do, exiting")
         sys.exit(0)
 
-    (calls, incompletes) = process_cdrs(callids)
-
-    log.info("process_cdrs returned with %d complete and %d incomplete calls", len(calls), len(incompletes))
-
-    # Note: this script is only recording completed calls (has an invite plus a final dialog-ending response); failed
-    # branches stay in the acc table to be analyzed elsewhere.
-
     # Note: can ignore incompletes; any in-progress calls will be picked up in later date ranges
 
     # NOTE: race condition when a failed branch shows up as a complete call but in reality the switch is currently
@@ -960,11 +2821,31 @@ if __name__ == '__main__':
     # was the final one returned to the client, or 3) just run this script at a later time and the writeCallRecord()
     # below will simply clobber the previous erroneous record.
 
-    for call in calls:
+    (since, horizon) = (None, None)
+    if p_lookback is not None:
+        (since, horizon) = (p_dfrom, p_dfrom - p_lookback)
+
+    if p_workers > 1:
+        counts = record_calls_sharded(callids, p_workers, store=p_store, pipeline=p_pipeline, since=since,
+                                      horizon=horizon)
+    else:
+        counts = record_calls(callids, db, p_store, pipeline=p_pipeline, since=since, horizon=horizon)
 
-        db.writeCallRecord(call)
+    log.info("process_cdrs returned with %d complete and %d incomplete calls", counts['complete'], counts['incomplete'])
 
 
     t2 = time.time()
-    log.info("recorded calls in %.1f seconds", (t2-t1))
+    log.info("recorded %d calls (%d unchanged) in %.1f seconds", counts['written'], counts['unchanged'], (t2-t1))
+    log.info("number classification cache: %d hits, %d misses", counts['nc_hits'], counts['nc_misses'])
+
+    if p_statsfile or p_statsredis:
+        writeRunStats(counts, p_statsfile, p_statsredis, mode='cron', dfrom=str(p_dfrom), dto=str(p_dto),
+                      workers=p_workers, pipeline=p_pipeline)
+
+    if counts['no_fcdr']:
+        log.warning("%d complete calls had no F-Cdr to record", counts['no_fcdr'])
+
+    if counts['errors']:
+        log.error("%d calls could not be recorded", counts['errors'])
+        sys.exit(1)
 
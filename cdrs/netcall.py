@@ -13,21 +13,20 @@
 # test with py.test
 #
 # TODO
-#  - persistent db handle ... app handles exception on idle disconnect by server or should we? the former, probably.
 #  - Redis caching
 
 
 
-import sys, time, os, getopt, re
+import sys, time, os, getopt, re, hashlib, thread, threading
 import logging as log
-from struct import pack
+from struct import pack, unpack
 from datetime import datetime
 from datetime import timedelta
 
 import redis
 import MySQLdb
 
-import PhoneNumber, nccdr
+import PhoneNumber, nccdr, runstats
 
 
 
@@ -36,9 +35,46 @@ import PhoneNumber, nccdr
 
 
 
+# columns of netcall.calls written by writeCallRecord(s), in INSERT order
+CALLCOLS = ('c_from', 'c_from5', 'c_to', 'c_to5', 'rspcode', 'fstatus', 't_start', 't_confirm', 't_end', 's_setup',
+            's_connected', 's_connected_r', 's_total', 'anum', 'anum2', 'a_country', 'a_state', 'a_lata', 'a_ocn',
+            'a_jtype', 'bnum', 'b_lrn', 'b_country', 'b_state', 'b_lata', 'b_ocn', 'b_jtype', 'xstate', 'call_price',
+            'ruleid', 'ptgroup', 'cp_nodes')
+
+# ... plus the digest over them (see _callDigest)
+WRITECOLS = CALLCOLS + ('cdigest',)
+
+
+# md5 (16 bytes) over a calls row's values in CALLCOLS order: equal digests == nothing to write
+def _callDigest(values):
+
+    parts = []
+    for v in values:
+        if v is None:
+            parts.append('\x00')
+        elif isinstance(v, unicode):
+            parts.append(v.encode('utf8'))
+        else:
+            parts.append(str(v))
+
+    return hashlib.md5('\x1f'.join(parts)).digest()
+
+
+# Call-Id digests: cidHash is the md5 of a Call-Id (callids.cid_hash, indexed), cidKey its first 8 bytes as a 64 bit
+# int for compact keys in memory/Redis.  Neither is unique in theory, so whatever is found by one is checked against
+# the full Call-Id.
+def cidHash(callid):
+    if isinstance(callid, unicode):
+        callid = callid.encode('utf8')
+    return hashlib.md5(callid).digest()
+
+def cidKey(callid):
+    return unpack('>Q', cidHash(callid)[:8])[0]
+
+
 class NetcallDB():
 
-    DBHOST = 'localhost'  # run on a26 or a27 or point to haproxy (but beware of haproxy closing idle connections)
+    DBHOST = 'localhost'  # run on a26 or a27 or point to haproxy (idle connections it closes are replaced, see Connections)
     DBPORT = 3306
 
     os_dbuser = 'opensips'
@@ -54,44 +90,55 @@ class NetcallDB():
 
     TESTMODE = False
 
+    TXCHUNK = 1000    # Call-Ids per acc query in iterTxRows
+    FETCHSIZE = 5000  # rows per server-side cursor fetch
+    WRITEBATCH = 500  # calls per transaction in writeCallRecords
+
 
     def __init__(self):
 
-        self.os_conn = None
-        self.nc_conn = None
-        self.redis = None
+        self.autoinc_step = None     # id step of a multi-row INSERT, 0 if its ids aren't predictable (see _insertCallRows)
+        self.rows_examined = 0       # acc rows read by the last Call-Id discovery (see iterCallIds)
 
-    
-    # warning: one thread per connection
-    def _osc(self):
-        if not self.os_conn:
-            h = NetcallDB.DBHOST
-            p = NetcallDB.DBPORT
-            u = NetcallDB.os_dbuser
-            s = NetcallDB.os_dbpswd
-            n = NetcallDB.os_dbname
-            if NetcallDB.TESTMODE:
-                n = n + '_test'
-            self.os_conn = MySQLdb.connect(host=h, port=p, user=u, passwd=s, db=n);
-        return self.os_conn
-
-    # warning: one thread per connection
+
+    # connections come from the process-wide registry (see Connections), so NetcallDB objects are cheap and all
+    # the ones used by a thread share that thread's connections.
+
+    # opensips database; stream: the connection for streaming (server-side cursor) queries, which can't share a
+    # connection with other queries while a result is being read
+    def _osc(self, stream=False):
+        if stream:
+            return connections.get('os.stream', NetcallDB._connectOS)
+        return connections.get('os', NetcallDB._connectOS)
+
+    # netcall database
     def _ncc(self):
-        if not self.nc_conn:
-            h = NetcallDB.DBHOST
-            p = NetcallDB.DBPORT
-            u = NetcallDB.nc_dbuser
-            s = NetcallDB.nc_dbpswd
-            n = NetcallDB.nc_dbname
-            if NetcallDB.TESTMODE:
-                n = n + '_test'
-            self.nc_conn = MySQLdb.connect(host=h, port=p, user=u, passwd=s, db=n);
-        return self.nc_conn
+        return connections.get('nc', NetcallDB._connectNC)
 
     def _redis(self):
-        if not self.redis and not NetcallDB.TESTMODE:
-            self.redis = redis.Redis(host=NetcallDB.REDIS_H, port=NetcallDB.REDIS_P, db=0)
-        return self.redis
+        if NetcallDB.TESTMODE:
+            return None
+        return connections.get('redis', NetcallDB._connectRedis, shared=True)
+
+    @staticmethod
+    def _connectOS():
+        n = NetcallDB.os_dbname
+        if NetcallDB.TESTMODE:
+            n = n + '_test'
+        return MySQLdb.connect(host=NetcallDB.DBHOST, port=NetcallDB.DBPORT, user=NetcallDB.os_dbuser,
+                               passwd=NetcallDB.os_dbpswd, db=n)
+
+    @staticmethod
+    def _connectNC():
+        n = NetcallDB.nc_dbname
+        if NetcallDB.TESTMODE:
+            n = n + '_test'
+        return MySQLdb.connect(host=NetcallDB.DBHOST, port=NetcallDB.DBPORT, user=NetcallDB.nc_dbuser,
+                               passwd=NetcallDB.nc_dbpswd, db=n)
+
+    @staticmethod
+    def _connectRedis():
+        return redis.Redis(host=NetcallDB.REDIS_H, port=NetcallDB.REDIS_P, db=0)
 
 
     def testMode(self):
@@ -99,6 +146,18 @@ class NetcallDB():
         return NetcallDB.TESTMODE
 
 
+    # all queries go through here, so runstats can count database round trips
+    def _execute(self, cur, sql, args=None):
+
+        runstats.stats.count('db_queries')
+        try:
+            return cur.execute(sql, args)
+        except MySQLdb.OperationalError as e:
+            if e.args and e.args[0] in Connections.GONE:
+                connections.expire()  # health check (and reconnect) on next use
+            raise
+
+
 
     # query database for calls that *end* within dfrom/dto range.  Return dict with database
     # fields, plus a few extras we assemble here.  TODO: return cursor/iterator for UI pagers (or Java?).
@@ -123,7 +182,7 @@ class NetcallDB():
         #print sql, dfrom, dto
         #sys.exit(0)
 
-        cur.execute(sql, (dfrom, dto))
+        self._execute(cur, sql, (dfrom, dto))
 
         for c in cur.fetchall():
             calls.append(c)
@@ -134,7 +193,8 @@ class NetcallDB():
 
 
     # take netcall.Call object and write all the fields into the calls table.  If the record already exists, 
-    # delete and replace it.
+    # update it in place -- unless nothing changed (same cdigest), then nothing is written at all.
+    # returns True if a record was written, False if it was unchanged (or the call has no F-Cdr)
     def writeCallRecord(self, call):
 
         callid = call.callid
@@ -145,7 +205,7 @@ class NetcallDB():
 
         if not cdr:
             log.error('nothing to record! no fcdr.  why is that? call=%s', call)
-            return
+            return False
 
         # Note: python mysql automatically begins a new transaction when cursor is first used.
         ncc = self._ncc()
@@ -153,80 +213,41 @@ class NetcallDB():
 
         try:
 
-            # check/delete existing row for Call-Id
-            cur.execute("SELECT calls_id from callids2calls WHERE callid_id='%s'" % (cid))
+            calldata = self._callRecordData(cdr)
+
+            # check for existing row for Call-Id
+            self._execute(cur, "SELECT C.id, C.cdigest FROM callids2calls IC, calls C WHERE IC.calls_id=C.id AND IC.callid_id=%s", (cid,))
             h = cur.fetchone()
-            if h:
-                cur.execute("DELETE FROM calls WHERE id=%s", h['calls_id'])
-                log.debug('netcall.calls: will clobber previous record for %s', callid)
-
-
-            # create data to insert into calls table
-
-            c_from = '?'
-            c_from5 = '?'
-            if cdr.c_from:
-                c_from = cdr.c_from
-                c_from5 = getCustomerObject(cdr.c_from).code5
-
-            c_to5 = None
-            if cdr.c_to:
-                c_to5 = getTerminatorObject(cdr.c_to).code5
-
-
-            # insert new row, get id
-
-            calldata = {
-
-                'c_from':        c_from,
-                'c_from5':       c_from5,
-                'c_to':          cdr.c_to,
-                'c_to5':         c_to5,
-                'rspcode':       cdr.last_rc,
-                'fstatus':       cdr.status,
-                't_start':       cdr.t_start,
-                't_confirm':     cdr.t_confirm,
-                't_end':         cdr.t_end,
-                's_setup':       cdr.s_setup,
-                's_connected':   cdr.s_connected,
-                's_connected_r': cdr.s_connected_r,
-                's_total':       cdr.s_total,
-                'anum':          cdr.anum,
-                'anum2':         cdr.anum2,
-                'a_country':     cdr.a_country,
-                'a_state':       cdr.a_state,
-                'a_lata':        cdr.a_lata,
-                'a_ocn':         cdr.a_ocn,
-                'a_jtype':       cdr.a_jtype,
-                'bnum':          cdr.bnum,
-                'b_lrn':         cdr.b_lrn,
-                'b_country':     cdr.b_country,
-                'b_state':       cdr.b_state,
-                'b_lata':        cdr.b_lata,
-                'b_ocn':         cdr.b_ocn,
-                'b_jtype':       cdr.b_jtype,
-                'xstate':        cdr.xstate,
-                'call_price':    cdr.call_price,
-                'ruleid':        cdr.ruleid,
-                'ptgroup':       cdr.ptgroup,
-                'cp_nodes':      ','.join(cdr.cp_node),
-            }
-
-            cdkeys = calldata.keys()
-            cdvals = calldata.values()
-
-            sql = 'INSERT INTO calls (' + ','.join(cdkeys) + ')'
-            sql += ' VALUES (' + ','.join( ['%s'] * len(cdkeys) ) + ')'
-
-            cur.execute(sql, cdvals)
-
-            calls_id = ncc.insert_id()
-
-            # insert new row in callids2calls table
-            cur.execute("INSERT INTO callids2calls (callid_id, calls_id) VALUES (%s,%s)", (cid, calls_id))
+
+            written = True
+
+            if h and h['cdigest'] == calldata['cdigest']:
+                runstats.stats.count('calls_unchanged')
+                written = False
+
+            elif h:
+                sql = 'UPDATE calls SET ' + ','.join([k + '=%s' for k in WRITECOLS]) + ' WHERE id=%s'
+                self._execute(cur, sql, [calldata[k] for k in WRITECOLS] + [h['id']])
+                log.debug('netcall.calls: updated previous record for %s', callid)
+                runstats.stats.count('calls_updated')
+
+            else:
+                # insert new row, get id
+                sql = 'INSERT INTO calls (' + ','.join(WRITECOLS) + ')'
+                sql += ' VALUES (' + ','.join( ['%s'] * len(WRITECOLS) ) + ')'
+
+                self._execute(cur, sql, [calldata[k] for k in WRITECOLS])
+
+                calls_id = ncc.insert_id()
+
+                # insert new row in callids2calls table
+                self._execute(cur, "INSERT INTO callids2calls (callid_id, calls_id) VALUES (%s,%s)", (cid, calls_id))
+                runstats.stats.count('calls_inserted')
 
             ncc.commit()
 
+            return written
+
         except MySQLdb.Error as e:
             log.error('problem with call %s', callid)
             log.error(e)
@@ -239,69 +260,461 @@ class NetcallDB():
 
 
 
+    # column values for the calls table (see WRITECOLS) from the F-Cdr of a call
+    def _callRecordData(self, cdr):
+
+        c_from = '?'
+        c_from5 = '?'
+        if cdr.c_from:
+            c_from = cdr.c_from
+            c_from5 = getCustomerObject(cdr.c_from).code5
+
+        c_to5 = None
+        if cdr.c_to:
+            c_to5 = getTerminatorObject(cdr.c_to).code5
+
+        calldata = {
+
+            'c_from':        c_from,
+            'c_from5':       c_from5,
+            'c_to':          cdr.c_to,
+            'c_to5':         c_to5,
+            'rspcode':       cdr.last_rc,
+            'fstatus':       cdr.status,
+            't_start':       cdr.t_start,
+            't_confirm':     cdr.t_confirm,
+            't_end':         cdr.t_end,
+            's_setup':       cdr.s_setup,
+            's_connected':   cdr.s_connected,
+            's_connected_r': cdr.s_connected_r,
+            's_total':       cdr.s_total,
+            'anum':          cdr.anum,
+            'anum2':         cdr.anum2,
+            'a_country':     cdr.a_country,
+            'a_state':       cdr.a_state,
+            'a_lata':        cdr.a_lata,
+            'a_ocn':         cdr.a_ocn,
+            'a_jtype':       cdr.a_jtype,
+            'bnum':          cdr.bnum,
+            'b_lrn':         cdr.b_lrn,
+            'b_country':     cdr.b_country,
+            'b_state':       cdr.b_state,
+            'b_lata':        cdr.b_lata,
+            'b_ocn':         cdr.b_ocn,
+            'b_jtype':       cdr.b_jtype,
+            'xstate':        cdr.xstate,
+            'call_price':    cdr.call_price,
+            'ruleid':        cdr.ruleid,
+            'ptgroup':       cdr.ptgroup,
+            'cp_nodes':      ','.join(cdr.cp_node),
+        }
+
+        calldata['cdigest'] = _callDigest([calldata[k] for k in CALLCOLS])
+
+        return calldata
+
+
+    # bulk version of writeCallRecord: per batch of WRITEBATCH calls, the Call-Id ids are resolved with a few
+    # IN()/multi-row queries, the digests of existing records are read in one query, unchanged records are skipped,
+    # changed ones are updated in place with one multi-row upsert, new calls and their callids2calls rows are written
+    # with multi-row INSERTs, and there is a single commit.  If a batch fails it is rolled back and retried one call at a
+    # time with writeCallRecord, so a bad record only costs itself.
+    # returns (number of calls written, number unchanged, list of calls that failed, list of calls without an F-Cdr)
+    def writeCallRecords(self, calls, batchsize=None):
+
+        if not batchsize:
+            batchsize = NetcallDB.WRITEBATCH
+
+        # one record per Call-Id (last one wins, as with repeated writeCallRecord calls)
+        bycid = {}
+        nofcdr = []
+        for call in calls:
+            if not call.getFCdr():
+                log.error('nothing to record! no fcdr.  why is that? call=%s', call)
+                nofcdr.append(call)
+                continue
+            bycid[call.callid] = call
+        calls = [c for c in calls if bycid.get(c.callid) is c]
+
+        nwritten = 0
+        nunchanged = 0
+        failed = []
+
+        for i in range(0, len(calls), batchsize):
+
+            batch = calls[i:i+batchsize]
+
+            try:
+                n = self._writeCallRecordBatch(batch)
+                nwritten += len(batch) - n
+                nunchanged += n
+
+            except MySQLdb.Error as e:
+                log.error('problem writing a batch of %d calls, retrying one at a time: %s', len(batch), e)
+
+                for call in batch:
+                    try:
+                        if self.writeCallRecord(call):
+                            nwritten += 1
+                        else:
+                            nunchanged += 1
+                    except MySQLdb.Error:
+                        failed.append(call)
+
+        return (nwritten, nunchanged, failed, nofcdr)
+
+
+    # returns the number of unchanged (not written) calls
+    def _writeCallRecordBatch(self, calls):
+
+        ncc = self._ncc()
+        cur = ncc.cursor(MySQLdb.cursors.DictCursor)
+
+        try:
+
+            cids = self._getOrMakeIdsFromCallIds(cur, [call.callid for call in calls])
+            ids = [cids.get(call.callid) for call in calls]
+            if None in ids:
+                # Call-Id came back different from the callids table (collation); writeCallRecord copes
+                raise MySQLdb.Error('Call-Id not found in callids after insert')
+
+            # existing records for these Call-Ids
+            inlist = ','.join(['%s'] * len(ids))
+            self._execute(cur, "SELECT IC.callid_id, C.id, C.cdigest FROM callids2calls IC, calls C WHERE IC.calls_id=C.id"
+                               " AND IC.callid_id IN (" + inlist + ")", ids)
+            existing = {}
+            for h in cur.fetchall():
+                existing.setdefault(h['callid_id'], h)
+
+            newrows = []
+            newids = []
+            changed = []  # (calls.id, row)
+
+            for (cid, call) in zip(ids, calls):
+
+                calldata = self._callRecordData(call.getFCdr())
+                row = [calldata[k] for k in WRITECOLS]
+                h = existing.get(cid)
+
+                if not h:
+                    newrows.append(row)
+                    newids.append(cid)
+                elif h['cdigest'] != calldata['cdigest']:
+                    changed.append((h['id'], row))
+
+            nunchanged = len(calls) - len(newrows) - len(changed)
+            runstats.stats.count('calls_unchanged', nunchanged)
+
+            if changed:
+                # rewrite in place: id is the primary key, so every row takes the UPDATE branch
+                args = []
+                for (id, row) in changed:
+                    args.append(id)
+                    args.extend(row)
+                sql = 'INSERT INTO calls (id,' + ','.join(WRITECOLS) + ') VALUES '
+                sql += ','.join(['(' + ','.join(['%s'] * (len(WRITECOLS)+1)) + ')'] * len(changed))
+                sql += ' ON DUPLICATE KEY UPDATE ' + ','.join(['%s=VALUES(%s)' % (k, k) for k in WRITECOLS])
+                self._execute(cur, sql, args)
+                runstats.stats.count('calls_updated', len(changed))
+
+            if newrows:
+                calls_ids = self._insertCallRows(cur, newrows)
+
+                args = []
+                for (cid, calls_id) in zip(newids, calls_ids):
+                    args.extend((cid, calls_id))
+                self._execute(cur, "INSERT INTO callids2calls (callid_id, calls_id) VALUES " + ','.join(['(%s,%s)'] * len(newids)), args)
+                runstats.stats.count('calls_inserted', len(newrows))
+
+            ncc.commit()
+
+            return nunchanged
+
+        except MySQLdb.Error:
+            ncc.rollback()
+            raise
+
+        finally:
+            cur.close()
+
+
+    # insert rows (value lists in WRITECOLS order) into calls, return their ids.  A multi-row INSERT is only used when
+    # the server hands it a predictable run of auto_increment ids (innodb_autoinc_lock_mode 0 or 1): the first one
+    # from insert_id(), then every auto_increment_increment (not 1 on the a26/a27 multi-master setup, which uses
+    # increment/offset).  Otherwise one INSERT per row (still in the caller's transaction).
+    def _insertCallRows(self, cur, rows):
+
+        ncc = self._ncc()
+
+        if self.autoinc_step is None:
+            self._execute(cur, "SELECT @@innodb_autoinc_lock_mode AS m, @@auto_increment_increment AS inc")
+            h = cur.fetchone()
+            self.autoinc_step = int(h['inc']) if int(h['m']) in (0, 1) else 0
+
+        row_sql = '(' + ','.join(['%s'] * len(WRITECOLS)) + ')'
+        sql = 'INSERT INTO calls (' + ','.join(WRITECOLS) + ') VALUES '
+
+        if self.autoinc_step:
+            args = []
+            for r in rows:
+                args.extend(r)
+            self._execute(cur, sql + ','.join([row_sql] * len(rows)), args)
+            first = ncc.insert_id()  # id of the first row of a multi-row insert
+            return range(first, first + len(rows) * self.autoinc_step, self.autoinc_step)
+
+        ids = []
+        for r in rows:
+            self._execute(cur, sql + row_sql, r)
+            ids.append(ncc.insert_id())
+        return ids
+
+
 
     # query opensips acc table for transactions matching Call-Id values.  Ensure
     # that transactions are returned in order (sort by auto incremented primary key,
     # which is done already but I want to be explicit because it's critical).
-    # TODO will eventually need to use cursors and an iterator to return instead of loading it all into ram at once
+    # note: loads everything into ram at once; see iterTxRows
     def getTxRows(self, callids=[]):
 
-        rdata = []
+        return list(self.iterTxRows(callids))
+
+
+    # stream acc transactions for Call-Id values: one SELECT per chunk of Call-Ids (instead of one per Call-Id),
+    # read through a server-side cursor so rows aren't buffered.  Rows come back grouped by callid and, within a
+    # Call-Id, in the order the dialog state machine needs them: prtime (or time if acc left prtime empty), then
+    # time, then id.
+    # afterids: optional dict of Call-Id -> acc.id; only rows with a higher id are returned for those Call-Ids (used
+    # to resume calls from a checkpoint).  Each (callid=?, id>?) term is a range on callid_idx, which carries the id.
+    # since: optional datetime; only rows with a time from then on are returned for the other Call-Ids (the rows
+    #        are still found through callid_idx, not a range scan on the time index)
+    # stream: False to read the rows through a buffered cursor on the regular os connection, e.g. for a small query
+    #         while another iterTxRows is still streaming
+    # warning: the os.stream connection is busy until the generator is exhausted (or closed).
+    def iterTxRows(self, callids=[], chunksize=None, afterids=None, since=None, stream=True):
+
+        if not chunksize:
+            chunksize = NetcallDB.TXCHUNK
+
+        callids = list(callids)
+
+        for i in range(0, len(callids), chunksize):
+
+            chunk = callids[i:i+chunksize]
+
+            args = [cid for cid in chunk if not afterids or cid not in afterids]
+            terms = []
+            if args:
+                if since is None:
+                    terms.append("callid IN (" + ','.join(['%s'] * len(args)) + ")")
+                else:
+                    terms.append("(callid IN (" + ','.join(['%s'] * len(args)) + ") AND time>=%s)")
+                    args.append(since)
+            for cid in chunk:
+                if afterids and cid in afterids:
+                    terms.append("(callid=%s AND id>%s)")
+                    args.extend((cid, afterids[cid]))
+
+            sql = "SELECT * from acc"
+            if since is not None:
+                sql += " FORCE INDEX (callid_idx)"
+            sql += " WHERE (" + ' OR '.join(terms) + ") AND dst_id=dst_id2"
+            sql += " ORDER BY callid, IF(prtime IS NULL OR prtime='0000-00-00 00:00:00', time, prtime), time, id"
+
+            if stream:
+                cur = self._osc(True).cursor(MySQLdb.cursors.SSDictCursor)
+            else:
+                cur = self._osc().cursor(MySQLdb.cursors.DictCursor)
+
+            try:
+                self._execute(cur, sql, args)
+
+                while True:
+                    rows = cur.fetchmany(NetcallDB.FETCHSIZE)
+                    runstats.stats.count('db_fetches')
+                    if not rows:
+                        break
+                    for r in rows:
+                        yield r
+
+            finally:
+                cur.close()
+
+    # query acc table for distinct list of Call-Ids with a transaction (request or response) in the date range;
+    # see iterCallIds for mode.  The number of acc rows (index entries) the server read for the discovery queries
+    # is left in self.rows_examined.
+    def getCallIds(self, dfrom, dto, src_id=None, limit=None, mode=None):
+
+        return list(self.iterCallIds(dfrom, dto, src_id, limit, mode))
+
+
+    # stream de-duplicated Call-Ids with a transaction in [dfrom, dto).  mode:
+    #
+    #  'index'     (default) one query per indexed column -- prtime range on acc_idx_prtime, then time range on
+    #              acc_idx_time -- instead of an OR over both, which MySQL can't do with either index; no DISTINCT
+    #              (and its temporary table) either, Call-Ids are de-duplicated here as they stream in.
+    #  'id'        find the acc.id range covering the window with 4 single-row index lookups, then scan that
+    #              primary key range with the date filter (best when the window is most of what's in that id range)
+    #  'distinct'  the original SELECT DISTINCT ... OR ... query
+    #
+    # rows examined are taken from the session's Handler_read_* counters (also counted in runstats)
+    def iterCallIds(self, dfrom, dto, src_id=None, limit=None, mode=None):
+
+        if limit is None or limit < 0:
+            limit = None
+
+        mode = mode or 'index'
+
+        srcsql = ''
+        srcargs = ()
+        if src_id:
+            srcsql = " AND src_id=%s"
+            srcargs = (src_id,)
+
+        if mode == 'index':
+            queries = [("SELECT callid FROM acc FORCE INDEX (acc_idx_prtime) WHERE prtime >= %s AND prtime < %s" + srcsql,
+                        (dfrom, dto) + srcargs),
+                       ("SELECT callid FROM acc FORCE INDEX (acc_idx_time) WHERE time >= %s AND time < %s" + srcsql,
+                        (dfrom, dto) + srcargs)]
+
+        elif mode == 'id':
+            (lo, hi) = self._accIdRange(dfrom, dto)
+            if lo is None:
+                queries = []
+            else:
+                queries = [("SELECT callid FROM acc WHERE id >= %s AND id <= %s"
+                            " AND ((prtime >= %s AND prtime < %s) OR (time >= %s AND time < %s))" + srcsql,
+                            (lo, hi, dfrom, dto, dfrom, dto) + srcargs)]
+
+        elif mode == 'distinct':
+            sql = "SELECT distinct(callid) AS callid from acc WHERE ((prtime >= %s AND prtime < %s) OR (time >= %s AND time < %s))" + srcsql
+            if limit:
+                sql += " LIMIT %d" % (limit)
+            queries = [(sql, (dfrom, dto, dfrom, dto) + srcargs)]
+
+        else:
+            raise ValueError('unknown Call-Id discovery mode %s' % (mode))
+
+        # rows examined: Handler_read_* deltas around each query alone, less what the SHOW itself reads (measured by
+        # two SHOWs in a row), so neither the SHOWs nor other queries on the session in between are counted
+        self.rows_examined = 0
+        r0 = self._handlerReads()
+        r1 = self._handlerReads()
+        show = r1 - r0
+
+        seen = set()
+
+        try:
+            for (sql, args) in queries:
+
+                if r1 is None:
+                    r1 = self._handlerReads()
+
+                cur = self._osc(True).cursor(MySQLdb.cursors.SSCursor)
+
+                try:
+                    self._execute(cur, sql, args)
+
+                    while True:
+                        rows = cur.fetchmany(NetcallDB.FETCHSIZE)
+                        runstats.stats.count('db_fetches')
+                        if not rows:
+                            break
+
+                        for (cid,) in rows:
+                            if cid in seen:
+                                continue
+                            seen.add(cid)
+                            yield cid
+
+                            if limit and len(seen) >= limit:
+                                return
+
+                finally:
+                    cur.close()  # reads (and discards) the rest of an unfinished result
+                    self.rows_examined += max(self._handlerReads() - r1 - show, 0)
+                    r1 = None
+
+        finally:
+            runstats.stats.count('acc_rows_examined', self.rows_examined)
+            log.debug('Call-Id discovery (%s): %d distinct Call-Ids, %d acc rows examined', mode, len(seen), self.rows_examined)
+
+
+    # smallest and largest acc.id with prtime or time in [dfrom, dto) -- (None, None) if there are none.  Each bound is
+    # an ORDER BY ... LIMIT 1 on one of the date indexes.
+    def _accIdRange(self, dfrom, dto):
 
         cur = self._osc().cursor(MySQLdb.cursors.DictCursor)
 
-        for cid in callids:
+        ids = []
+        for col in ('prtime', 'time'):
+            for order in ('ASC', 'DESC'):
+                sql = "SELECT id FROM acc WHERE %s >= %%s AND %s < %%s ORDER BY %s %s, id %s LIMIT 1" % (col, col, col, order, order)
+                self._execute(cur, sql, (dfrom, dto))
+                h = cur.fetchone()
+                if h:
+                    ids.append(h['id'])
+
+        cur.close()
+
+        if not ids:
+            return (None, None)
+
+        return (min(ids), max(ids))
 
-            cur.execute("SELECT * from acc WHERE callid='%s' AND dst_id=dst_id2 ORDER BY id ASC" % (cid))
-            h = cur.fetchall()
-            rdata.extend(h)
 
+    # sum of the streaming session's Handler_read_* status counters: rows (index entries) the server has read
+    def _handlerReads(self):
+
+        cur = self._osc(True).cursor(MySQLdb.cursors.Cursor)
+        self._execute(cur, "SHOW SESSION STATUS LIKE 'Handler_read%'")
+        n = sum(long(v) for (k, v) in cur.fetchall())
         cur.close()
 
-        return rdata
+        return n
 
-    # query acc table for distinct list of Call-Ids
-    # TODO will eventually need to use cursors and an iterator to return instead of loading it all into ram at once
-    def getCallIds(self, dfrom, dto, src_id=None, limit=None):
 
-        cids = []
 
-        if not limit:
-            limit = -1
+    # highest acc.id so far (0 if the table is empty)
+    def getMaxAccId(self):
 
         cur = self._osc().cursor(MySQLdb.cursors.DictCursor)
+        self._execute(cur, "SELECT MAX(id) AS maxid FROM acc")
+        h = cur.fetchone()
+        cur.close()
+        self._osc().commit()  # end the read snapshot so the next query sees new rows
 
-        sql = "SELECT distinct(callid) from acc WHERE "
-        sql += " ((prtime >= '%s' AND prtime < '%s') OR (time >= '%s' AND time < '%s'))"
-        if src_id:
-            sql += " AND src_id='%s'" % (src_id)
-        if limit >= 0:
-            sql += " LIMIT %d" % (limit)
+        return long(h['maxid'] or 0)
 
-        sql = sql % (dfrom,dto,dfrom,dto)
 
-        cur.execute(sql)
-        for cid in cur.fetchall():
-            cids.append(cid['callid'])
+    # acc (id, callid) pairs with id > lastid in id order, at most limit rows: a range scan on the primary key for
+    # tailing the table.  Ends the read transaction afterwards; with REPEATABLE READ a long-running reader would
+    # otherwise never see rows inserted after its first query.
+    def getAccIdsSince(self, lastid, limit=None):
 
-        cur.close() # needed?
+        sql = "SELECT id, callid FROM acc WHERE id > %s ORDER BY id"
+        if limit:
+            sql += " LIMIT %d" % (limit)
 
-        return cids
+        cur = self._osc().cursor(MySQLdb.cursors.DictCursor)
+        self._execute(cur, sql, (lastid,))
+        rows = [(long(h['id']), h['callid']) for h in cur.fetchall()]
+        cur.close()
+        self._osc().commit()
 
+        return rows
 
 
     ####
 
 
-    # return primary key (int) from netcall.callids table for given Call-Id.
+    # return primary key (int) from netcall.callids table for given Call-Id, through the cid_hash index (every row
+    # has its hash, see db/netcall-cidhash.sql), or None
     def _getIdFromCallId(self, nccursor, callid):
 
-        # TODO redis cache
-
-        nccursor.execute("SELECT id FROM callids WHERE callid=%s", (callid))
-        h = nccursor.fetchone()
-
-        if h: return h['id']
+        self._execute(nccursor, "SELECT id, callid FROM callids FORCE INDEX (callids_hash) WHERE cid_hash=%s", (cidHash(callid),))
+        for h in nccursor.fetchall():
+            if h['callid'] == callid:
+                return h['id']
 
         return None
 
@@ -309,8 +722,6 @@ class NetcallDB():
     # this creates/commits its own tx, so careful to call this before using another cursor.
     def _getOrMakeIdFromCallId(self, callid):
 
-        # TODO lock callids table to avoid race condition
-
         ncc = self._ncc()
         cur = ncc.cursor(MySQLdb.cursors.DictCursor)
 
@@ -320,11 +731,19 @@ class NetcallDB():
 
             if cid: return cid
 
-            cur.execute("INSERT INTO callids (callid) VALUES (%s)", (callid))
+            # IGNORE: another process may have added it in the meantime (or it's there in another case)
+            self._execute(cur, "INSERT IGNORE INTO callids (callid, cid_hash) VALUES (%s,%s)", (callid, cidHash(callid)))
 
-            cid = ncc.insert_id()
-
-            # TODO redis cache
+            if cur.rowcount == 1:
+                cid = ncc.insert_id()
+            else:
+                cid = self._getIdFromCallId(cur, callid)
+                if not cid:
+                    # only here can the hash miss a stored row: a Call-Id that differs in case only (the same to
+                    # the callid collation and its UNIQUE KEY), so look the full string up
+                    self._execute(cur, "SELECT id FROM callids WHERE callid=%s", (callid,))
+                    h = cur.fetchone()
+                    cid = h and h['id']
 
             ncc.commit()
 
@@ -340,44 +759,105 @@ class NetcallDB():
 
 
 
+    # bulk _getOrMakeIdFromCallId, in the caller's transaction: returns dict of Call-Id -> callids.id, inserting
+    # the missing ones.  INSERT IGNORE covers another process adding the same Call-Id in the meantime.
+    def _getOrMakeIdsFromCallIds(self, cur, callids):
+
+        ids = {}
+
+        def byHash(cids):
+            hashes = dict((cidHash(cid), cid) for cid in cids)
+            self._execute(cur, "SELECT id, callid, cid_hash FROM callids FORCE INDEX (callids_hash) WHERE cid_hash IN (" +
+                          ','.join(['%s'] * len(hashes)) + ")", hashes.keys())
+            for h in cur.fetchall():
+                cid = hashes.get(h['cid_hash'])
+                if cid == h['callid']:
+                    ids[cid] = h['id']
+
+        # Call-Ids that differ from a stored one in case only (see _getOrMakeIdFromCallId)
+        def byString(cids):
+            lower = dict((cid.lower(), cid) for cid in cids)
+            self._execute(cur, "SELECT id, callid FROM callids WHERE callid IN (" + ','.join(['%s'] * len(cids)) + ")", cids)
+            for h in cur.fetchall():
+                cid = lower.get(h['callid'].lower())
+                if cid:
+                    ids[cid] = h['id']
+
+        byHash(callids)
+
+        missing = [cid for cid in callids if cid not in ids]
+        if missing:
+            args = []
+            for cid in missing:
+                args.extend((cid, cidHash(cid)))
+            self._execute(cur, "INSERT IGNORE INTO callids (callid, cid_hash) VALUES " + ','.join(['(%s,%s)'] * len(missing)), args)
+            byHash(missing)
+
+        missing = [cid for cid in callids if cid not in ids]
+        if missing:
+            byString(missing)
+
+        return ids
+
+
+
     #
     # It should be guaranteed that there will always be a valid ptgroup & corresponding price
     # to look up: opensips will only match an lcr rule based on group, and for every lcr rule in dr_rules_cp table
     # there is a fk constraint 
+    #
+    # Prices come from the in-process snapshot (priceTable, see PriceTable), so this is normally a dict lookup.
     def getRoutePrice(self, ptgroup, ruleid):
 
+        runstats.stats.count('price_lookups')
+        with runstats.stats.timer('price'):
+            return self._getRoutePrice(ptgroup, ruleid)
+
+    def _getRoutePrice(self, ptgroup, ruleid):
+
         if NetcallDB.TESTMODE:
             return 0.00159
 
-        # check Redis cache first
-        rck = 'pt.'+str(ptgroup)+'.'+str(ruleid)
-        rp = self._redis().get(rck)
+        return priceTable.getPrice(ptgroup, ruleid)
 
-        if rp:
-            if rp != 'n/a':
-                return float(rp)
-            else:
-                return None
 
+    # {ruleid: mprice} for all the rules of a price table (mprice None if not set)
+    def getPriceTable(self, ptgroup):
 
         cur = self._ncc().cursor(MySQLdb.cursors.DictCursor)
 
-        cur.execute("SELECT mprice FROM price_tables WHERE ruleid=%s and ptgroup=%s",  (ruleid, ptgroup))
+        self._execute(cur, "SELECT ruleid, mprice FROM price_tables WHERE ptgroup=%s", (ptgroup,))
+        prices = dict((h['ruleid'], _price(h['mprice'])) for h in cur.fetchall())
+
+        cur.close()
+        self._ncc().commit()  # don't keep a (repeatable read) snapshot open for the next load
+
+        return prices
+
+    # mprice for one rule, None if there is none
+    def getPrice(self, ptgroup, ruleid):
+
+        cur = self._ncc().cursor(MySQLdb.cursors.DictCursor)
+
+        self._execute(cur, "SELECT mprice FROM price_tables WHERE ruleid=%s and ptgroup=%s", (ruleid, ptgroup))
         h = cur.fetchone()
 
         cur.close()
+        self._ncc().commit()
 
-        if h:
-            rp = h['mprice']
-            PTEXPIRE = 864000 # 10 days
-            self._redis().setex(rck, rp, PTEXPIRE)
-            return float(rp)
+        return h and _price(h['mprice'])
 
-        else:
-            rp = 'n/a'
-            PTEXPIRE = 864000 # 10 days
-            self._redis().setex(rck, rp, PTEXPIRE)
-            return None
+    # call after changing rows of price table ptgroup, so running processes reload it (see PriceTable)
+    def priceTableChanged(self, ptgroup):
+
+        r = self._redis()
+        if not r:
+            return
+
+        pipe = r.pipeline(transaction=False)
+        pipe.hincrby(PriceTable.VERSIONS, ptgroup, 1)
+        pipe.publish(PriceTable.CHANNEL, ptgroup)
+        pipe.execute()
 
 
 
@@ -395,7 +875,7 @@ class NetcallDB():
             return None
 
 
-        cur.execute("SELECT P.ts1,P.ts2,P.src_ip,P.pcap FROM pcaps P WHERE P.callid_id=%s", (cid))
+        self._execute(cur, "SELECT P.ts1,P.ts2,P.src_ip,P.pcap FROM pcaps P WHERE P.callid_id=%s", (cid))
         h = cur.fetchone()
 
         cur.close()
@@ -422,14 +902,14 @@ class NetcallDB():
 
         cur = self._ncc().cursor(MySQLdb.cursors.DictCursor)
 
-        cur.execute("SELECT callid_id FROM pcaps WHERE callid_id=%s", (cid))
+        self._execute(cur, "SELECT callid_id FROM pcaps WHERE callid_id=%s", (cid))
         h = cur.fetchone()
 
         if h:
-            cur.execute("UPDATE pcaps SET ts1=%s,ts2=%s,src_ip=%s,pcap=%s WHERE callid_id=%s", (ts1, ts2, src_ip, pcapblob, cid))
+            self._execute(cur, "UPDATE pcaps SET ts1=%s,ts2=%s,src_ip=%s,pcap=%s WHERE callid_id=%s", (ts1, ts2, src_ip, pcapblob, cid))
 
         else:
-            cur.execute("INSERT INTO pcaps (callid_id,ts1,ts2,src_ip,pcap) VALUES (%s,%s,%s,%s,%s)", (cid, ts1, ts2, src_ip, pcapblob))
+            self._execute(cur, "INSERT INTO pcaps (callid_id,ts1,ts2,src_ip,pcap) VALUES (%s,%s,%s,%s,%s)", (cid, ts1, ts2, src_ip, pcapblob))
 
         self._ncc().commit()
 
@@ -440,6 +920,269 @@ class NetcallDB():
 
 
 
+###############################################################################
+# {{{ class Connections: process-wide registry of database connections
+#
+# MySQLdb connections mustn't be used by more than one thread, so each thread gets its own connection of each kind
+# ('os', 'os.stream', 'nc'), reused by every NetcallDB in that thread; a Redis client is thread safe (it has its own
+# connection pool) and shared by all threads.  Connections are keyed by pid too, so a forked worker makes its own
+# and leaves the parent's alone.  Leaving alone means never letting go of them: when the child's last reference to
+# an inherited MySQLdb connection goes, its dealloc sends COM_QUIT on the socket the parent is still using.  So the
+# child parks them (and anything else holding them, see keep()) in a list that is never freed.
+#
+# A connection that has been idle for more than PING_IDLE seconds (haproxy and the server close idle connections)
+# is pinged before it's handed out, and replaced if it's dead; same after a query failed with 'server has gone
+# away'.  Connections of threads that have exited are closed when a new connection is made.
+
+class Connections(object):
+    'per process, per thread database connections shared by all NetcallDB objects'
+
+    PING_IDLE = 60      # seconds
+    GONE = (2006, 2013)  # MySQL server has gone away, lost connection during query
+
+    def __init__(self):
+        self.conns = {}  # (pid, thread ident or None if shared, kind) -> [connection, last used]
+        self.inherited = []  # connections (and objects holding some) of the process we were forked from
+        self.lock = threading.Lock()
+
+
+    # the connection of this kind for this thread (shared: for this process), made with connect() if needed
+    def get(self, kind, connect, shared=False):
+
+        key = (os.getpid(), None if shared else thread.get_ident(), kind)
+        now = time.time()
+
+        e = self.conns.get(key)
+
+        if e and not shared and now - e[1] > Connections.PING_IDLE and not _alive(e[0]):
+            log.info('reconnecting %s database connection', kind)
+            runstats.stats.count('db_reconnects')
+            self._close(e[0])
+            e = None
+
+        if not e:
+            self._prune()
+            runstats.stats.count('db_connects')
+            e = [connect(), now]
+            with self.lock:
+                self.conns[key] = e
+
+        e[1] = now
+        return e[0]
+
+    # use conn as this thread's connection of this kind (tests)
+    def set(self, kind, conn):
+        with self.lock:
+            self.conns[(os.getpid(), thread.get_ident(), kind)] = [conn, time.time()]
+
+    # health check this thread's connections on next use
+    def expire(self):
+        key = (os.getpid(), thread.get_ident())
+        for (k, e) in self.conns.items():
+            if k[:2] == key:
+                e[1] = 0
+
+    # close this thread's connections
+    def close(self):
+        key = (os.getpid(), thread.get_ident())
+        with self.lock:
+            for k in [k for k in self.conns if k[:2] == key]:
+                self._close(self.conns.pop(k)[0])
+
+
+    # keep objects holding connections of the parent process referenced forever (in a forked child)
+    def keep(self, *objs):
+        with self.lock:
+            self.inherited.extend(objs)
+
+    # park connections of other processes (forked from: don't close them, don't free them) and close those of
+    # threads that have exited
+    def _prune(self):
+
+        pid = os.getpid()
+        alive = set(t.ident for t in threading.enumerate())
+
+        with self.lock:
+            for k in self.conns.keys():
+                if k[0] != pid:
+                    self.inherited.append(self.conns.pop(k))
+                elif k[1] is not None and k[1] not in alive:
+                    self._close(self.conns.pop(k)[0])
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _alive(conn):
+    try:
+        conn.ping()
+        return True
+    except MySQLdb.Error:
+        return False
+
+
+connections = Connections()
+
+
+# }}}
+###############################################################################
+
+
+
+###############################################################################
+# {{{ class PriceTable: in-process snapshot of netcall.price_tables
+#
+# Route prices are looked up for every connected call, so instead of a round trip per call each process keeps the
+# price tables it has used in memory: (ptgroup, ruleid) -> mprice.  A price table is loaded with one query the first
+# time it's used; a rule that isn't in the loaded table (added since) is looked up on its own and remembered.
+#
+# price_tables is maintained outside this tree (rating admin, rate deck imports), so invalidation is a contract with
+# those tools: after changing rows of a price table they call NetcallDB.priceTableChanged(ptgroup) (from a shell or
+# Perl script: python netcall.py --price-table-changed PTGROUP), which bumps the table's version in the Redis hash
+# VERSIONS and publishes the ptgroup on CHANNEL.  Lookups pick up published changes (at most every CHECK seconds,
+# without a round trip: the messages are already in the socket buffer) and drop the changed tables, to be reloaded
+# on next use.  In case a message got lost (Redis restart, ...), the versions are compared every VERIFY seconds too.
+# A writer that doesn't call it, or no Redis: all tables are dropped every VERIFY seconds, so a price change takes
+# effect within VERIFY seconds either way.
+
+def _price(mprice):
+    if mprice is None:
+        return None
+    return float(mprice)
+
+
+class PriceTable(object):
+    'in-process (ptgroup, ruleid) -> route price per minute map, reloaded per ptgroup when prices change'
+
+    VERSIONS = 'pt:versions'  # Redis hash: ptgroup -> version
+    CHANNEL = 'pt:changed'    # Redis pub/sub channel: ptgroup
+    CHECK = 1                 # seconds between checks for published changes
+    VERIFY = 60               # seconds between version checks
+
+    # db: NetcallDB to load prices with (default: one of its own)
+    def __init__(self, db=None):
+
+        self.dbarg = db
+        self.clear()
+
+    # forget everything, e.g. in a forked worker (don't use the parent's connections)
+    def clear(self):
+
+        self.db = self.dbarg
+        self.groups = {}    # ptgroup -> {ruleid: mprice}
+        self.versions = {}  # ptgroup -> version it was loaded at
+        self.pubsub = None
+        self.nextcheck = 0
+        self.nextverify = 0
+
+
+    def getPrice(self, ptgroup, ruleid):
+
+        if time.time() >= self.nextcheck:
+            self.check()
+
+        prices = self.groups.get(ptgroup)
+        if prices is None:
+            prices = self._load(ptgroup)
+
+        try:
+            return prices[ruleid]
+        except KeyError:
+            runstats.stats.count('price_misses')
+            p = prices[ruleid] = self._db().getPrice(ptgroup, ruleid)
+            return p
+
+
+    # drop the price tables that changed since they were loaded
+    def check(self):
+
+        now = time.time()
+        self.nextcheck = now + PriceTable.CHECK
+
+        r = self._db()._redis()
+
+        if not r:
+            if now >= self.nextverify:
+                self.nextverify = now + PriceTable.VERIFY
+                self.groups.clear()
+            return
+
+        try:
+            if not self.pubsub:
+                self.pubsub = r.pubsub()
+                self.pubsub.subscribe(PriceTable.CHANNEL)
+                self.nextverify = 0  # may have missed messages while we weren't subscribed
+
+            while True:
+                m = self.pubsub.get_message()
+                if not m:
+                    break
+                if m['type'] == 'message':
+                    self._drop(_int(m['data']))
+
+            if now >= self.nextverify:
+                self.nextverify = now + PriceTable.VERIFY
+                runstats.stats.count('redis_queries')
+                versions = r.hgetall(PriceTable.VERSIONS)
+                for g in self.groups.keys():
+                    if versions.get(str(g)) != self.versions.get(g):
+                        self._drop(g)
+
+        except redis.RedisError as e:
+            log.warning('price table change check failed: %s', e)
+            self.pubsub = None
+
+
+    def _load(self, ptgroup):
+
+        db = self._db()
+        r = db._redis()
+
+        version = None
+        if r:
+            try:
+                runstats.stats.count('redis_queries')
+                version = r.hget(PriceTable.VERSIONS, ptgroup)  # before the query, so a change during it isn't missed
+            except redis.RedisError as e:
+                log.warning('could not get price table version: %s', e)
+
+        runstats.stats.count('price_loads')
+        prices = db.getPriceTable(ptgroup)
+
+        self.groups[ptgroup] = prices
+        self.versions[ptgroup] = version
+
+        return prices
+
+    def _drop(self, ptgroup):
+        if ptgroup in self.groups:
+            log.info('price table %s changed, reloading', ptgroup)
+            del self.groups[ptgroup]
+
+    def _db(self):
+        if not self.db:
+            self.db = NetcallDB()
+        return self.db
+
+
+def _int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return v
+
+
+priceTable = PriceTable()
+
+
+# }}}
+###############################################################################
+
+
+
 ###############################################################################
 # {{{ classes Carrer/Customer/Terminator
 
@@ -598,6 +1341,33 @@ class Customer(Carrier):
         return (cp, self.ptgroup)
 
 
+    # CdrBatch version of calculateRoundedBillingSeconds: fill in the billing spec columns (r1, r2) for the rows
+    # in mask (a boolean column); the batch does the rounding.  Subclasses with custom rounding rules should
+    # override both methods.
+    def applyBillingSpecs(self, batch, mask):
+
+        batch.r1[mask] = self.billing_spec_r1
+        batch.r2[mask] = self.billing_spec_r2
+
+
+    # CdrBatch version of computeCallPrice: fill in the ptgroup and route price per minute (mprice) columns for
+    # the rows in mask; the batch multiplies by the rounded seconds.  Prices are looked up once per rule.
+    def applyCallPrices(self, batch, mask):
+
+        batch.ptgroup[mask] = self.ptgroup
+
+        for (ruleid, rmask) in batch.groupBy(mask & (batch.s_connected_r > 0), 'ruleid'):
+
+            rt_price_minute = self.db.getRoutePrice(self.ptgroup, ruleid)
+
+            if not rt_price_minute:
+                for cdr in batch.getCdrs(rmask):
+                    log.error("no route price available! ptgroup=%d ruleid=%d callid=%s", self.ptgroup, cdr.ruleid, cdr.callid)
+                continue
+
+            batch.mprice[rmask] = rt_price_minute
+
+
 
 
 ### custom carrier classes
@@ -626,6 +1396,14 @@ class QuickcomCustomer(Customer):
 
         return self._calculateRoundedBillingSeconds(s_connected, r1, r2)
 
+    def applyBillingSpecs(self, batch, mask):
+
+        Customer.applyBillingSpecs(self, batch, mask)
+
+        mx = mask & (batch.bnumCountries() == 'MX')
+        batch.r1[mx] = 1
+        batch.r2[mx] = 1
+
 ###
 ###
 
@@ -730,6 +1508,272 @@ def test_sanity_check_carrierData():
         dupes_c5.add(d['code5'])
 
 
+def test_call_digest():
+
+    row = ['a22', 'US', 12, 0.0015, datetime(2013, 12, 1, 12, 12, 12), None]
+    d = _callDigest(row)
+
+    assert len(d) == 16
+    assert _callDigest([u'a22'] + row[1:]) == d   # checkpoint-restored fields come back as unicode
+    assert _callDigest(row[:-1] + ['None']) != d
+    assert _callDigest(row[:-1] + ['']) != d
+    assert _callDigest(row[:3] + [0.0016] + row[4:]) != d
+
+
+# PriceTable against a scripted Redis: published changes, missed messages
+def test_price_table():
+
+    class FakePubSub(object):
+        def __init__(self, msgs): self.msgs = msgs
+        def subscribe(self, ch): self.msgs.append({'type': 'subscribe', 'data': 1})
+        def get_message(self): return self.msgs and self.msgs.pop(0)
+
+    class FakeRedis(object):
+        def __init__(self):
+            self.h = {}
+            self.msgs = []
+        def hget(self, k, f): return self.h.get(str(f))
+        def hgetall(self, k): return dict(self.h)
+        def pubsub(self): return FakePubSub(self.msgs)
+
+    class FakeDB(object):
+        def __init__(self):
+            self.r = FakeRedis()
+            self.prices = {7: {100: 0.01, 101: None}}
+            self.loads = []
+        def _redis(self): return self.r
+        def getPriceTable(self, g):
+            self.loads.append(g)
+            return dict(self.prices.get(g, {}))
+        def getPrice(self, g, rule):
+            self.loads.append((g, rule))
+            return self.prices.get(g, {}).get(rule)
+
+    db = FakeDB()
+    pt = PriceTable(db)
+
+    assert pt.getPrice(7, 100) == 0.01
+    assert pt.getPrice(7, 101) is None
+    assert pt.getPrice(7, 100) == 0.01
+    assert db.loads == [7]
+
+    # rule added after the table was loaded
+    db.prices[7][102] = 0.02
+    assert pt.getPrice(7, 102) == 0.02
+    assert pt.getPrice(7, 102) == 0.02
+    assert db.loads == [7, (7, 102)]
+
+    # published change: table reloaded on the next check
+    db.prices[7][100] = 0.011
+    db.r.h['7'] = '1'
+    db.r.msgs.append({'type': 'message', 'data': '7'})
+    assert pt.getPrice(7, 100) == 0.01   # not checked yet
+    pt.check()
+    assert pt.getPrice(7, 100) == 0.011
+    assert db.loads == [7, (7, 102), 7]
+
+    # missed message: the version check catches it
+    db.prices[7][100] = 0.012
+    db.r.h['7'] = '2'
+    pt.check()
+    assert pt.getPrice(7, 100) == 0.011
+    pt.nextverify = 0
+    pt.check()
+    assert pt.getPrice(7, 100) == 0.012
+
+    pt.clear()
+    assert pt.db is db and not pt.groups
+
+    # without Redis, every VERIFY seconds all tables are dropped and reloaded on next use
+    db.r = None
+    pt.clear()
+    assert pt.getPrice(7, 100) == 0.012
+    db.prices[7][100] = 0.013
+    pt.check()
+    assert pt.getPrice(7, 100) == 0.012
+    pt.nextverify = 0
+    pt.check()
+    assert pt.getPrice(7, 100) == 0.013
+    assert db.loads[-2:] == [7, 7]
+
+
+# Call-Id -> callids.id through the hash index, with the full-string fallback
+def test_callid_hash_lookup():
+
+    class FakeCursor(object):
+        def __init__(self, rows):
+            self.rows = rows  # the callids table: [id, callid, cid_hash]
+            self.result = []
+            self.sql = []
+        def execute(self, sql, args):
+            self.sql.append(sql)
+            if sql.startswith('INSERT'):
+                for (cid, h) in zip(args[::2], args[1::2]):
+                    if cid.lower() not in [r[1].lower() for r in self.rows]:  # UNIQUE KEY (callid), case insensitive
+                        self.rows.append([len(self.rows) + 1, cid, h])
+            elif 'cid_hash IN' in sql:
+                self.result = [{'id': r[0], 'callid': r[1], 'cid_hash': r[2]} for r in self.rows if r[2] in args]
+            else:
+                args = [a.lower() for a in args]
+                self.result = [{'id': r[0], 'callid': r[1]} for r in self.rows if r[1].lower() in args]
+        def fetchall(self):
+            return self.result
+
+    # 'b@x' shares its hash with a stored, different Call-Id (a collision); 'C@x' is stored as 'c@x'
+    cur = FakeCursor([[1, 'a@x', cidHash('a@x')], [2, 'zz@x', cidHash('b@x')], [3, 'c@x', cidHash('c@x')]])
+
+    ids = NetcallDB()._getOrMakeIdsFromCallIds(cur, ['a@x', 'b@x', 'C@x', 'd@x'])
+
+    assert ids == {'a@x': 1, 'b@x': 4, 'C@x': 3, 'd@x': 5}
+    assert len([q for q in cur.sql if 'WHERE callid IN' in q]) == 1
+
+    assert cidKey('a@x') == int(cidHash('a@x')[:8].encode('hex'), 16)
+
+
+# calls ids of a multi-row insert, against a scripted connection reporting the server's auto_increment settings
+def test_insert_call_rows():
+
+    class FakeConn(object):
+        def __init__(self, mode, inc):
+            (self.mode, self.inc) = (mode, inc)
+            self.sql = []
+            self.next = 11
+            self.first = None
+        def cursor(self, cls=None):
+            return FakeCursor(self)
+        def insert_id(self):
+            return self.first
+        def close(self): pass
+
+    class FakeCursor(object):
+        def __init__(self, conn):
+            self.conn = conn
+        def execute(self, sql, args=None):
+            self.conn.sql.append(sql)
+            if sql.startswith('INSERT'):
+                self.conn.first = self.conn.next
+                self.conn.next += self.conn.inc * sql.count('),(') + self.conn.inc
+        def fetchone(self):
+            return {'m': self.conn.mode, 'inc': self.conn.inc}
+
+    rows = [[None] * len(WRITECOLS)] * 3
+
+    try:
+        for (mode, inc, ids, ninserts) in [(1, 1, [11, 12, 13], 1), (1, 2, [11, 13, 15], 1), (2, 2, [11, 13, 15], 3)]:
+            conn = FakeConn(mode, inc)
+            connections.set('nc', conn)
+            db = NetcallDB()
+            assert db._insertCallRows(conn.cursor(), rows) == ids
+            assert len([q for q in conn.sql if q.startswith('INSERT')]) == ninserts
+            assert db.autoinc_step == (inc if mode < 2 else 0)
+
+    finally:
+        connections.close()
+
+
+# Call-Id discovery against a scripted connection: checks the queries and de-duplication, not MySQL
+def test_iter_callids():
+
+    class FakeConn(object):
+        def __init__(self):
+            self.sql = []
+            self.reads = 0
+        def cursor(self, cls=None):
+            return FakeCursor(self)
+        def commit(self): pass
+        def close(self): pass
+
+    class FakeCursor(object):
+        def __init__(self, conn):
+            self.conn = conn
+            self.rows = []
+        def execute(self, sql, args=None):
+            self.conn.sql.append(sql)
+            if sql.startswith('SHOW'):
+                self.rows = [('Handler_read_next', str(self.conn.reads))]
+                self.conn.reads += 7  # the SHOW's own reads (temporary table)
+            elif 'acc_idx_prtime' in sql:
+                self.rows = [('a',), ('b',), ('a',)]
+                self.conn.reads += 3
+            elif 'acc_idx_time' in sql:
+                self.rows = [('b',), ('c',)]
+                self.conn.reads += 2
+        def fetchmany(self, n):
+            (rows, self.rows) = (self.rows[:n], self.rows[n:])
+            return rows
+        def fetchall(self):
+            return self.fetchmany(len(self.rows))
+        def close(self): pass
+
+    conn = FakeConn()
+    connections.set('os.stream', conn)
+
+    db = NetcallDB()
+
+    try:
+        assert db.getCallIds('2013-06-19', '2013-06-20') == ['a', 'b', 'c']
+        assert db.rows_examined == 5
+        assert [q for q in conn.sql if ' OR ' in q] == []
+
+        assert db.getCallIds('2013-06-19', '2013-06-20', 'a22', 2) == ['a', 'b']
+        assert 'src_id=%s' in conn.sql[-2]
+        assert db.rows_examined == 3  # stopped after the first query
+
+    finally:
+        connections.close()
+
+
+def test_connections():
+
+    class FakeConn(object):
+        def __init__(self, n):
+            self.n = n
+            self.up = True
+            self.closed = False
+        def ping(self):
+            if not self.up: raise MySQLdb.Error('gone away')
+        def close(self):
+            self.closed = True
+
+    made = []
+    def connect():
+        made.append(FakeConn(len(made)))
+        return made[-1]
+
+    reg = Connections()
+
+    # one per thread and kind, reused
+    assert reg.get('nc', connect) is made[0]
+    assert reg.get('nc', connect) is made[0]
+    assert reg.get('os', connect) is made[1]
+    assert reg.get('redis', connect, shared=True) is made[2]
+
+    other = []
+    th = threading.Thread(target=lambda: other.extend([reg.get('nc', connect), reg.get('redis', connect, True)]))
+    th.start()
+    th.join()
+    assert other == [made[3], made[2]]
+
+    # the exited thread's connection is closed when the next one is made
+    assert reg.get('os.stream', connect) is made[4]
+    assert made[3].closed and not made[0].closed
+
+    # idle and dead: replaced
+    made[0].up = False
+    assert reg.get('nc', connect) is made[0]  # recently used, not checked
+    reg.expire()
+    assert reg.get('nc', connect) is made[5]
+    assert made[0].closed
+
+    reg.close()
+    assert made[1].closed and made[4].closed and made[5].closed and not made[2].closed
+
+    # the parent's connections in a forked child: parked, never closed or freed
+    reg.conns[(-1, None, 'nc')] = [made[0], 0]
+    assert reg.get('nc', connect) is made[6]
+    assert (-1, None, 'nc') not in reg.conns and reg.inherited[-1][0] is made[0]
+
+
 def test_calc_bill_sec():
 
     code3_2_customers.clear()
@@ -861,6 +1905,7 @@ def test_pcaps_db_ops():
     assert len(p1[3]) == len(tstPkt1)
 
 
+# build a simple hand-crafted Call/Cdr object
 def test_cdr_db_ops():
 
     erase_test_db()
@@ -908,6 +1953,81 @@ def test_cdr_db_ops():
     assert True
 
 
+def _mkTestCall(callid):
+
+    call = nccdr.Call(callid)
+
+    cdr = nccdr.Cdr(callid, 'tag123')
+
+    cdr.t_start = datetime.strptime('2013-12-01 12:12:12', '%Y-%m-%d %H:%M:%S')
+    cdr.t_confirm = datetime.strptime('2013-12-01 12:12:14', '%Y-%m-%d %H:%M:%S')
+    cdr.t_end = datetime.strptime('2013-12-01 12:12:14', '%Y-%m-%d %H:%M:%S')
+    cdr.s_setup = 2
+    cdr.s_connected = 0
+    cdr.s_connected_r = 0
+    cdr.s_total = 2
+
+    cdr.c_from = 'ryn'
+    cdr.anum = '15032223333'
+    cdr.anum2 = '15032223333'
+    cdr.a_country = 'US'
+    cdr.bnum = '12123443434'
+    cdr.b_lrn = '12125452233'
+    cdr.b_jtype = 'D'
+    cdr.xstate = 'inter'
+
+    cdr.call_price = 0.0
+    cdr.ruleid = 666
+    cdr.cp_node = ['g23', 'g44']
+
+    call.f_cdr = cdr
+
+    return call
+
+
+# test_cdr_db_bulk_ops needs a dr_rules_cp_archive row too (see test_cdr_db_ops)
+def _addTestRule(db):
+
+    ncc = db._ncc()
+    cur = ncc.cursor(MySQLdb.cursors.DictCursor)
+    sql = 'INSERT INTO dr_rules_cp_archive (ruleid, groupid, prefix, timerec, priority, routeid, gwlist, attrs, description) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)'
+    cur.execute(sql, (666, '8', '503593', '', 0, None, '#ctl,#lv3,#c99', None, ''))
+
+
+def test_cdr_db_bulk_ops():
+
+    erase_test_db()
+    db = NetcallDB()
+    _addTestRule(db)
+
+    calls = [_mkTestCall('lkjdsflknm%d' % (i)) for i in range(5)]
+
+    db.writeCallRecord(calls[0])
+
+    # calls[0] is already there as is, the rest are new; a call without an F-Cdr is reported, not written
+    nofcdr = nccdr.Call('nofcdr')
+    assert db.writeCallRecords(calls + [nofcdr], batchsize=2) == (4, 1, [], [nofcdr])
+    assert db.writeCallRecords(calls[3:]) == (0, 2, [], [])
+
+    cur = db._ncc().cursor(MySQLdb.cursors.DictCursor)
+    cur.execute("SELECT count(*) AS n FROM calls")
+    assert cur.fetchone()['n'] == 5
+    cur.execute("SELECT I.callid, C.c_from, C.cp_nodes FROM calls C, callids2calls IC, callids I WHERE IC.calls_id=C.id AND IC.callid_id=I.id")
+    rows = cur.fetchall()
+    assert sorted(h['callid'] for h in rows) == sorted(c.callid for c in calls)
+    assert set((h['c_from'], h['cp_nodes']) for h in rows) == set([('ryn', 'g23,g44')])
+
+    # rerun: nothing changed, nothing written; a changed record is updated in place
+    runstats.stats.reset()
+    calls[1].getFCdr().s_connected_r = 6
+    assert db.writeCallRecords(calls) == (1, 4, [], [])
+    assert runstats.stats.counts['calls_unchanged'] == 4
+    assert runstats.stats.counts['calls_updated'] == 1
+    cur.execute("SELECT count(*) AS n, sum(s_connected_r) AS r FROM calls")
+    h = cur.fetchone()
+    assert (h['n'], h['r']) == (5, 6)
+
+
 ## }}}
 ###############################################################################
 
@@ -916,4 +2036,9 @@ def test_cdr_db_ops():
 
 if __name__ == '__main__':
 
-    pass
+    # python netcall.py --price-table-changed PTGROUP: tell running processes price table PTGROUP changed
+    opts, args = getopt.getopt(sys.argv[1:], '', ['price-table-changed='])
+
+    for opt, arg in opts:
+        if opt=='--price-table-changed':
+            NetcallDB().priceTableChanged(int(arg))
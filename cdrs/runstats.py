@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# RunStats: wall time per pipeline stage plus counters (rows, calls, branches, database round trips ...) for a
+# cdr processing run, written out as one json record per run so we can see which stage is eating the cron budget.
+#
+# Stages can nest (e.g. 'price' happens inside 'finalize'), so stage times don't add up to the run's wall time.
+#
+# Each process has its own module-level `stats`; worker processes send theirs back with data() and the parent
+# merge()s them.  Threads within a process (see nccdr's pipelined record_calls) share it, so updates are locked.
+#
+# test with py.test
+
+
+
+import time, os, socket, json, threading
+import logging as log
+from collections import Counter
+from contextlib import contextmanager
+
+
+
+###############################################################################
+# {{{ class RunStats
+
+class RunStats(object):
+    'wall time per stage and counters for a processing run'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.t0 = time.time()
+        self.times = Counter()
+        self.counts = Counter()
+
+
+    # with stats.timer('stage'): ...
+    @contextmanager
+    def timer(self, stage):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self._addTime(stage, time.time() - t)
+
+    # wrap an iterator (generator) to time only the work done producing its items, not the consumer's
+    def timeiter(self, stage, it):
+
+        it = iter(it)
+
+        while True:
+            t = time.time()
+            try:
+                v = it.next()
+            except StopIteration:
+                return
+            finally:
+                self._addTime(stage, time.time() - t)
+            yield v
+
+    def _addTime(self, stage, secs):
+        with self.lock:
+            self.times[stage] += secs
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+
+    def data(self):
+        return {'times': dict(self.times), 'counts': dict(self.counts)}
+
+    def merge(self, data):
+        with self.lock:
+            self.times.update(data['times'])
+            self.counts.update(data['counts'])
+
+
+    # the stats record for this run; extra: more fields to add (mode, date range ...)
+    def record(self, **extra):
+
+        rec = {
+            'ts':      int(self.t0),
+            'host':    socket.gethostname(),
+            'pid':     os.getpid(),
+            'wall':    round(time.time() - self.t0, 3),
+            'stages':  dict((k, round(v, 3)) for (k, v) in self.times.iteritems()),
+            'counts':  dict(self.counts),
+        }
+        rec.update(extra)
+
+        return rec
+
+
+# append the record as a json line to path, and/or push it on a Redis list (newest first, trimmed to REDIS_KEEP)
+REDIS_KEY = 'cdr:runstats'
+REDIS_KEEP = 1000
+
+def writeRecord(rec, path=None, r=None):
+
+    line = json.dumps(rec, sort_keys=True)
+
+    if path:
+        with open(path, 'a') as f:
+            f.write(line + '\n')
+
+    if r:
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.lpush(REDIS_KEY, line)
+            pipe.ltrim(REDIS_KEY, 0, REDIS_KEEP-1)
+            pipe.execute()
+        except Exception as e:
+            log.warning('could not write run stats to Redis: %s', e)
+
+
+stats = RunStats()
+
+
+# }}}
+###############################################################################
+
+
+###############################################################################
+## {{{ py.test tests
+
+
+def test_runstats(tmpdir):
+
+    st = RunStats()
+
+    with st.timer('a'):
+        time.sleep(0.01)
+
+    def gen():
+        time.sleep(0.01)
+        yield 1
+        yield 2
+
+    for v in st.timeiter('load', gen()):
+        time.sleep(0.02)  # consumer time isn't counted
+        st.count('rows')
+
+    assert st.times['a'] >= 0.01
+    assert 0.01 <= st.times['load'] < 0.03
+    assert st.counts['rows'] == 2
+
+    st2 = RunStats()
+    st2.count('rows', 3)
+    st.merge(st2.data())
+    assert st.counts['rows'] == 5
+
+    path = str(tmpdir.join('stats'))
+    writeRecord(st.record(mode='cron'), path)
+    writeRecord(st.record(mode='cron'), path)
+
+    recs = [json.loads(l) for l in open(path)]
+    assert len(recs) == 2
+    assert recs[0]['counts'] == {'rows': 5}
+    assert recs[0]['mode'] == 'cron'
+    assert set(recs[0]['stages']) == set(['a', 'load'])
+
+## }}}
+###############################################################################
@@ -0,0 +1,4 @@
+-- upgrade an existing netcall database: change digest for calls records (see NetcallDB.writeCallRecord(s)).
+-- existing rows keep a NULL digest and are rewritten (in place) once the next time they're processed.
+
+ALTER TABLE calls ADD COLUMN cdigest binary(16) default null AFTER cp_nodes;
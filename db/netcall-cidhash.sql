@@ -0,0 +1,6 @@
+-- upgrade an existing netcall database: Call-Id digest for callids lookups (see NetcallDB._getIdFromCallId).
+-- run before deploying the code that uses it; the UPDATE rewrites every row, so expect it to take a while.
+
+ALTER TABLE callids ADD COLUMN cid_hash binary(16) default null AFTER callid;
+UPDATE callids SET cid_hash = UNHEX(MD5(callid));
+ALTER TABLE callids MODIFY cid_hash binary(16) not null, ADD KEY callids_hash (cid_hash);
@@ -76,6 +76,8 @@ CREATE TABLE calls (
 
     cp_nodes varchar(255), -- comma-separated list of cp nodes used
 
+    cdigest binary(16) default null, -- md5 over the columns above, to skip rewriting unchanged records
+
   FOREIGN KEY (ruleid) REFERENCES dr_rules_cp_archive(ruleid)
 
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -86,7 +88,9 @@ CREATE INDEX calls_ite ON calls(t_end);
 CREATE TABLE callids (
     id     int(10) primary key auto_increment,
     callid varchar(250) not null,
-   UNIQUE KEY (callid)
+    cid_hash binary(16) not null, -- md5(callid): lookups go through this (much smaller) index, then check callid
+   UNIQUE KEY (callid),
+   KEY callids_hash (cid_hash)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 